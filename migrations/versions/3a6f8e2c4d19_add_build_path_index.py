@@ -0,0 +1,29 @@
+"""add an index on build.path for nas.data lookups
+
+Revision ID: 3a6f8e2c4d19
+Revises: 5e7a3c9d2b41
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3a6f8e2c4d19"
+down_revision: Union[str, Sequence[str], None] = "5e7a3c9d2b41"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("build") as batch_op:
+        batch_op.create_index("ix_build_path", ["path"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("build") as batch_op:
+        batch_op.drop_index("ix_build_path")
@@ -0,0 +1,34 @@
+"""add build_architecture index for conflict detection
+
+Revision ID: 4d8a2f6c3b17
+Revises: 7b2e4c9d1a05
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "4d8a2f6c3b17"
+down_revision: Union[str, Sequence[str], None] = "7b2e4c9d1a05"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        "ix_build_architecture_architecture_id_build_id",
+        "build_architecture",
+        ["architecture_id", "build_id"],
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(
+        "ix_build_architecture_architecture_id_build_id",
+        table_name="build_architecture",
+    )
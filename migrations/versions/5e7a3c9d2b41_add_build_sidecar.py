@@ -0,0 +1,70 @@
+"""add build_sidecar table replacing sidecar files
+
+Revision ID: 5e7a3c9d2b41
+Revises: 9c3e1b7a5d20
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+
+import io
+import json
+import os
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from flask import current_app
+
+# revision identifiers, used by Alembic.
+revision: str = "5e7a3c9d2b41"
+down_revision: Union[str, Sequence[str], None] = "9c3e1b7a5d20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    build_sidecar = op.create_table(
+        "build_sidecar",
+        sa.Column("build_id", sa.Integer(), nullable=False),
+        sa.Column("info", sa.JSON(), nullable=False),
+        sa.Column("derived", sa.JSON(), nullable=False),
+        sa.Column("calculated", sa.JSON(), nullable=False),
+        sa.ForeignKeyConstraint(["build_id"], ["build.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("build_id"),
+    )
+
+    # Import the sidecar files of remote builds, left in place for rollbacks
+    build = sa.table(
+        "build",
+        sa.column("id", sa.Integer),
+        sa.column("path", sa.Unicode),
+        sa.column("storage", sa.Unicode),
+    )
+    data_path = current_app.config["DATA_PATH"]
+    rows = []
+    for build_id, path in op.get_bind().execute(
+        sa.select(build.c.id, build.c.path).where(build.c.storage == "remote")
+    ):
+        try:
+            with io.open(
+                os.path.join(data_path, path + ".json"), "r", encoding="utf-8"
+            ) as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError):
+            continue
+        rows.append(
+            {
+                "build_id": build_id,
+                "info": sidecar["info"],
+                "derived": sidecar["derived"],
+                "calculated": sidecar["calculated"],
+            }
+        )
+    if rows:
+        op.bulk_insert(build_sidecar, rows)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("build_sidecar")
@@ -0,0 +1,32 @@
+"""add build.upload_digest for upload deduplication
+
+Revision ID: 7b2e4c9d1a05
+Revises: 3f5664905242
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "7b2e4c9d1a05"
+down_revision: Union[str, Sequence[str], None] = "3f5664905242"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("build") as batch_op:
+        batch_op.add_column(sa.Column("upload_digest", sa.Unicode(length=64)))
+        batch_op.create_index("ix_build_upload_digest", ["upload_digest"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("build") as batch_op:
+        batch_op.drop_index("ix_build_upload_digest")
+        batch_op.drop_column("upload_digest")
@@ -0,0 +1,30 @@
+"""add build.member_index for direct archive member reads
+
+Revision ID: 9c3e1b7a5d20
+Revises: 4d8a2f6c3b17
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9c3e1b7a5d20"
+down_revision: Union[str, Sequence[str], None] = "4d8a2f6c3b17"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("build") as batch_op:
+        batch_op.add_column(sa.Column("member_index", sa.JSON()))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("build") as batch_op:
+        batch_op.drop_column("member_index")
@@ -3,11 +3,13 @@ import logging
 import sys
 
 import jinja2
-from flask import Flask, request
+from celery import current_task
+from flask import Flask, has_app_context, request
 from flask_admin import Admin
 from flask_security.signals import user_registered
 
 from . import config as default_config
+from . import storage
 from .cli import spkrepo as spkrepo_cli
 from .ext import babel, cache, celery, db, debug_toolbar, mail, migrate, security
 from .filters import register_filters
@@ -28,6 +30,7 @@ from .views import (
     frontend,
     nas,
 )
+from .views.tasks import flush_cdn_purges
 
 CACHEABLE_ENDPOINTS = {
     "nas.catalog",
@@ -133,12 +136,50 @@ def create_app(config=None, register_blueprints=True, init_admin=True):
 
     class FlaskTask(celery.Task):
         def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return self.run(*args, **kwargs)
+            if not has_app_context():
+                with app.app_context():
+                    return self.run(*args, **kwargs)
+
+            # run eagerly from a request or another task: its CDN purges are
+            # handed over to the caller, to be flushed once with its own
+            purges = ([], [])
+            try:
+                with app.app_context():
+                    try:
+                        return self.run(*args, **kwargs)
+                    finally:
+                        purges = storage.pending_purges()
+            finally:
+                storage.queue_purges(*purges)
 
     celery.Task = FlaskTask
     app.extensions["celery"] = celery
 
+    @app.teardown_appcontext
+    def queue_cdn_purges(exception):
+        """Send the CDN purges collected during a request or task at once.
+
+        They are sent synchronously if the task cannot be queued, or from
+        :func:`~spkrepo.views.tasks.flush_cdn_purges` itself.
+        """
+        url_paths, keys = storage.pending_purges()
+        if not url_paths and not keys:
+            return
+        if current_task and current_task.name == flush_cdn_purges.name:
+            # a flush must not queue another one
+            failed_paths, failed_keys = storage.send_purges(url_paths, keys)
+        else:
+            try:
+                flush_cdn_purges.delay(url_paths, keys)
+                return
+            except Exception:
+                app.logger.exception("Failed to queue CDN purges, sending them now")
+                failed_paths, failed_keys = storage.send_purges(url_paths, keys)
+        if failed_paths or failed_keys:
+            app.logger.error(
+                "CDN purges lost: %s", " ".join((*failed_paths, *failed_keys))
+            )
+
     @app.after_request
     def set_cache_control(response):
         endpoint = request.endpoint or ""
@@ -149,7 +190,7 @@ def create_app(config=None, register_blueprints=True, init_admin=True):
             or endpoint == "frontend.profile"
         ):
             response.headers["Cache-Control"] = "no-store, private"
-        elif endpoint in CACHEABLE_ENDPOINTS:
+        elif endpoint in CACHEABLE_ENDPOINTS and response.cache_control.max_age is None:
             response.headers["Cache-Control"] = "public"
         return response
 
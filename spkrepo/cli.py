@@ -1,16 +1,24 @@
+import io
+import json
 import logging
 import os
 import re
 import shutil
+import time
 import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 from datetime import date, datetime
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
 
+from .exceptions import SPKParseError
 from .ext import db
+from .hashing import hash_file, hash_stream
 from .models import Build, Package, Role, User
+from .uploads import UPLOADS_DIRNAME
+from .utils import SPK
 
 
 def _create_user(username, email, password):
@@ -332,13 +340,13 @@ def parse_download(record):
 def ingest_logs():
     """Ingest download stats from Object Storage log files."""
     import gzip
-    import json
     from collections import defaultdict
 
     import boto3
     from botocore.exceptions import BotoCoreError, ClientError
 
-    from .models import Architecture, Build, DownloadStat
+    from . import reference
+    from .models import Build, DownloadStat
 
     logger = logging.getLogger(__name__)
 
@@ -429,7 +437,7 @@ def ingest_logs():
 
                 if arch_code is not None:
                     if arch_code not in arch_cache:
-                        arch = Architecture.find(arch_code, syno=True)
+                        arch = reference.architecture(arch_code, syno=True)
                         arch_cache[arch_code] = arch.id
                     architecture_id = arch_cache[arch_code]
                 else:
@@ -537,3 +545,217 @@ def ingest_logs():
             logger.info("Refreshed package_download_counts materialized view.")
         except Exception as e:
             logger.error("Failed to refresh package_download_counts: %s", e)
+
+
+class _ThrottledReader(io.RawIOBase):
+    """Seekable binary stream wrapper sleeping as needed to read at most
+    `max_rate` bytes per second from `f`."""
+
+    def __init__(self, f, max_rate):
+        super().__init__()
+        self.f = f
+        self.max_rate = max_rate
+        self.start = time.monotonic()
+        self.read_size = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def readinto(self, b):
+        length = self.f.readinto(b)
+        self.read_size += length
+        delay = self.read_size / self.max_rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+        return length
+
+
+def verify_build_file(file_path, md5, size, signed, max_rate=0):
+    """Verify a build's SPK file against the values recorded for it.
+
+    Runs in a worker process of the ``verify`` command, without an
+    application context.
+
+    :param file_path: absolute path of the SPK
+    :param md5: md5 recorded for the build
+    :param size: size recorded for the build
+    :param signed: whether the build is recorded as signed
+    :param max_rate: maximum bytes read per second, 0 for no limit
+    :returns: list of problems found, empty if the file is valid
+    """
+    if not os.path.exists(file_path):
+        return ["missing file"]
+    problems = []
+    with io.open(file_path, "rb") as f:
+        if max_rate:
+            # the file is parsed through the throttle as well
+            stream = io.BufferedReader(_ThrottledReader(f, max_rate))
+            digests, file_size = hash_stream(stream)
+        else:
+            stream = f
+            digests, file_size = hash_file(file_path)
+        if file_size != size:
+            problems.append(f"size mismatch: {file_size} on disk, {size} recorded")
+        if digests["md5"] != md5:
+            problems.append(f"md5 mismatch: {digests['md5']} on disk, {md5} recorded")
+        # parsed through its tar headers, the stored member index may be stale;
+        # the md5 of the whole file already covers the checksum of package.tgz
+        stream.seek(0)
+        try:
+            spk = SPK(stream, verify_checksum=False)
+        except SPKParseError as e:
+            problems.append(f"invalid SPK: {e}")
+            return problems
+    if spk.signature is not None and not signed:
+        problems.append("signature drift: file is signed, build is not")
+    elif spk.signature is None and signed:
+        problems.append("signature drift: build is signed, file is not")
+    return problems
+
+
+def _find_orphans(data_path, paths):
+    """Return the SPK files under `data_path` that are not in `paths`."""
+    orphans = []
+    for root, dirs, files in os.walk(data_path):
+        dirs[:] = sorted(d for d in dirs if d != UPLOADS_DIRNAME)
+        for name in sorted(files):
+            if not name.endswith(".spk"):
+                continue
+            path = os.path.relpath(os.path.join(root, name), data_path)
+            if path not in paths:
+                orphans.append(path)
+    return orphans
+
+
+@spkrepo.command("verify")
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--max-rate",
+    type=click.FloatRange(min=0),
+    default=0,
+    help="Maximum read throughput in MB/s shared by all workers, 0 for none.",
+)
+@click.option(
+    "--state",
+    type=click.Path(dir_okay=False),
+    help="File recording the builds already verified, to resume an interrupted run.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Where to write the JSON report, standard output by default.",
+)
+@click.pass_context
+@with_appcontext
+def verify(ctx, jobs, max_rate, state, output):
+    """Verify local SPK files against the database.
+
+    Each build stored locally is parsed and its md5, size and signature are
+    compared with the database, in a pool of worker processes. SPK files that
+    no build refers to are reported as orphans. Exits with status 1 if any
+    problem is found.
+    """
+    data_path = current_app.config["DATA_PATH"]
+    rate = max_rate * 1024 * 1024 / jobs
+
+    results = {}
+    if state and os.path.exists(state):
+        with io.open(state, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["build_id"]] = result
+    state_file = io.open(state, "a", encoding="utf-8") if state else None
+
+    builds = db.session.execute(
+        db.select(
+            Build.id,
+            Build.path,
+            Build.md5,
+            Build.size,
+            Build.signed,
+            Build.storage,
+        ).order_by(Build.id)
+    ).all()
+    paths = {build.path for build in builds if build.path}
+    skipped = [build.id for build in builds if build.storage != "local"]
+
+    def record(result):
+        results[result["build_id"]] = result
+        if state_file is not None:
+            state_file.write(json.dumps(result) + "\n")
+            state_file.flush()
+
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            pending = set()
+            for build in builds:
+                if build.storage != "local" or build.id in results:
+                    continue
+                if not build.path:
+                    record(
+                        {"build_id": build.id, "path": None, "problems": ["no path"]}
+                    )
+                    continue
+                future = pool.submit(
+                    verify_build_file,
+                    os.path.join(data_path, build.path),
+                    build.md5,
+                    build.size,
+                    build.signed,
+                    rate,
+                )
+                future.build = build
+                pending.add(future)
+                # bound the queued work so large repositories do not pile up
+                if len(pending) >= jobs * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(_verify_result(future))
+            for future in as_completed(pending):
+                record(_verify_result(future))
+    finally:
+        if state_file is not None:
+            state_file.close()
+
+    failures = [r for r in results.values() if r["problems"]]
+    orphans = _find_orphans(data_path, paths)
+    report = {
+        "verified": len(results),
+        "failed": len(failures),
+        "skipped": len(skipped),
+        "orphaned": len(orphans),
+        "failures": sorted(failures, key=lambda r: r["build_id"]),
+        "orphans": orphans,
+    }
+    json.dump(report, output, indent=2)
+    output.write("\n")
+    if failures or orphans:
+        ctx.exit(1)
+
+
+def _verify_result(future):
+    build = future.build
+    try:
+        problems = future.result()
+    except Exception as e:
+        problems = [f"error: {e}"]
+    return {"build_id": build.id, "path": build.path, "problems": problems}
@@ -12,9 +12,16 @@ SUBDOMAIN_MATCHING = False
 # Application
 DATA_PATH = os.path.realpath("data")
 TEMPLATE_PATH = None
+API_BULK_PARSE_WORKERS = 4  # SPKs parsed concurrently by the bulk upload API
+API_BULK_MAX_CONTENT_LENGTH = 1024 * 1024 * 1024  # whole bulk upload request
+UPLOAD_SESSION_TIMEOUT = 86400  # idle chunked upload sessions are removed after
 GNUPG_TIMESTAMP_URL = "http://timestamp.synology.com/timestamp.php"
 GNUPG_PATH = None
 GNUPG_FINGERPRINT = "gnupg-fingerprint"
+GNUPG_SIGNING_WORKERS = 4  # concurrent signatures in a batch signing task
+GNUPG_TIMESTAMP_RETRIES = 3
+GNUPG_TIMESTAMP_BACKOFF = 1.0  # seconds, doubled on each retry
+SPK_METADATA_CACHE_TIMEOUT = 7 * 86400  # parsed SPK metadata, keyed by file stat
 
 # Object Storage — Logs (S3-compatible)
 OBJECT_STORAGE_LOGS_ENDPOINT = "https://us-east.object.fastlystorage.app"
@@ -30,10 +37,27 @@ OBJECT_STORAGE_PACKAGES_REGION = None
 OBJECT_STORAGE_PACKAGES_BUCKET = None
 OBJECT_STORAGE_PACKAGES_ACCESS_KEY = None
 OBJECT_STORAGE_PACKAGES_SECRET_KEY = None
+OBJECT_STORAGE_PACKAGES_MAX_POOL_CONNECTIONS = 64  # per process, shared by threads
+OBJECT_STORAGE_MULTIPART_THRESHOLD = 16 * 1024 * 1024  # larger files go in parts
+OBJECT_STORAGE_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+OBJECT_STORAGE_MAX_CONCURRENCY = 10  # parts transferred at once, per transfer
+OBJECT_STORAGE_UPLOAD_WORKERS = 4  # builds uploaded at once by a batch upload
+UPLOAD_DIRECT_TO_STORAGE = False  # API uploads go straight to Object Storage
+REMOTE_CACHE_PATH = None  # local copies of remote builds served by nas.data
+REMOTE_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024  # bytes, least recently used evicted
+REMOTE_PRESIGNED_URL_EXPIRES = 900  # seconds, without PACKAGES_CDN_HOST
+REMOTE_REDIRECT_MAX_AGE = 3600  # seconds redirects to remote builds are cacheable
+DATA_MAX_AGE = 3600  # seconds SPKs and icons are cacheable before revalidation
+DATA_ACCEL_REDIRECT = None  # nginx internal location of DATA_PATH, e.g. "/_data"
+REMOTE_CACHE_ACCEL_REDIRECT = None  # nginx internal location of REMOTE_CACHE_PATH
 
 # CDN
 CDN_PURGE_TOKEN = None
 PACKAGES_CDN_HOST = None
+CDN_API_URL = "https://api.fastly.com"
+CDN_SERVICE_ID = None  # required to purge surrogate keys, such as the catalog
+CDN_PURGE_BATCH_SIZE = 256  # surrogate keys purged per API call
+CDN_PURGE_RETRIES = 5
 
 # Security
 SECURITY_CACHE_CONTROL = {}
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Hashing of SPK files and streams.
+
+Files are hashed through a read-only memory map and streams through a single
+reusable buffer, feeding several digests in one pass. :mod:`hashlib` releases
+the GIL while hashing these large chunks, so files hashed from different
+threads are hashed concurrently.
+"""
+
+import hashlib
+import mmap
+import os
+
+#: Size of the chunks fed to the digests
+CHUNK_SIZE = 1024 * 1024
+
+
+def update_from_stream(hashes, stream):
+    """Feed the rest of `stream` to each of `hashes`.
+
+    :param hashes: :mod:`hashlib` hash objects
+    :param stream: binary stream, read from its current position to the end
+    :returns: number of bytes read
+    """
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    size = 0
+    while True:
+        length = stream.readinto(buffer)
+        if not length:
+            break
+        for h in hashes:
+            h.update(view[:length])
+        size += length
+    return size
+
+
+def hash_stream(stream, algorithms=("md5",)):
+    """Hash the rest of `stream` in a single pass.
+
+    :param stream: binary stream, read from its current position to the end
+    :param algorithms: names of the :mod:`hashlib` algorithms to compute
+    :returns: a tuple of a dict of hex digests by algorithm and the number of
+              bytes read
+    """
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    size = update_from_stream(hashes, stream)
+    return {a: h.hexdigest() for a, h in zip(algorithms, hashes)}, size
+
+
+def hash_file(path, algorithms=("md5",)):
+    """Hash the file at `path` in a single pass through a memory map.
+
+    :param path: path of the file
+    :param algorithms: names of the :mod:`hashlib` algorithms to compute
+    :returns: a tuple of a dict of hex digests by algorithm and the size of the
+              file
+    """
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, size, CHUNK_SIZE):
+                        chunk = view[offset : offset + CHUNK_SIZE]
+                        for h in hashes:
+                            h.update(chunk)
+                        chunk.release()
+    return {a: h.hexdigest() for a, h in zip(algorithms, hashes)}, size
+
+
+class HashingReader(object):
+    """Read-only, forward-only wrapper of a binary stream hashing whatever is
+    read through it, so a stream can be hashed while it is consumed by another
+    reader such as an upload.
+
+    :param stream: binary stream, read from its current position
+    :param algorithms: names of the :mod:`hashlib` algorithms to compute
+    """
+
+    def __init__(self, stream, algorithms=("md5",)):
+        self.stream = stream
+        self.algorithms = algorithms
+        self.hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+        #: Number of bytes read so far
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        for h in self.hashes:
+            h.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigests(self):
+        """Return a dict of hex digests by algorithm of the bytes read so far."""
+        return {a: h.hexdigest() for a, h in zip(self.algorithms, self.hashes)}
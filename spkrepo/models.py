@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
-import hashlib
 import io
+import json
 import os
 import shutil
+import tarfile
 from datetime import datetime, timezone
 
 from flask import current_app
@@ -10,11 +11,12 @@ from flask_security import RoleMixin, SQLAlchemyUserDatastore, UserMixin
 from sqlalchemy import event, select
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.sql.expression import FunctionElement
 
 from .ext import db
+from .hashing import hash_file
 
 user_role = db.Table(
     "user_role",
@@ -64,6 +66,26 @@ def _utcnow():
     return datetime.now(timezone.utc)
 
 
+def read_member_index(file_path=None, fileobj=None):
+    """Return the offset and size of every member of the tar archive at
+    `file_path`, or in the seekable `fileobj`, read from its tar headers.
+
+    The index is a dict with the ``size`` of the archive it describes and its
+    ``members``, mapping each name to a ``[offset, size]`` pair of its data, so
+    members can later be read without walking the archive.
+    """
+    if fileobj is None:
+        with tarfile.open(file_path, mode="r:") as archive:
+            members = {m.name: [m.offset_data, m.size] for m in archive.getmembers()}
+        return {"size": os.path.getsize(file_path), "members": members}
+    fileobj.seek(0)
+    with tarfile.open(fileobj=fileobj, mode="r:") as archive:
+        members = {m.name: [m.offset_data, m.size] for m in archive.getmembers()}
+    size = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(0)
+    return {"size": size, "members": members}
+
+
 class User(db.Model, UserMixin):
     """A registered user, including authentication credentials and their
     authored/maintained package relationships."""
@@ -491,6 +513,9 @@ build_architecture = db.Table(
     db.Column(
         "architecture_id", db.Integer(), db.ForeignKey("architecture.id"), index=True
     ),
+    db.Index(
+        "ix_build_architecture_architecture_id_build_id", "architecture_id", "build_id"
+    ),
 )
 
 
@@ -510,9 +535,11 @@ class Build(db.Model):
     publisher_user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     checksum = db.Column(db.Unicode(32))
     changelog = db.Column(db.UnicodeText)
-    path = db.Column(db.Unicode(2048))
+    path = db.Column(db.Unicode(2048), index=True)
     md5 = db.Column(db.Unicode(32))
     size = db.Column(db.Integer)
+    upload_digest = db.Column(db.Unicode(64), index=True)
+    member_index = db.Column(db.JSON)
     storage = db.Column(
         db.Enum("local", "remote", name="storage_location"),
         default="local",
@@ -561,6 +588,54 @@ class Build(db.Model):
         cascade="all, delete-orphan",
         collection_class=attribute_mapped_collection("language.code"),
     )
+    sidecar = db.relationship(
+        "BuildSidecar",
+        back_populates="build",
+        cascade="all, delete-orphan",
+        uselist=False,
+    )
+
+    @classmethod
+    def conflicting_architectures(
+        cls, version_id, architectures, firmware_min, firmware_max=None
+    ):
+        """Return the sorted codes of the `architectures` already covered by a
+        build of the version over an overlapping firmware range.
+
+        The overlap is computed by the database from ``build_architecture``
+        and the firmware build numbers, without loading the builds. A build
+        without maximum firmware covers its minimum firmware only.
+        """
+        min_build = firmware_min.build
+        max_build = firmware_max.build if firmware_max is not None else min_build
+        existing_min = aliased(Firmware)
+        existing_max = aliased(Firmware)
+        return (
+            db.session.execute(
+                select(Architecture.code)
+                .distinct()
+                .select_from(build_architecture)
+                .join(cls, cls.id == build_architecture.c.build_id)
+                .join(
+                    Architecture,
+                    Architecture.id == build_architecture.c.architecture_id,
+                )
+                .join(existing_min, existing_min.id == cls.firmware_min_id)
+                .outerjoin(existing_max, existing_max.id == cls.firmware_max_id)
+                .filter(
+                    cls.version_id == version_id,
+                    build_architecture.c.architecture_id.in_(
+                        [a.id for a in architectures]
+                    ),
+                    existing_min.build <= max_build,
+                    db.func.coalesce(existing_max.build, existing_min.build)
+                    >= min_build,
+                )
+                .order_by(Architecture.code)
+            )
+            .scalars()
+            .all()
+        )
 
     @classmethod
     def generate_filename(cls, package, version, firmware, architectures):
@@ -584,18 +659,14 @@ class Build(db.Model):
             f.write(stream.read())
 
     def calculate_md5(self):
-        """Compute and return this build's file's MD5 checksum by reading
-        it from disk in chunks."""
+        """Compute and return this build's file's MD5 checksum, read from
+        disk."""
         if not self.path:
             raise ValueError("Path cannot be empty.")
         file_path = os.path.join(current_app.config["DATA_PATH"], self.path)
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found at path: {file_path}")
-        with io.open(file_path, "rb") as f:
-            md5_hash = hashlib.md5()
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-            return md5_hash.hexdigest()
+        return hash_file(file_path)[0]["md5"]
 
     def calculate_size(self):
         """Return this build's file size in bytes, read from disk."""
@@ -606,10 +677,36 @@ class Build(db.Model):
             raise FileNotFoundError(f"File not found at path: {file_path}")
         return os.path.getsize(file_path)
 
+    def calculate_member_index(self):
+        """Compute and return the member index of this build's archive, read
+        from disk. See :func:`read_member_index`."""
+        if not self.path:
+            raise ValueError("Path cannot be empty.")
+        file_path = os.path.join(current_app.config["DATA_PATH"], self.path)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File not found at path: {file_path}")
+        return read_member_index(file_path)
+
+    def load_sidecar(self):
+        """Return the sidecar of this build as a dict, None if it has none.
+
+        Sidecars of remote builds uploaded before they were stored in the
+        ``build_sidecar`` table are read from their ``<path>.json`` file, see
+        :func:`read_sidecar_file`.
+        """
+        if self.sidecar is not None:
+            return self.sidecar.to_dict()
+        if self.storage != "remote" or not self.path:
+            return None
+        return read_sidecar_file(self.path)
+
     def _before_insert(self):
         self._insert_path = os.path.join(current_app.config["DATA_PATH"], self.path)
 
     def _after_insert(self):
+        # builds uploaded straight to Object Storage have no local file
+        if self.storage == "remote":
+            return
         if not os.path.exists(self._insert_path):
             raise FileNotFoundError(
                 f"Expected file not found after insert: {self._insert_path}"
@@ -738,6 +835,58 @@ Firmware.recent_target_download_count = db.column_property(
 )
 
 
+def read_sidecar_file(path):
+    """Read the legacy sidecar file of the build at `path`.
+
+    :param path: path of the build, relative to ``DATA_PATH``
+    :returns: the sidecar as a dict, None if the build has no sidecar file
+    """
+    sidecar_path = os.path.join(current_app.config["DATA_PATH"], path + ".json")
+    try:
+        with io.open(sidecar_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class BuildSidecar(db.Model):
+    """Metadata of a build stored in Object Storage, read from its SPK before
+    the upload so the build can be resynced without fetching the archive."""
+
+    __tablename__ = "build_sidecar"
+
+    # Columns
+    build_id = db.Column(
+        db.Integer, db.ForeignKey("build.id", ondelete="CASCADE"), primary_key=True
+    )
+    info = db.Column(db.JSON, nullable=False)
+    derived = db.Column(db.JSON, nullable=False)
+    calculated = db.Column(db.JSON, nullable=False)
+
+    # Relationships
+    build = db.relationship("Build", back_populates="sidecar")
+
+    @classmethod
+    def from_dict(cls, sidecar):
+        """Create a sidecar from its dict, as made by
+        :func:`~spkrepo.views.tasks.make_sidecar`."""
+        return cls(
+            info=sidecar["info"],
+            derived=sidecar["derived"],
+            calculated=sidecar["calculated"],
+        )
+
+    def to_dict(self):
+        return {
+            "info": self.info,
+            "derived": self.derived,
+            "calculated": self.calculated,
+        }
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} build_id={self.build_id}>"
+
+
 class BuildManifest(db.Model):
     """A build's install-time dependency/conflict/permission manifest,
     parsed from its SPK INFO/conf files."""
@@ -814,6 +963,20 @@ class Version(db.Model):
     # Constraints
     __table_args__ = (db.UniqueConstraint(package_id, version),)
 
+    @classmethod
+    def find(cls, package, version):
+        """Look up a version of a package by its version number, or return None
+        if not found. Other versions of the package are not loaded."""
+        if package.id is None:
+            return None
+        return (
+            db.session.execute(
+                select(cls).filter(cls.package_id == package.id, cls.version == version)
+            )
+            .scalars()
+            .first()
+        )
+
     @hybrid_property
     def beta(self):
         """True if this version has a report_url set, marking it as a
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""In-process registry of reference data.
+
+Architectures, languages, firmware and services are small tables that are read
+on every upload, resync and log ingestion. They are loaded once per process and
+looked up in memory. A token stored in the cache identifies the current
+revision of the data: it is replaced whenever one of these tables is changed
+through the ORM, and each process reloads its copy when it sees a new token.
+The token is checked once per application context.
+
+Lookups return instances merged into the current session, without a query.
+"""
+
+import threading
+import uuid
+
+from flask import g
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from .ext import cache, db
+from .models import Architecture, Firmware, Language, Service
+
+#: Cache key of the current revision token
+TOKEN_CACHE_KEY = "reference_data:token"
+
+_state = {"token": None, "data": None}
+_lock = threading.Lock()
+
+
+def _load():
+    with Session(db.engine) as session:
+        return {
+            "architecture": {
+                a.code: a for a in session.execute(select(Architecture)).scalars()
+            },
+            "firmware": {
+                f.build: f for f in session.execute(select(Firmware)).scalars()
+            },
+            "language": {
+                lang.code: lang for lang in session.execute(select(Language)).scalars()
+            },
+            "service": {s.code: s for s in session.execute(select(Service)).scalars()},
+        }
+
+
+def _data():
+    token = g.get("reference_data_token")
+    if token is None:
+        token = cache.get(TOKEN_CACHE_KEY)
+        if token is None:
+            token = uuid.uuid4().hex
+            cache.set(TOKEN_CACHE_KEY, token, timeout=0)
+        g.reference_data_token = token
+    with _lock:
+        if _state["token"] != token:
+            _state["data"] = _load()
+            _state["token"] = token
+        return _state["data"]
+
+
+def _get(kind, key, session):
+    instance = _data()[kind].get(key)
+    if instance is None:
+        return None
+    return (session or db.session).merge(instance, load=False)
+
+
+def architecture(code, syno=False, session=None):
+    """Return the :class:`~spkrepo.models.Architecture` with the given code, or
+    None if not found. If `syno` is True, the code is first translated from its
+    Synology spelling.
+
+    :param session: session to merge the instance into, defaults to
+                    ``db.session``
+    """
+    if syno:
+        code = Architecture.from_syno.get(code, code)
+    return _get("architecture", code, session)
+
+
+def firmware(build, session=None):
+    """Return the :class:`~spkrepo.models.Firmware` with the given build
+    number, or None if not found."""
+    return _get("firmware", build, session)
+
+
+def language(code, session=None):
+    """Return the :class:`~spkrepo.models.Language` with the given code, or
+    None if not found."""
+    return _get("language", code, session)
+
+
+def service(code, session=None):
+    """Return the :class:`~spkrepo.models.Service` with the given code, or None
+    if not found."""
+    return _get("service", code, session)
+
+
+def invalidate():
+    """Drop the loaded reference data in every process."""
+    token = uuid.uuid4().hex
+    cache.set(TOKEN_CACHE_KEY, token, timeout=0)
+    with _lock:
+        _state["token"] = None
+        _state["data"] = None
+    g.reference_data_token = token
+
+
+def invalidate_on_commit(session):
+    """Drop the loaded reference data once `session` commits, for changes that
+    do not go through the ORM events, such as bulk inserts."""
+    if session.info.get("reference_data_changed"):
+        return
+    session.info["reference_data_changed"] = True
+
+    @event.listens_for(session, "after_commit", once=True)
+    def on_commit(session):
+        session.info.pop("reference_data_changed", None)
+        invalidate()
+
+
+def _on_change(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        invalidate_on_commit(session)
+
+
+for _model in [Architecture, Firmware, Language, Service]:
+    for _event in ["after_insert", "after_update", "after_delete"]:
+        event.listen(_model, _event, _on_change)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Read-through disk cache of builds stored in Object Storage.
+
+Builds are fetched on the first request and kept under ``REMOTE_CACHE_PATH``,
+named after their md5 so a replaced build is never served from a stale copy.
+Concurrent requests for the same build, from any thread or process, wait on a
+lock file and share a single download. Downloads land in a temporary file that
+is verified and renamed into place, so a partial file is never served. The
+least recently served builds are evicted once the cache grows over
+``REMOTE_CACHE_MAX_SIZE``.
+"""
+
+import fcntl
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+from . import storage
+from .hashing import hash_file
+
+logger = logging.getLogger(__name__)
+
+#: Suffix of the files being downloaded
+PART_SUFFIX = ".part"
+
+#: Age in seconds after which a leftover download is removed
+PART_MAX_AGE = 86400
+
+
+def cache_configured():
+    """Return True if remote builds can be cached locally."""
+    return bool(current_app.config["REMOTE_CACHE_PATH"]) and (
+        storage.storage_configured()
+    )
+
+
+def _cache_root():
+    return current_app.config["REMOTE_CACHE_PATH"]
+
+
+def _touch(path):
+    """Mark a cached build as recently used, return False if it is missing."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+@contextmanager
+def _locked(path, blocking=True):
+    """Hold an exclusive lock on the file at `path`, created if missing.
+
+    :returns: whether the lock was acquired, always True when `blocking`
+    """
+    with open(path, "ab") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fetch(object_key, md5, size):
+    """Return the path of the cached copy of a remote build, downloading it
+    first on a miss.
+
+    :param object_key: key of the build in the packages bucket
+    :param md5: md5 of the build, checked after the download
+    :param size: size of the build, checked after the download
+    :returns: the path of the cached build, None if it could not be fetched
+    """
+    root = _cache_root()
+    path = os.path.join(root, md5 + ".spk")
+    if _touch(path):
+        return path
+
+    os.makedirs(root, exist_ok=True)
+    lock_path = path + ".lock"
+    with _locked(lock_path):
+        # fetched by another request while waiting for the lock
+        if _touch(path):
+            return path
+        fd, part_path = tempfile.mkstemp(dir=root, prefix=".", suffix=PART_SUFFIX)
+        os.close(fd)
+        try:
+            if not storage.download(object_key, part_path):
+                return None
+            digests, part_size = hash_file(part_path)
+            if part_size != size or digests["md5"] != md5:
+                logger.warning(
+                    "Discarded download of %s: expected %s (%d bytes), got %s"
+                    " (%d bytes)",
+                    object_key,
+                    md5,
+                    size,
+                    digests["md5"],
+                    part_size,
+                )
+                return None
+            os.replace(part_path, path)
+        finally:
+            try:
+                os.remove(part_path)
+            except FileNotFoundError:
+                pass
+            # waiters find the build in place once they get the lock
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    evict(keep=path)
+    return path
+
+
+def evict(keep=None):
+    """Remove the least recently used builds until the cache fits in
+    ``REMOTE_CACHE_MAX_SIZE``, along with leftover downloads. Skipped if another
+    eviction is running.
+
+    :param keep: path of a build never to evict, such as the one just fetched
+    """
+    root = _cache_root()
+    with _locked(os.path.join(root, ".evict.lock"), blocking=False) as acquired:
+        if not acquired:
+            return
+        now = time.time()
+        builds, total = [], 0
+        with os.scandir(root) as entries:
+            for entry in entries:
+                # Downloads may complete or be evicted by other processes while
+                # the cache is scanned
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if entry.name.endswith(PART_SUFFIX):
+                        if now - stat.st_mtime > PART_MAX_AGE:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".spk"):
+                    builds.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        max_size = current_app.config["REMOTE_CACHE_MAX_SIZE"]
+        for _, size, path in sorted(builds):
+            if total <= max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info("Evicted %s from the remote build cache", path)
@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import io
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
 
 import boto3
 import requests
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
-from flask import current_app
+from flask import current_app, g
+
+from .hashing import CHUNK_SIZE, update_from_stream
 
 logger = logging.getLogger(__name__)
 
@@ -24,60 +33,393 @@ def storage_configured():
     )
 
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _reset_clients():
+    """Drop the clients inherited from the parent process, their pooled
+    connections are shared with it."""
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
 def _client():
-    """Return a boto3 S3 client for the packages bucket."""
-    config = Config(
-        request_checksum_calculation="when_required",
+    """Return the boto3 S3 client for the packages bucket.
+
+    A single client is created per process and configuration, and reused by
+    every call and thread, so connections to the endpoint are kept alive and
+    pooled. Clients are dropped in forked processes, such as gunicorn or
+    Celery workers.
+    """
+    config = current_app.config
+    key = (
+        config["OBJECT_STORAGE_PACKAGES_ENDPOINT"],
+        config["OBJECT_STORAGE_PACKAGES_REGION"],
+        config["OBJECT_STORAGE_PACKAGES_ACCESS_KEY"],
+        config["OBJECT_STORAGE_PACKAGES_SECRET_KEY"],
+        config["OBJECT_STORAGE_PACKAGES_MAX_POOL_CONNECTIONS"],
     )
-    return boto3.client(
-        "s3",
-        config=config,
-        endpoint_url=current_app.config["OBJECT_STORAGE_PACKAGES_ENDPOINT"],
-        aws_access_key_id=current_app.config["OBJECT_STORAGE_PACKAGES_ACCESS_KEY"],
-        aws_secret_access_key=current_app.config["OBJECT_STORAGE_PACKAGES_SECRET_KEY"],
-        region_name=current_app.config["OBJECT_STORAGE_PACKAGES_REGION"],
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            endpoint, region, access_key, secret_key, max_pool_connections = key
+            # sessions are not thread-safe, clients are
+            client = boto3.session.Session().client(
+                "s3",
+                config=Config(
+                    request_checksum_calculation="when_required",
+                    max_pool_connections=max_pool_connections,
+                    tcp_keepalive=True,
+                ),
+                endpoint_url=endpoint,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                region_name=region,
+            )
+            _clients[key] = client
+    return client
+
+
+class RangeReader(io.RawIOBase):
+    """Read-only, seekable file over an object of the packages bucket.
+
+    Only the blocks that are read are fetched, with HTTP Range requests, and
+    the most recent ones are kept so that going back and forth between tar
+    headers and small members does not fetch them again. Parsing the metadata
+    of an archive therefore does not download its large members.
+
+    :param object_key: key of the object in the packages bucket
+    :param block_size: size of the fetched blocks
+    :param max_blocks: number of blocks kept in memory
+    :raises botocore.exceptions.ClientError: if the object cannot be read
+    """
+
+    def __init__(self, object_key, block_size=8 * 1024, max_blocks=256):
+        super().__init__()
+        self.object_key = object_key
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self._client = _client()
+        self._bucket = current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"]
+        head = self._client.head_object(Bucket=self._bucket, Key=object_key)
+        #: Size of the object
+        self.size = head["ContentLength"]
+        #: ETag of the object, changes when it is replaced
+        self.etag = head.get("ETag", "").strip('"')
+        #: Number of bytes fetched so far
+        self.bytes_fetched = 0
+        self._position = 0
+        self._blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def _fetch(self, first, last):
+        """Fetch blocks `first` to `last` in a single request."""
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size) - 1
+        response = self._client.get_object(
+            Bucket=self._bucket, Key=self.object_key, Range=f"bytes={start}-{end}"
+        )
+        data = response["Body"].read()
+        self.bytes_fetched += len(data)
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            self._blocks[index] = data[offset : offset + self.block_size]
+        while len(self._blocks) > max(self.max_blocks, last - first + 1):
+            self._blocks.popitem(last=False)
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self._position)
+        if length <= 0:
+            return 0
+        first = self._position // self.block_size
+        last = (self._position + length - 1) // self.block_size
+        missing = [i for i in range(first, last + 1) if i not in self._blocks]
+        if missing:
+            self._fetch(missing[0], missing[-1])
+        data = b"".join(self._blocks[i] for i in range(first, last + 1))
+        for index in range(first, last + 1):
+            self._blocks.move_to_end(index)
+        offset = self._position - first * self.block_size
+        b[:length] = data[offset : offset + length]
+        self._position += length
+        return length
+
+
+def _transfer_config():
+    """Return the multipart settings of uploads and downloads."""
+    config = current_app.config
+    return TransferConfig(
+        multipart_threshold=config["OBJECT_STORAGE_MULTIPART_THRESHOLD"],
+        multipart_chunksize=config["OBJECT_STORAGE_MULTIPART_CHUNKSIZE"],
+        max_concurrency=config["OBJECT_STORAGE_MAX_CONCURRENCY"],
     )
 
 
-def upload(local_path, object_key):
-    """Upload a local file to Object Storage. Returns True on success."""
+class TransferProgress(object):
+    """Transfer callback tracking the bytes transferred and the throughput.
+
+    boto3 calls it from its transfer threads with the number of bytes of each
+    completed part.
+
+    :param total: size of the transfer in bytes
+    :param report: optional callable receiving the bytes transferred, the total
+                   and the throughput in bytes per second, at most once per
+                   `interval` seconds and once at the end
+    :param interval: minimum number of seconds between two reports
+    """
+
+    def __init__(self, total, report=None, interval=1.0):
+        self.total = total
+        self.report = report
+        self.interval = interval
+        self.done = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        """Average throughput so far, in bytes per second."""
+        return self.done / max(self.elapsed, 1e-6)
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.done += bytes_amount
+            now = time.monotonic()
+            if self.report is None or (
+                self.done < self.total and now - self._reported < self.interval
+            ):
+                return
+            self._reported = now
+            self.report(self.done, self.total, self.rate)
+
+
+def upload(local_path, object_key, progress=None):
+    """Upload a local file to Object Storage. Returns True on success.
+
+    Large files are uploaded in parts, several at a time, as configured by
+    ``OBJECT_STORAGE_MULTIPART_*`` and ``OBJECT_STORAGE_MAX_CONCURRENCY``.
+
+    :param progress: optional progress report callable, see
+                     :class:`TransferProgress`
+    """
     if not storage_configured():
         logger.warning("Object Storage not configured — upload skipped")
         return False
     try:
         s3 = _client()
+        callback = TransferProgress(os.path.getsize(local_path), progress)
         s3.upload_file(
             local_path,
             current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"],
             object_key,
+            Callback=callback,
+            Config=_transfer_config(),
+        )
+        logger.info(
+            "Uploaded %s to object storage (%d bytes in %.1fs, %.1f MB/s)",
+            object_key,
+            callback.done,
+            callback.elapsed,
+            callback.rate / 1024 / 1024,
         )
-        logger.info("Uploaded %s to object storage", object_key)
         return True
     except (BotoCoreError, ClientError) as e:
         logger.error("Failed to upload %s: %s", object_key, e)
         return False
 
 
-def download(object_key, local_path):
-    """Download a file from Object Storage to a local path. Returns True on success."""
+def upload_stream(stream, object_key, total=0, progress=None):
+    """Upload a binary stream to Object Storage. Returns True on success.
+
+    The stream is read once, from its current position and in order, so it can
+    be wrapped to hash it on the way. Large streams are uploaded in parts like
+    with :func:`upload`.
+
+    :param total: size of the stream, for progress reports
+    :param progress: optional progress report callable, see
+                     :class:`TransferProgress`
+    """
+    if not storage_configured():
+        logger.warning("Object Storage not configured — upload skipped")
+        return False
+    try:
+        s3 = _client()
+        callback = TransferProgress(total, progress)
+        s3.upload_fileobj(
+            stream,
+            current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"],
+            object_key,
+            Callback=callback,
+            Config=_transfer_config(),
+        )
+        logger.info(
+            "Uploaded %s to object storage (%d bytes in %.1fs, %.1f MB/s)",
+            object_key,
+            callback.done,
+            callback.elapsed,
+            callback.rate / 1024 / 1024,
+        )
+        return True
+    except (BotoCoreError, ClientError) as e:
+        logger.error("Failed to upload %s: %s", object_key, e)
+        return False
+
+
+def download(object_key, local_path, progress=None):
+    """Download a file from Object Storage to a local path. Returns True on success.
+
+    Large files are downloaded in parts, several at a time, as configured by
+    ``OBJECT_STORAGE_MULTIPART_*`` and ``OBJECT_STORAGE_MAX_CONCURRENCY``.
+
+    :param progress: optional progress report callable, see
+                     :class:`TransferProgress`
+    """
     if not storage_configured():
         logger.warning("Object Storage not configured — download skipped")
         return False
     try:
         s3 = _client()
+        bucket = current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"]
+        total = 0
+        if progress is not None:
+            total = s3.head_object(Bucket=bucket, Key=object_key)["ContentLength"]
+        callback = TransferProgress(total, progress)
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         s3.download_file(
-            current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"],
+            bucket,
             object_key,
             local_path,
+            Callback=callback,
+            Config=_transfer_config(),
+        )
+        logger.info(
+            "Downloaded %s to %s (%d bytes in %.1fs, %.1f MB/s)",
+            object_key,
+            local_path,
+            callback.done,
+            callback.elapsed,
+            callback.rate / 1024 / 1024,
         )
-        logger.info("Downloaded %s to %s", object_key, local_path)
         return True
     except (BotoCoreError, ClientError) as e:
         logger.error("Failed to download %s: %s", object_key, e)
         return False
 
 
+def resume_download(object_key, part_path, progress=None):
+    """Download a file from Object Storage to `part_path`, resuming an
+    interrupted download.
+
+    The object is read in order with HTTP Range requests of
+    ``OBJECT_STORAGE_MULTIPART_CHUNKSIZE`` bytes, each appended to `part_path`
+    and hashed as it arrives. The bytes already in `part_path` are hashed
+    without being downloaded again, so a failed download picks up where it
+    stopped.
+
+    :param progress: optional progress report callable, see
+                     :class:`TransferProgress`
+    :returns: a tuple of the md5 hex digest and the size of the complete file,
+              None on failure
+    """
+    if not storage_configured():
+        logger.warning("Object Storage not configured — download skipped")
+        return None
+    try:
+        s3 = _client()
+        bucket = current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"]
+        part_size = current_app.config["OBJECT_STORAGE_MULTIPART_CHUNKSIZE"]
+        total = s3.head_object(Bucket=bucket, Key=object_key)["ContentLength"]
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        md5 = hashlib.md5()
+        with io.open(part_path, "ab+") as f:
+            f.seek(0)
+            resumed = update_from_stream([md5], f)
+            if resumed > total:
+                f.truncate(0)
+                md5 = hashlib.md5()
+                resumed = 0
+            callback = TransferProgress(total, progress)
+            callback.done = offset = resumed
+            while offset < total:
+                end = min(offset + part_size, total) - 1
+                body = s3.get_object(
+                    Bucket=bucket, Key=object_key, Range=f"bytes={offset}-{end}"
+                )["Body"]
+                received = 0
+                for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    received += len(chunk)
+                    callback(len(chunk))
+                if not received:
+                    logger.error("Empty range read from %s at %d", object_key, offset)
+                    return None
+                offset += received
+        logger.info(
+            "Downloaded %s to %s (%d bytes in %.1fs, %d resumed)",
+            object_key,
+            part_path,
+            offset - resumed,
+            callback.elapsed,
+            resumed,
+        )
+        return md5.hexdigest(), offset
+    except (BotoCoreError, ClientError) as e:
+        logger.error("Failed to download %s: %s", object_key, e)
+        return None
+
+
+def presigned_url(object_key, expires):
+    """Return a URL to download an object of the packages bucket without
+    credentials, valid for `expires` seconds. None if it cannot be signed."""
+    if not storage_configured():
+        logger.warning("Object Storage not configured — presigned URL skipped")
+        return None
+    try:
+        return _client().generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": current_app.config["OBJECT_STORAGE_PACKAGES_BUCKET"],
+                "Key": object_key,
+            },
+            ExpiresIn=expires,
+        )
+    except (BotoCoreError, ClientError) as e:
+        logger.error("Failed to presign %s: %s", object_key, e)
+        return None
+
+
 def delete(object_key):
     """Delete a file from Object Storage. Returns True on success."""
     if not storage_configured():
@@ -96,16 +438,110 @@ def delete(object_key):
         return False
 
 
-def purge_cdn(url_path):
-    """Issue a CDN purge for the given URL path. Logs and skips if not configured."""
-    token = current_app.config.get("CDN_PURGE_TOKEN")
-    host = current_app.config.get("PACKAGES_CDN_HOST")
-    if not token or not host:
-        logger.info("CDN purge skipped (not configured): %s", url_path)
+def cdn_configured():
+    """Return True if CDN purges are configured."""
+    config = current_app.config
+    return bool(config.get("CDN_PURGE_TOKEN") and config.get("PACKAGES_CDN_HOST"))
+
+
+def purge_cdn(*url_paths, keys=()):
+    """Queue a CDN purge of the given URL paths and surrogate keys.
+
+    Purges are collected for the lifetime of the application context, that is
+    the current request or task, and flushed together when it ends, see
+    :func:`pending_purges`. Logs and skips if not configured.
+
+    :param keys: surrogate keys to purge, such as
+                 :data:`~spkrepo.views.nas.CATALOG_SURROGATE_KEY`
+    """
+    if not cdn_configured():
+        logger.info(
+            "CDN purge skipped (not configured): %s", ", ".join((*url_paths, *keys))
+        )
         return
-    url = f"https://{host}{url_path}"
-    try:
-        requests.request("PURGE", url, headers={"Fastly-Key": token}, timeout=10)
-        logger.info("CDN purge issued: %s", url)
-    except requests.RequestException as e:
-        logger.warning("CDN purge failed for %s: %s", url, e)
+    pending = g.setdefault("cdn_purges", ({}, {}))
+    pending[0].update(dict.fromkeys(url_paths))
+    pending[1].update(dict.fromkeys(keys))
+
+
+def data_surrogate_key(path):
+    """Return the surrogate key of the ``nas.data`` responses serving the data
+    file at `path`, relative to ``DATA_PATH``."""
+    return "data/" + quote(path)
+
+
+def purge_data_files(*paths):
+    """Queue a CDN purge of data files rewritten in place, such as a signed SPK
+    or the icons of a resynced version, through their
+    :func:`data_surrogate_key`.
+
+    :param paths: paths of the files, relative to ``DATA_PATH``
+    """
+    purge_cdn(keys=[data_surrogate_key(path) for path in paths])
+
+
+def pending_purges():
+    """Return and forget the purges queued in the current application context.
+
+    :returns: a tuple of the URL paths and of the surrogate keys, deduplicated
+    """
+    paths, keys = g.pop("cdn_purges", ({}, {}))
+    return list(paths), list(keys)
+
+
+def queue_purges(url_paths, keys):
+    """Queue in the current application context the purges taken from another
+    one with :func:`pending_purges`, such as a worker thread or an eagerly run
+    task, so they are flushed once, with the purges of this context.
+    """
+    if url_paths or keys:
+        purge_cdn(*url_paths, keys=keys)
+
+
+def send_purges(url_paths, keys):
+    """Purge URL paths and surrogate keys through the CDN API, over a single
+    connection. Surrogate keys are purged in batches of
+    ``CDN_PURGE_BATCH_SIZE``.
+
+    :returns: a tuple of the URL paths and of the surrogate keys that could not
+              be purged
+    """
+    config = current_app.config
+    api_url = config["CDN_API_URL"].rstrip("/")
+    host = config["PACKAGES_CDN_HOST"]
+    headers = {"Fastly-Key": config["CDN_PURGE_TOKEN"]}
+    failed_paths, failed_keys = [], []
+
+    def post(url, **kwargs):
+        try:
+            response = session.post(url, timeout=10, **kwargs)
+            response.raise_for_status()
+            return True
+        except requests.RequestException as e:
+            logger.warning("CDN purge failed for %s: %s", url, e)
+            return False
+
+    with requests.Session() as session:
+        session.headers.update(headers)
+        for url_path in url_paths:
+            if post(f"{api_url}/purge/{host}{url_path}"):
+                logger.info("CDN purge issued: %s%s", host, url_path)
+            else:
+                failed_paths.append(url_path)
+        if keys and not config["CDN_SERVICE_ID"]:
+            logger.warning(
+                "CDN surrogate key purge skipped (no CDN_SERVICE_ID): %s",
+                " ".join(keys),
+            )
+            keys = []
+        batch_size = config["CDN_PURGE_BATCH_SIZE"]
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i : i + batch_size]
+            if post(
+                f"{api_url}/service/{config['CDN_SERVICE_ID']}/purge",
+                headers={"Surrogate-Key": " ".join(batch)},
+            ):
+                logger.info("CDN purge issued for keys: %s", " ".join(batch))
+            else:
+                failed_keys.extend(batch)
+    return failed_paths, failed_keys
@@ -18,6 +18,7 @@ import factory
 import factory.alchemy
 import factory.fuzzy
 import faker
+from botocore.exceptions import ClientError
 from factory.alchemy import SQLAlchemyModelFactory
 from flask import current_app, url_for
 from flask_security import hash_password
@@ -439,6 +440,67 @@ class BaseTestCase(TestCase):
         self.assertEqual(response.headers[header], value, message)
 
 
+#: Packages Object Storage settings for tests using :class:`FakeObjectStorage`
+OBJECT_STORAGE_CONFIG = {
+    "OBJECT_STORAGE_PACKAGES_ENDPOINT": "https://storage.test",
+    "OBJECT_STORAGE_PACKAGES_REGION": "test",
+    "OBJECT_STORAGE_PACKAGES_BUCKET": "packages",
+    "OBJECT_STORAGE_PACKAGES_ACCESS_KEY": "key",
+    "OBJECT_STORAGE_PACKAGES_SECRET_KEY": "secret",
+}
+
+
+class FakeObjectStorage(object):
+    """In-memory stand-in for the S3 client of the packages bucket.
+
+    :param objects: dict of object keys to their content
+    """
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        #: ``(start, end)`` of each ranged read
+        self.ranges = []
+
+    def _get(self, key, operation):
+        if key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, operation)
+        return self.objects[key]
+
+    def head_object(self, Bucket, Key):
+        data = self._get(Key, "HeadObject")
+        return {
+            "ContentLength": len(data),
+            "ETag": f'"{hashlib.md5(data).hexdigest()}"',
+        }
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self._get(Key, "GetObject")
+        if Range is not None:
+            start, end = (int(i) for i in Range[len("bytes=") :].split("-"))
+            self.ranges.append((start, end))
+            data = data[start : end + 1]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def download_file(self, Bucket, Key, Filename, Callback=None, Config=None):
+        data = self._get(Key, "GetObject")
+        with io.open(Filename, "wb") as f:
+            f.write(data)
+        if Callback is not None:
+            Callback(len(data))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Callback=None, Config=None):
+        data = b"".join(iter(lambda: Fileobj.read(Config.multipart_chunksize), b""))
+        self.objects[Key] = data
+        if Callback is not None:
+            Callback(len(data))
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f"https://storage.test/{Params['Key']}?expires={ExpiresIn}"
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
 def create_info(build):
     """
     Create a dict to emulate the INFO file of a SPK.
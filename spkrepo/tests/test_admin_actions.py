@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import io
 import os
-from unittest.mock import patch
+import tarfile
+from unittest.mock import Mock, patch
 
 from flask import current_app, url_for
 
@@ -17,7 +18,13 @@ from spkrepo.tests.common import (
     create_spk,
 )
 from spkrepo.utils import SPK, extract_version_metadata
-from spkrepo.views.tasks import resync_build_file, resync_build_metadata
+from spkrepo.views.admin import _detect_and_fix_signed
+from spkrepo.views.tasks import (
+    resync_build_file,
+    resync_build_metadata,
+    sign_builds,
+    upload_builds,
+)
 
 
 def _run_task_sync(task_func):
@@ -954,6 +961,27 @@ class BuildTestCase(_AdminActionTestMixin, BaseTestCase):
         db.session.expire_all()
         self.assertTrue(db.session.get(Build, build.id).active)
 
+    def test_action_upload_queues_batch_task(self):
+        build1 = BuildFactory(signed=True)
+        build2 = BuildFactory(signed=True)
+        build3 = BuildFactory(signed=True, storage="remote")
+        db.session.commit()
+        with (
+            self.logged_user("package_admin"),
+            patch.object(
+                upload_builds, "delay", return_value=Mock(id="upload-task-id")
+            ) as delay,
+        ):
+            response = self.client.post(
+                url_for("build.action_view"),
+                follow_redirects=True,
+                data=dict(action="03_upload", rowid=[build1.id, build2.id, build3.id]),
+            )
+        self.assert200(response)
+        delay.assert_called_once()
+        self.assertEqual(sorted(delay.call_args.args[0]), [build1.id, build2.id])
+        self.assertIn("Upload of 2 build(s) queued", response.data.decode())
+
     def test_action_sign_requires_admin(self):
         build = BuildFactory()
         db.session.commit()
@@ -964,6 +992,43 @@ class BuildTestCase(_AdminActionTestMixin, BaseTestCase):
             )
         self.assert403(response)
 
+    def test_action_sign_queues_batch_task(self):
+        build1 = BuildFactory(active=False, signed=False)
+        build2 = BuildFactory(active=False, signed=False, storage="remote")
+        db.session.commit()
+        current_app.config["GNUPG_PATH"] = "gnupghome"
+
+        def fake_delay(build_ids):
+            with (
+                patch("spkrepo.utils.gnupg.GPG"),
+                patch(
+                    "spkrepo.utils.Signer.sign", return_value="timestamped signature"
+                ),
+            ):
+                sign_builds(build_ids)
+
+            class FakeResult:
+                id = "fake-task-id"
+
+            return FakeResult()
+
+        with (
+            self.logged_user("package_admin", "admin"),
+            patch.object(sign_builds, "delay", side_effect=fake_delay) as delay,
+        ):
+            response = self.client.post(
+                url_for("build.action_view"),
+                follow_redirects=True,
+                data=dict(action="07_sign", rowid=[build1.id, build2.id]),
+            )
+        self.assert200(response)
+        delay.assert_called_once_with([build1.id])
+        self.assertIn("must be re-homed before signing", response.data.decode())
+        self.assertIn("Signing of 1 build(s) queued", response.data.decode())
+        db.session.expire_all()
+        self.assertTrue(db.session.get(Build, build1.id).signed)
+        self.assertFalse(db.session.get(Build, build2.id).signed)
+
     def test_action_unsign_requires_admin(self):
         build = BuildFactory(active=False)
         db.session.commit()
@@ -985,3 +1050,16 @@ class BuildTestCase(_AdminActionTestMixin, BaseTestCase):
             response_data = response.data.decode()
             self.assertIn(own_package.name, response_data)
             self.assertNotIn(other_build.version.package.name, response_data)
+
+    def test_signed_out_of_band_detected_despite_member_index(self):
+        build = BuildFactory(active=False, signed=False)
+        db.session.commit()
+        build.member_index = build.calculate_member_index()
+        build.size = build.calculate_size()
+        path = os.path.join(current_app.config["DATA_PATH"], build.path)
+        with tarfile.open(path, "a") as archive:
+            info = tarfile.TarInfo(SPK.SIGNATURE_FILENAME)
+            info.size = len(b"signature")
+            archive.addfile(info, io.BytesIO(b"signature"))
+        self.assertTrue(_detect_and_fix_signed(build))
+        self.assertTrue(build.signed)
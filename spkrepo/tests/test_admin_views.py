@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
-from unittest.mock import patch
+import threading
+from unittest.mock import Mock, patch
 
 from flask import url_for
 
+from spkrepo.ext import cache
 from spkrepo.tests.common import BaseTestCase
-from spkrepo.views.tasks import resync_build_file, resync_build_metadata
+from spkrepo.views.tasks import (
+    resync_build_file,
+    resync_build_metadata,
+    track_user_task,
+    user_tasks_key,
+)
 
 
 def _run_task_sync(task_func):
@@ -129,6 +136,41 @@ class TaskStatusViewTestCase(BaseTestCase):
             self.assertEqual(data["tasks"], [])
             self.assertEqual(data["pending_count"], 0)
 
+    def test_status_json_includes_user_tasks(self):
+        with self.logged_user("developer") as user:
+            track_user_task(user.id, "signing-task-id", "sign", "build label")
+            result = Mock(state="PENDING", info=None)
+            result.ready.return_value = False
+            with patch("spkrepo.views.admin.AsyncResult", return_value=result):
+                response = self.client.get(url_for("tasks.status_json"))
+            self.assert200(response)
+            data = response.get_json()
+            self.assertEqual(len(data["tasks"]), 1)
+            self.assertEqual(data["tasks"][0]["id"], "signing-task-id")
+            self.assertEqual(data["tasks"][0]["type"], "sign")
+            self.assertEqual(data["pending_count"], 1)
+
+    def test_track_user_task_concurrent(self):
+        app = self.app
+
+        def track(i):
+            with app.app_context():
+                track_user_task(1, f"task-{i}", "sign", f"build {i}")
+
+        threads = [threading.Thread(target=track, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tasks = cache.get(user_tasks_key(1))
+        self.assertCountEqual([t["id"] for t in tasks], [f"task-{i}" for i in range(8)])
+
+    def test_track_user_task_locked(self):
+        cache.add(f"{user_tasks_key(1)}:lock", "other-task")
+        with patch("spkrepo.views.tasks.USER_TASKS_LOCK_TIMEOUT", 0):
+            track_user_task(1, "task-id", "sign", "build label")
+        self.assertIsNone(cache.get(user_tasks_key(1)))
+
     def test_status_json_redirects_for_anonymous(self):
         response = self.client.get(url_for("tasks.status_json"))
         self.assert302(response)
@@ -1,24 +1,38 @@
 # -*- coding: utf-8 -*-
 import base64
+import hashlib
+import io
 import json
 import os
+import tarfile
 import warnings
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
 
 from flask import current_app, url_for
+from flask_restful import abort
+from sqlalchemy import event
 from sqlalchemy.exc import SAWarning
 
+from spkrepo import uploads
+from spkrepo.exceptions import SPKSignError
 from spkrepo.ext import db
-from spkrepo.models import Architecture, Build, Firmware, Role
+from spkrepo.models import Architecture, Build, Firmware, Package, Role, Version
 from spkrepo.tests.common import (
+    OBJECT_STORAGE_CONFIG,
     BaseTestCase,
     BuildFactory,
+    FakeObjectStorage,
     IconFactory,
     PackageFactory,
     UserFactory,
+    VersionFactory,
     create_info,
     create_spk,
 )
+from spkrepo.utils import SPK
+from spkrepo.views.api import _store_upload
 
 
 def get_only_build():
@@ -184,7 +198,206 @@ class PackagesTestCase(BaseTestCase):
                     data=spk.read(),
                 )
             )
-        self.assertBuildInserted(get_only_build(), build, user)
+        inserted_build = get_only_build()
+        self.assertBuildInserted(inserted_build, build, user)
+        with tarfile.open(
+            os.path.join(current_app.config["DATA_PATH"], inserted_build.path)
+        ) as archive:
+            info = archive.getmember("INFO")
+        self.assertEqual(inserted_build.member_index["size"], inserted_build.size)
+        self.assertEqual(
+            inserted_build.member_index["members"]["INFO"],
+            [info.offset_data, info.size],
+        )
+
+    def test_post_queues_signing(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+        current_app.config["GNUPG_PATH"] = "gnupghome"
+
+        build = BuildFactory.build()
+        with (
+            create_spk(build) as spk,
+            patch(
+                "spkrepo.views.api.sign_build.delay",
+                return_value=Mock(id="signing-task-id"),
+            ) as delay,
+        ):
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert201(response)
+        self.assertEqual(response.json["signing_task"], "signing-task-id")
+        inserted_build = get_only_build()
+        self.assertFalse(inserted_build.signed)
+        self.assertFalse(inserted_build.active)
+        delay.assert_called_once_with(inserted_build.id, str(inserted_build))
+
+    def test_post_signing_not_queued(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+        current_app.config["GNUPG_PATH"] = "gnupghome"
+
+        build = BuildFactory.build()
+        with (
+            create_spk(build) as spk,
+            patch(
+                "spkrepo.views.api.sign_build.delay",
+                side_effect=OSError("Broker unreachable"),
+            ),
+        ):
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert201(response)
+        self.assertNotIn("signing_task", response.json)
+        inserted_build = get_only_build()
+        self.assertFalse(inserted_build.signed)
+        self.assertFalse(inserted_build.active)
+
+    def test_post_direct_to_storage(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+        current_app.config.update(
+            OBJECT_STORAGE_CONFIG, UPLOAD_DIRECT_TO_STORAGE=True, GNUPG_PATH="gnupghome"
+        )
+        fake = FakeObjectStorage()
+
+        build = BuildFactory.build()
+        with (
+            create_spk(build) as spk,
+            patch("spkrepo.storage._client", return_value=fake),
+            patch(
+                "spkrepo.utils.SPK._generate_signature",
+                return_value="timestamped signature",
+            ),
+            patch("spkrepo.views.api.sign_build.delay") as delay,
+        ):
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert201(response)
+        self.assertNotIn("signing_task", response.json)
+        delay.assert_not_called()
+        inserted_build = get_only_build()
+        self.assertEqual(inserted_build.storage, "remote")
+        self.assertTrue(inserted_build.signed)
+        spk_path = os.path.join(current_app.config["DATA_PATH"], inserted_build.path)
+        self.assertFalse(os.path.exists(spk_path))
+        data = fake.objects[inserted_build.path]
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            self.assertIn("syno_signature.asc", archive.getnames())
+        self.assertEqual(inserted_build.md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(inserted_build.size, len(data))
+        self.assertEqual(inserted_build.member_index["size"], len(data))
+        self.assertFalse(os.path.exists(spk_path + ".json"))
+        calculated = inserted_build.sidecar.calculated
+        self.assertEqual(calculated["sha256"], hashlib.sha256(data).hexdigest())
+        self.assertEqual(calculated["object_storage_key"], inserted_build.path)
+
+    def test_post_stores_before_lock(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+        events = []
+
+        @contextmanager
+        def package_lock(*names):
+            events.append("lock")
+            yield
+            events.append("unlock")
+
+        def store_upload(*args, **kwargs):
+            events.append("store")
+            return _store_upload(*args, **kwargs)
+
+        build = BuildFactory.build()
+        with (
+            create_spk(build) as spk,
+            patch("spkrepo.views.api.package_lock", package_lock),
+            patch("spkrepo.views.api._store_upload", side_effect=store_upload),
+        ):
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert201(response)
+        self.assertEqual(events, ["store", "lock", "unlock"])
+
+    def test_post_conflict_under_lock(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        def check_conflicts(upload, lock=True):
+            # another upload registered the same build while this one was stored
+            if lock:
+                abort(409, message="Conflicting architectures")
+
+        build = BuildFactory.build()
+        with (
+            create_spk(build) as spk,
+            patch("spkrepo.views.api._check_conflicts", side_effect=check_conflicts),
+        ):
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert409(response)
+        self.assertEqual(
+            db.session.execute(db.select(Build)).unique().scalars().all(), []
+        )
+        data_path = current_app.config["DATA_PATH"]
+        self.assertFalse(
+            os.path.exists(os.path.join(data_path, build.version.package.name))
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(data_path, uploads.UPLOADS_DIRNAME)), []
+        )
+
+    def test_post_direct_to_storage_sign_failure(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+        current_app.config.update(
+            OBJECT_STORAGE_CONFIG, UPLOAD_DIRECT_TO_STORAGE=True, GNUPG_PATH="gnupghome"
+        )
+        fake = FakeObjectStorage()
+
+        build = BuildFactory.build()
+        with (
+            create_spk(build) as spk,
+            patch("spkrepo.storage._client", return_value=fake),
+            patch(
+                "spkrepo.utils.SPK._generate_signature",
+                side_effect=SPKSignError("Timestamp server did not respond in time"),
+            ),
+            patch(
+                "spkrepo.views.api.sign_build.delay",
+                return_value=Mock(id="signing-task-id"),
+            ),
+        ):
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert201(response)
+        self.assertEqual(response.json["signing_task"], "signing-task-id")
+        inserted_build = get_only_build()
+        self.assertEqual(inserted_build.storage, "local")
+        self.assertFalse(inserted_build.signed)
+        self.assertEqual(fake.objects, {})
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(current_app.config["DATA_PATH"], inserted_build.path)
+            )
+        )
 
     def test_post_conflict(self):
         user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
@@ -200,7 +413,9 @@ class PackagesTestCase(BaseTestCase):
                     data=spk.read(),
                 )
             )
-            spk.seek(0)
+        # same build, different file
+        build.changelog = "Rebuilt"
+        with create_spk(build) as spk:
             response = self.client.post(
                 url_for("api.packages"),
                 headers=authorization_header(user),
@@ -212,6 +427,90 @@ class PackagesTestCase(BaseTestCase):
             response.data.decode(),
         )
 
+    def test_post_duplicate(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        build = BuildFactory.build()
+        with create_spk(build) as spk:
+            data = spk.read()
+        self.assert201(
+            self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=data,
+            )
+        )
+        with patch("spkrepo.views.api.SPK") as spk_class:
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=data,
+            )
+        self.assert200(response)
+        spk_class.assert_not_called()
+        self.assertTrue(response.json["duplicate"])
+        self.assertEqual(response.json["package"], build.version.package.name)
+        inserted_build = get_only_build()
+        self.assertEqual(inserted_build.upload_digest, hashlib.sha256(data).hexdigest())
+
+    def test_post_duplicate_insufficient_permissions(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        other_user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        with create_spk(BuildFactory.build()) as spk:
+            data = spk.read()
+        self.assert201(
+            self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=data,
+            )
+        )
+        response = self.client.post(
+            url_for("api.packages"),
+            headers=authorization_header(other_user),
+            data=data,
+        )
+        self.assert403(response)
+
+    def test_post_conflict_overlapping_firmware_range(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        firmwares = (
+            db.session.execute(db.select(Firmware).order_by(Firmware.build))
+            .scalars()
+            .all()
+        )
+        build = BuildFactory.build(
+            architectures=[Architecture.find("88f628x"), Architecture.find("qoriq")],
+            firmware_min=firmwares[0],
+            firmware_max=firmwares[-1],
+        )
+        with create_spk(build) as spk:
+            self.assert201(
+                self.client.post(
+                    url_for("api.packages"),
+                    headers=authorization_header(user),
+                    data=spk.read(),
+                )
+            )
+        other_build = BuildFactory.build(
+            version=build.version,
+            architectures=[Architecture.find("cedarview"), Architecture.find("qoriq")],
+            firmware_min=firmwares[-1],
+        )
+        with create_spk(other_build) as spk:
+            response = self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=spk.read(),
+            )
+        self.assert409(response)
+        self.assertEqual(response.json["message"], "Conflicting architectures: qoriq")
+
     def test_post_allows_different_firmware_same_architecture(self):
         user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
         db.session.commit()
@@ -606,6 +905,33 @@ class PackagesTestCase(BaseTestCase):
                 )
             )
 
+    def test_post_does_not_load_version_history(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        package = PackageFactory()
+        VersionFactory.create_batch(20, package=package)
+        db.session.commit()
+        headers = authorization_header(user)
+        with create_spk(BuildFactory.build(version__package=package)) as spk:
+            data = spk.read()
+        # start from an empty identity map, as a new request would
+        db.session.rollback()
+        db.session.expunge_all()
+
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target.version)
+
+        event.listen(Version, "load", on_load)
+        try:
+            response = self.client.post(
+                url_for("api.packages"), headers=headers, data=data
+            )
+        finally:
+            event.remove(Version, "load", on_load)
+        self.assert201(response)
+        self.assertEqual(loaded, [])
+
     def test_post_existing_version_mismatched_upstream(self):
         # A second build with a different upstream_version must be rejected with 422.
         user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
@@ -964,3 +1290,541 @@ class PackagesTestCase(BaseTestCase):
         self.assertIn(
             "Insufficient permissions on this package", response.data.decode()
         )
+
+
+class BulkPackagesTestCase(BaseTestCase):
+    def _post(self, user, builds, infos=None):
+        files = {}
+        for i, build in enumerate(builds):
+            info = infos[i] if infos else None
+            with create_spk(build, info=info) as spk:
+                files.setdefault("file", []).append(
+                    (io.BytesIO(spk.read()), f"build_{i}.spk")
+                )
+        return self.client.post(
+            url_for("api.bulkpackages"),
+            headers=authorization_header(user),
+            data=files,
+            content_type="multipart/form-data",
+        )
+
+    def _builds_of_one_version(self, *arch_codes):
+        build = BuildFactory.build(architectures=[Architecture.find(arch_codes[0])])
+        return [build] + [
+            BuildFactory.build(
+                version=build.version, architectures=[Architecture.find(code)]
+            )
+            for code in arch_codes[1:]
+        ]
+
+    def test_post_registers_all_builds(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        builds = self._builds_of_one_version("88f628x", "cedarview", "qoriq")
+        response = self._post(user, builds)
+        self.assert201(response)
+        results = response.json["results"]
+        self.assertEqual([r["status"] for r in results], [201, 201, 201])
+        self.assertEqual(
+            [r["filename"] for r in results], [f"build_{i}.spk" for i in range(3)]
+        )
+        self.assertEqual(results[1]["architectures"], ["cedarview"])
+        inserted = db.session.execute(db.select(Build)).unique().scalars().all()
+        self.assertEqual(len(inserted), 3)
+        self.assertEqual(len({b.version_id for b in inserted}), 1)
+        for build in inserted:
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(current_app.config["DATA_PATH"], build.path)
+                )
+            )
+
+    def test_post_conflict_within_set_registers_nothing(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        builds = self._builds_of_one_version("88f628x", "cedarview", "cedarview")
+        builds[2].firmware_min = builds[1].firmware_min
+        response = self._post(user, builds)
+        self.assert409(response)
+        results = response.json["results"]
+        self.assertNotIn("status", results[0])
+        self.assertEqual(results[2]["status"], 409)
+        self.assertIn("Conflicting architectures: cedarview", results[2]["message"])
+        self.assertEqual(
+            db.session.execute(db.select(Build)).unique().scalars().all(), []
+        )
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(
+                    current_app.config["DATA_PATH"], builds[0].version.package.name
+                )
+            )
+        )
+
+    def test_post_conflict_under_lock_registers_nothing(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        def check_conflicts(upload, lock=True):
+            if lock and upload.architectures[0].code == "cedarview":
+                abort(409, message="Conflicting architectures: cedarview")
+
+        builds = self._builds_of_one_version("88f628x", "cedarview", "qoriq")
+        with patch("spkrepo.views.api._check_conflicts", side_effect=check_conflicts):
+            response = self._post(user, builds)
+        self.assert409(response)
+        results = response.json["results"]
+        self.assertEqual(results[1]["status"], 409)
+        self.assertEqual(results[2]["message"], "Not processed")
+        self.assertEqual(
+            db.session.execute(db.select(Build)).unique().scalars().all(), []
+        )
+        data_path = current_app.config["DATA_PATH"]
+        self.assertFalse(
+            os.path.exists(os.path.join(data_path, builds[0].version.package.name))
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(data_path, uploads.UPLOADS_DIRNAME)), []
+        )
+
+    def test_post_inconsistent_version_metadata(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        builds = self._builds_of_one_version("88f628x", "cedarview")
+        infos = [create_info(build) for build in builds]
+        infos[1]["maintainer"] = "someone else"
+        response = self._post(user, builds, infos)
+        self.assert422(response)
+        results = response.json["results"]
+        self.assertEqual(results[1]["status"], 422)
+        self.assertEqual(
+            results[1]["message"], "Version-level metadata differs from build_0.spk"
+        )
+        self.assertEqual(
+            db.session.execute(db.select(Build)).unique().scalars().all(), []
+        )
+
+    def test_post_invalid_spk_reported_per_file(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        with create_spk(BuildFactory.build()) as spk:
+            data = {
+                "file": [
+                    (io.BytesIO(spk.read()), "valid.spk"),
+                    (io.BytesIO(b"garbage"), "invalid.spk"),
+                ]
+            }
+        response = self.client.post(
+            url_for("api.bulkpackages"),
+            headers=authorization_header(user),
+            data=data,
+            content_type="multipart/form-data",
+        )
+        self.assert422(response)
+        results = response.json["results"]
+        self.assertEqual(results[1]["status"], 422)
+        self.assertEqual(results[1]["message"], "Invalid SPK")
+
+    def test_post_skips_duplicates(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        builds = self._builds_of_one_version("88f628x", "cedarview")
+        with create_spk(builds[0]) as spk:
+            self.assert201(
+                self.client.post(
+                    url_for("api.packages"),
+                    headers=authorization_header(user),
+                    data=spk.read(),
+                )
+            )
+        response = self._post(user, builds)
+        self.assert201(response)
+        results = response.json["results"]
+        self.assertEqual([r["status"] for r in results], [200, 201])
+        self.assertTrue(results[0]["duplicate"])
+        self.assertNotIn("duplicate", results[1])
+        inserted = db.session.execute(db.select(Build)).unique().scalars().all()
+        self.assertEqual(len(inserted), 2)
+
+    def test_post_no_files(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+        response = self.client.post(
+            url_for("api.bulkpackages"), headers=authorization_header(user)
+        )
+        self.assert400(response)
+
+    def test_post_limits_size_per_file(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        builds = self._builds_of_one_version("88f628x", "cedarview")
+        sizes = []
+        for build in builds:
+            with create_spk(build) as spk:
+                sizes.append(len(spk.read()))
+        current_app.config["MAX_CONTENT_LENGTH"] = max(sizes)
+        with patch("spkrepo.views.api.SPK", wraps=SPK) as parse:
+            response = self._post(user, builds)
+        self.assert201(response)
+        for call in parse.call_args_list:
+            self.assertIsInstance(call.args[0], io.BufferedReader)
+        data_path = current_app.config["DATA_PATH"]
+        self.assertEqual(
+            os.listdir(os.path.join(data_path, uploads.UPLOADS_DIRNAME)), []
+        )
+
+    def test_post_file_too_large(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        builds = self._builds_of_one_version("88f628x", "cedarview")
+        with create_spk(builds[1]) as spk:
+            current_app.config["MAX_CONTENT_LENGTH"] = len(spk.read()) - 1
+        response = self._post(user, builds)
+        self.assertStatus(response, 413)
+        results = response.json["results"]
+        self.assertEqual(results[1]["status"], 413)
+        self.assertEqual(results[1]["message"], "File exceeds the maximum SPK size")
+        self.assertEqual(
+            db.session.execute(db.select(Build)).unique().scalars().all(), []
+        )
+        data_path = current_app.config["DATA_PATH"]
+        self.assertEqual(
+            os.listdir(os.path.join(data_path, uploads.UPLOADS_DIRNAME)), []
+        )
+
+    def test_post_request_too_large(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        current_app.config["API_BULK_MAX_CONTENT_LENGTH"] = 1024
+        response = self._post(user, self._builds_of_one_version("88f628x"))
+        self.assertStatus(response, 413)
+
+
+class UploadsTestCase(BaseTestCase):
+    def _create(self, user):
+        response = self.client.post(
+            url_for("api.uploads"), headers=authorization_header(user)
+        )
+        self.assert201(response)
+        return response.json["id"]
+
+    def _put(self, user, session_id, offset, data):
+        return self.client.put(
+            url_for("api.upload", session_id=session_id, offset=offset),
+            headers=authorization_header(user),
+            data=data,
+        )
+
+    def test_chunked_upload(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        build = BuildFactory.build()
+        with create_spk(build) as spk:
+            data = spk.read()
+        session_id = self._create(user)
+        chunk_size = len(data) // 3 + 1
+        with patch("spkrepo.uploads.hash_file", wraps=uploads.hash_file) as hash_file:
+            for offset in range(0, len(data), chunk_size):
+                response = self._put(
+                    user, session_id, offset, data[offset : offset + chunk_size]
+                )
+                self.assert200(response)
+                self.assertEqual(
+                    response.json["offset"], min(offset + chunk_size, len(data))
+                )
+            # the staged data is only read when the session is committed
+            hash_file.assert_not_called()
+
+            response = self.client.post(
+                url_for("api.uploadcommit", session_id=session_id),
+                headers=authorization_header(user),
+            )
+        self.assert201(response)
+        hash_file.assert_called_once()
+        self.assertEqual(response.json["package"], build.version.package.name)
+        inserted_build = get_only_build()
+        self.assertEqual(inserted_build.md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(inserted_build.size, len(data))
+        with io.open(
+            os.path.join(current_app.config["DATA_PATH"], inserted_build.path), "rb"
+        ) as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(
+            os.listdir(
+                os.path.join(current_app.config["DATA_PATH"], uploads.UPLOADS_DIRNAME)
+            ),
+            [],
+        )
+
+    def test_commit_direct_to_storage(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+        current_app.config.update(
+            OBJECT_STORAGE_CONFIG, UPLOAD_DIRECT_TO_STORAGE=True, GNUPG_PATH="gnupghome"
+        )
+        fake = FakeObjectStorage()
+
+        build = BuildFactory.build()
+        with create_spk(build) as spk:
+            data = spk.read()
+        session_id = self._create(user)
+        self.assert200(self._put(user, session_id, 0, data))
+        with (
+            patch("spkrepo.storage._client", return_value=fake),
+            patch(
+                "spkrepo.utils.SPK._generate_signature",
+                return_value="timestamped signature",
+            ),
+        ):
+            response = self.client.post(
+                url_for("api.uploadcommit", session_id=session_id),
+                headers=authorization_header(user),
+            )
+        self.assert201(response)
+        inserted_build = get_only_build()
+        self.assertEqual(inserted_build.storage, "remote")
+        uploaded = fake.objects[inserted_build.path]
+        with tarfile.open(fileobj=io.BytesIO(uploaded)) as archive:
+            self.assertIn("syno_signature.asc", archive.getnames())
+        self.assertEqual(inserted_build.md5, hashlib.md5(uploaded).hexdigest())
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(current_app.config["DATA_PATH"], inserted_build.path)
+            )
+        )
+        self.assertEqual(
+            os.listdir(
+                os.path.join(current_app.config["DATA_PATH"], uploads.UPLOADS_DIRNAME)
+            ),
+            [],
+        )
+
+    def test_commit_duplicate(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        with create_spk(BuildFactory.build()) as spk:
+            data = spk.read()
+        self.assert201(
+            self.client.post(
+                url_for("api.packages"),
+                headers=authorization_header(user),
+                data=data,
+            )
+        )
+        session_id = self._create(user)
+        self.assert200(self._put(user, session_id, 0, data))
+        response = self.client.post(
+            url_for("api.uploadcommit", session_id=session_id),
+            headers=authorization_header(user),
+        )
+        self.assert200(response)
+        self.assertTrue(response.json["duplicate"])
+        self.assertIsNone(uploads.owner(session_id))
+        self.assertEqual(
+            len(db.session.execute(db.select(Build)).unique().scalars().all()), 1
+        )
+
+    def test_resume_after_wrong_offset(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        session_id = self._create(user)
+        self.assert200(self._put(user, session_id, 0, b"abcd"))
+        response = self._put(user, session_id, 2, b"cdef")
+        self.assert409(response)
+        self.assertEqual(response.json["offset"], 4)
+        response = self.client.get(
+            url_for("api.upload", session_id=session_id),
+            headers=authorization_header(user),
+        )
+        self.assertEqual(response.json["offset"], 4)
+        self.assert200(self._put(user, session_id, 4, b"ef"))
+        md5, sha256, size = uploads.digests(session_id)
+        self.assertEqual(md5, hashlib.md5(b"abcdef").hexdigest())
+        self.assertEqual(sha256, hashlib.sha256(b"abcdef").hexdigest())
+        self.assertEqual(size, 6)
+
+    def test_staged_data_gone(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        session_id = self._create(user)
+        self.assert200(self._put(user, session_id, 0, b"abcd"))
+        os.remove(uploads.data_path(session_id))
+        response = self.client.get(
+            url_for("api.upload", session_id=session_id),
+            headers=authorization_header(user),
+        )
+        self.assertStatus(response, 410)
+        self.assertIsNone(uploads.owner(session_id))
+
+    def test_session_of_other_user(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        other_user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        session_id = self._create(user)
+        self.assert404(self._put(other_user, session_id, 0, b"data"))
+        self.assert404(
+            self.client.post(
+                url_for("api.uploadcommit", session_id=session_id),
+                headers=authorization_header(other_user),
+            )
+        )
+
+    def test_commit_invalid_spk(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        session_id = self._create(user)
+        self.assert200(self._put(user, session_id, 0, b"garbage"))
+        response = self.client.post(
+            url_for("api.uploadcommit", session_id=session_id),
+            headers=authorization_header(user),
+        )
+        self.assert422(response)
+        self.assertIn("Invalid SPK", response.data.decode())
+
+    def test_delete(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        session_id = self._create(user)
+        response = self.client.delete(
+            url_for("api.upload", session_id=session_id),
+            headers=authorization_header(user),
+        )
+        self.assertStatus(response, 204)
+        self.assert404(self._put(user, session_id, 0, b"data"))
+
+
+def info_text(info):
+    return "\n".join(f'{k}="{v}"' for k, v in info.items()).encode("utf-8")
+
+
+class PackagesPreflightTestCase(BaseTestCase):
+    def _preflight(self, user, data, content_type="text/plain"):
+        return self.client.post(
+            url_for("api.packagespreflight"),
+            headers=authorization_header(user),
+            data=data,
+            content_type=content_type,
+        )
+
+    def test_info_text_new_package(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        build = BuildFactory.build(architectures=[Architecture.find("88f628x")])
+        response = self._preflight(user, info_text(create_info(build)))
+        self.assert200(response)
+        self.assertEqual(response.json["package"], build.version.package.name)
+        self.assertEqual(response.json["architectures"], ["88f628x"])
+        self.assertTrue(response.json["create_package"])
+        self.assertTrue(response.json["create_version"])
+        self.assertIsNone(Package.find(build.version.package.name))
+
+    def test_archive_head(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        build = BuildFactory.build()
+        spk_stream = io.BytesIO()
+        with tarfile.open(fileobj=spk_stream, mode="w:") as spk:
+            for name, data in (
+                ("INFO", info_text(create_info(build))),
+                ("package.tgz", os.urandom(1024 * 1024)),
+            ):
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                spk.addfile(tarinfo, io.BytesIO(data))
+        response = self._preflight(
+            user, spk_stream.getvalue()[:8192], "application/octet-stream"
+        )
+        self.assert200(response)
+        self.assertEqual(response.json["version"], build.version.version_string)
+
+    def test_archive_head_without_info(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        with create_spk(BuildFactory.build()) as spk:
+            data = spk.read(1024)
+        response = self._preflight(user, data, "application/octet-stream")
+        self.assert422(response)
+        self.assertIn("Missing INFO file", response.data.decode())
+
+    def test_conflict(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        build = BuildFactory.build(architectures=[Architecture.find("cedarview")])
+        with create_spk(build) as spk:
+            self.assert201(
+                self.client.post(
+                    url_for("api.packages"),
+                    headers=authorization_header(user),
+                    data=spk.read(),
+                )
+            )
+        response = self._preflight(user, info_text(create_info(build)))
+        self.assert409(response)
+        self.assertIn("Conflicting architectures: cedarview", response.data.decode())
+
+    def test_existing_version_metadata_mismatch(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        build = BuildFactory.build(
+            architectures=[Architecture.find("cedarview")],
+            version__license="license",
+            version__install_wizard=True,
+        )
+        with create_spk(build) as spk:
+            self.assert201(
+                self.client.post(
+                    url_for("api.packages"),
+                    headers=authorization_header(user),
+                    data=spk.read(),
+                )
+            )
+        new_build = BuildFactory.build(
+            version=build.version, architectures=[Architecture.find("88f628x")]
+        )
+        info = create_info(new_build)
+        # license and wizards are not part of INFO, they are not compared
+        response = self._preflight(user, info_text(info))
+        self.assert200(response)
+        self.assertFalse(response.json["create_version"])
+
+        info["maintainer"] = "someone else"
+        response = self._preflight(user, info_text(info))
+        self.assert422(response)
+        self.assertIn("maintainer", response.data.decode())
+
+    def test_unknown_architecture(self):
+        user = UserFactory(roles=[Role.find("developer"), Role.find("package_admin")])
+        db.session.commit()
+
+        info = create_info(BuildFactory.build())
+        info["arch"] = "myarch"
+        response = self._preflight(user, info_text(info))
+        self.assert422(response)
+        self.assertIn("Unknown architecture: myarch", response.data.decode())
+
+    def test_insufficient_permissions(self):
+        user = UserFactory(roles=[Role.find("developer")])
+        db.session.commit()
+
+        response = self._preflight(user, info_text(create_info(BuildFactory.build())))
+        self.assert403(response)
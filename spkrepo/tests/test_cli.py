@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import tarfile
+import time
+from unittest.mock import patch
+
+from spkrepo.cli import verify_build_file
+from spkrepo.ext import db
+from spkrepo.tests.common import BaseTestCase, BuildFactory
+from spkrepo.utils import SPK
+
+
+class _CountingFile(io.FileIO):
+    """File counting the bytes read from it."""
+
+    def __init__(self, path):
+        super().__init__(path, "r")
+        self.read_size = 0
+
+    def readinto(self, b):
+        length = super().readinto(b)
+        self.read_size += length
+        return length
+
+
+class VerifyTestCase(BaseTestCase):
+    def verify(self, *args):
+        result = self.app.test_cli_runner().invoke(
+            args=["spkrepo", "verify", "--jobs", "2", *args]
+        )
+        return result.exit_code, json.loads(result.output)
+
+    def test_valid(self):
+        BuildFactory.create_batch(3)
+        db.session.commit()
+        exit_code, report = self.verify()
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(report["verified"], 3)
+        self.assertEqual(report["failed"], 0)
+        self.assertEqual(report["orphans"], [])
+
+    def test_problems(self):
+        mismatch, drift, missing, remote = BuildFactory.create_batch(4)
+        db.session.commit()
+        mismatch.md5 = "0" * 32
+        mismatch.size += 1
+        drift.signed = True
+        os.remove(os.path.join(self.app.config["DATA_PATH"], missing.path))
+        remote.storage = "remote"
+        db.session.commit()
+
+        exit_code, report = self.verify()
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(report["verified"], 3)
+        self.assertEqual(report["skipped"], 1)
+        problems = {r["build_id"]: r["problems"] for r in report["failures"]}
+        self.assertEqual(len(problems[mismatch.id]), 2)
+        self.assertIn("size mismatch", problems[mismatch.id][0])
+        self.assertIn("md5 mismatch", problems[mismatch.id][1])
+        self.assertEqual(
+            problems[drift.id], ["signature drift: build is signed, file is not"]
+        )
+        self.assertEqual(problems[missing.id], ["missing file"])
+
+    def test_stale_member_index(self):
+        build = BuildFactory()
+        db.session.commit()
+        build.member_index = build.calculate_member_index()
+        path = os.path.join(self.app.config["DATA_PATH"], build.path)
+        with tarfile.open(path, "a") as archive:
+            info = tarfile.TarInfo(SPK.SIGNATURE_FILENAME)
+            info.size = len(b"signature")
+            archive.addfile(info, io.BytesIO(b"signature"))
+        build.md5 = build.calculate_md5()
+        build.size = build.calculate_size()
+        build.member_index["size"] = build.size
+        db.session.commit()
+
+        exit_code, report = self.verify("--max-rate", "100")
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(
+            report["failures"][0]["problems"],
+            ["signature drift: file is signed, build is not"],
+        )
+
+    def test_max_rate(self):
+        build = BuildFactory()
+        db.session.commit()
+        path = os.path.join(self.app.config["DATA_PATH"], build.path)
+        max_rate = build.size * 4
+        opened = []
+
+        def counting_open(file_path, mode):
+            f = _CountingFile(file_path)
+            opened.append(f)
+            return f
+
+        start = time.monotonic()
+        with patch("spkrepo.cli.io.open", side_effect=counting_open):
+            problems = verify_build_file(
+                path, build.md5, build.size, build.signed, max_rate=max_rate
+            )
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(problems, [])
+        read_size = sum(f.read_size for f in opened)
+        self.assertGreater(read_size, build.size)
+        self.assertGreaterEqual(elapsed, read_size / max_rate)
+
+    def test_orphans(self):
+        build = BuildFactory()
+        db.session.commit()
+        data_path = self.app.config["DATA_PATH"]
+        orphan = os.path.join(os.path.dirname(build.path), "old.spk")
+        for path in [orphan, os.path.join(".uploads", "staged.spk")]:
+            os.makedirs(os.path.dirname(os.path.join(data_path, path)), exist_ok=True)
+            io.open(os.path.join(data_path, path), "wb").close()
+
+        exit_code, report = self.verify()
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(report["orphans"], [orphan])
+
+    def test_resume(self):
+        first, second = BuildFactory.create_batch(2)
+        db.session.commit()
+        state = os.path.join(self.app.config["DATA_PATH"], "verify.state")
+        with io.open(state, "w", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {"build_id": first.id, "path": first.path, "problems": ["old"]}
+                )
+                + "\n"
+            )
+
+        exit_code, report = self.verify("--state", state)
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(report["verified"], 2)
+        self.assertEqual([r["build_id"] for r in report["failures"]], [first.id])
+        with io.open(state, "r", encoding="utf-8") as f:
+            recorded = [json.loads(line)["build_id"] for line in f]
+        self.assertEqual(recorded, [first.id, second.id])
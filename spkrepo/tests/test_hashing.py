@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from spkrepo.hashing import (
+    CHUNK_SIZE,
+    HashingReader,
+    hash_file,
+    hash_stream,
+    update_from_stream,
+)
+
+
+class HashingTestCase(TestCase):
+    def setUp(self):
+        self.data = os.urandom(CHUNK_SIZE * 2 + 123)
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(self.data)
+        self.path = f.name
+
+    def test_hash_file(self):
+        digests, size = hash_file(self.path, ("md5", "sha256"))
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(digests["md5"], hashlib.md5(self.data).hexdigest())
+        self.assertEqual(digests["sha256"], hashlib.sha256(self.data).hexdigest())
+
+    def test_hash_empty_file(self):
+        io.open(self.path, "wb").close()
+        self.assertEqual(hash_file(self.path), ({"md5": hashlib.md5().hexdigest()}, 0))
+
+    def test_hash_stream(self):
+        stream = io.BytesIO(self.data)
+        stream.seek(10)
+        digests, size = hash_stream(stream)
+        self.assertEqual(size, len(self.data) - 10)
+        self.assertEqual(digests, {"md5": hashlib.md5(self.data[10:]).hexdigest()})
+
+    def test_update_from_stream(self):
+        md5 = hashlib.md5(b"prefix")
+        self.assertEqual(
+            update_from_stream([md5], io.BytesIO(self.data)), len(self.data)
+        )
+        self.assertEqual(
+            md5.hexdigest(), hashlib.md5(b"prefix" + self.data).hexdigest()
+        )
+
+    def test_hashing_reader(self):
+        reader = HashingReader(io.BytesIO(self.data), ("md5", "sha256"))
+        chunks = list(iter(lambda: reader.read(1000), b""))
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertEqual(reader.size, len(self.data))
+        self.assertEqual(
+            reader.hexdigests(),
+            {
+                "md5": hashlib.md5(self.data).hexdigest(),
+                "sha256": hashlib.sha256(self.data).hexdigest(),
+            },
+        )
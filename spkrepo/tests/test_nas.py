@@ -1,19 +1,28 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import json
+import os
+import threading
+import time
 from datetime import datetime, timedelta
+from unittest.mock import patch
+from urllib.parse import quote, unquote
 
 from flask import url_for
 
+from spkrepo import remote_cache, storage
 from spkrepo.ext import db
 from spkrepo.models import Architecture, DownloadStat, Firmware, PackageDownloadCounts
 from spkrepo.tests.common import (
+    OBJECT_STORAGE_CONFIG,
     BaseTestCase,
     BuildFactory,
     DownloadStatFactory,
+    FakeObjectStorage,
     PackageFactory,
     VersionFactory,
 )
+from spkrepo.views.nas import find_build
 
 
 class CatalogTestCase(BaseTestCase):
@@ -611,6 +620,7 @@ class CatalogTestCase(BaseTestCase):
         data_a = dict(arch="88f6281", build="1594", language="enu")
         response_a = self.client.post(url_for("nas.catalog"), data=data_a)
         self.assert200(response_a)
+        self.assertEqual(response_a.headers["Surrogate-Key"], "catalog")
         catalog_a = json.loads(response_a.data.decode())
         packages_a = catalog_a["packages"] if isinstance(catalog_a, dict) else catalog_a
         self.assertEqual(len(packages_a), 1)
@@ -634,3 +644,268 @@ class CatalogTestCase(BaseTestCase):
         # Build-level auto-generated fields (md5, link) should differ per build
         self.assertNotEqual(packages_a[0]["md5"], packages_b[0]["md5"])
         self.assertNotEqual(packages_a[0]["link"], packages_b[0]["link"])
+
+
+class DataTestCase(BaseTestCase):
+    def file_etag(self, path):
+        stat = os.stat(os.path.join(self.app.config["DATA_PATH"], path))
+        return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def test_build(self):
+        build = BuildFactory()
+        db.session.commit()
+        response = self.client.get(url_for("nas.data", path=build.path))
+        self.assert200(response)
+        self.assertEqual(response.headers["ETag"], self.file_etag(build.path))
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=3600")
+        self.assertEqual(
+            response.headers["Surrogate-Key"], storage.data_surrogate_key(build.path)
+        )
+        response.close()
+
+    def test_hidden_path(self):
+        hidden_path = os.path.join(self.app.config["DATA_PATH"], ".uploads")
+        os.makedirs(hidden_path)
+        with open(os.path.join(hidden_path, "staged"), "wb") as f:
+            f.write(b"data")
+        self.assert404(self.client.get(url_for("nas.data", path=".uploads/staged")))
+
+    def test_not_modified(self):
+        build = BuildFactory()
+        db.session.commit()
+        response = self.client.get(
+            url_for("nas.data", path=build.path),
+            headers={"If-None-Match": self.file_etag(build.path)},
+        )
+        self.assertStatus(response, 304)
+
+    def test_rewritten_file_modified(self):
+        build = BuildFactory()
+        db.session.commit()
+        etag = self.file_etag(build.path)
+        # signed in place by another process
+        with open(os.path.join(self.app.config["DATA_PATH"], build.path), "ab") as f:
+            f.write(b"\0" * 1024)
+        response = self.client.get(
+            url_for("nas.data", path=build.path), headers={"If-None-Match": etag}
+        )
+        self.assert200(response)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        response.close()
+
+    def test_range(self):
+        build = BuildFactory()
+        db.session.commit()
+        with open(os.path.join(self.app.config["DATA_PATH"], build.path), "rb") as f:
+            content = f.read()
+        response = self.client.get(
+            url_for("nas.data", path=build.path), headers={"Range": "bytes=10-19"}
+        )
+        self.assertStatus(response, 206)
+        self.assertEqual(response.data, content[10:20])
+        self.assertEqual(
+            response.headers["Content-Range"], f"bytes 10-19/{len(content)}"
+        )
+        response.close()
+
+    def test_icon_max_age(self):
+        self.app.config["DATA_MAX_AGE"] = 60
+        version = VersionFactory()
+        db.session.commit()
+        icon = version.icons["72"]
+        response = self.client.get(url_for("nas.data", path=icon.path))
+        self.assert200(response)
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=60")
+        self.assertIn("ETag", response.headers)
+        response.close()
+
+    def test_screenshot_no_max_age(self):
+        package = PackageFactory()
+        db.session.commit()
+        response = self.client.get(
+            url_for("nas.data", path=package.screenshots[0].path)
+        )
+        self.assert200(response)
+        self.assertEqual(response.headers["Cache-Control"], "public")
+        response.close()
+
+    def test_accel_redirect(self):
+        self.app.config["DATA_ACCEL_REDIRECT"] = "/_data/"
+        build = BuildFactory()
+        db.session.commit()
+        response = self.client.get(
+            url_for("nas.data", path=build.path), headers={"Range": "bytes=10-19"}
+        )
+        self.assert200(response)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(
+            response.headers["X-Accel-Redirect"], "/_data/" + quote(build.path)
+        )
+        self.assertNotIn("X-Sendfile", response.headers)
+        self.assertEqual(response.headers["ETag"], self.file_etag(build.path))
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+    def test_x_sendfile(self):
+        self.app.config["USE_X_SENDFILE"] = True
+        build = BuildFactory()
+        db.session.commit()
+        response = self.client.get(url_for("nas.data", path=build.path))
+        self.assert200(response)
+        self.assertEqual(
+            response.headers["X-Sendfile"],
+            os.path.join(self.app.config["DATA_PATH"], build.path),
+        )
+
+    def test_not_found(self):
+        response = self.client.get(url_for("nas.data", path="missing/1/missing.spk"))
+        self.assert404(response)
+
+
+class RemoteDataTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_path = os.path.join(self.app.config["DATA_PATH"], ".cache")
+        self.app.config.update(OBJECT_STORAGE_CONFIG, REMOTE_CACHE_PATH=self.cache_path)
+        self.fake = FakeObjectStorage()
+        patcher = patch("spkrepo.storage._client", return_value=self.fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_remote_build(self):
+        build = BuildFactory()
+        db.session.commit()
+        path = os.path.join(self.app.config["DATA_PATH"], build.path)
+        with open(path, "rb") as f:
+            self.fake.objects[build.path] = f.read()
+        os.remove(path)
+        build.storage = "remote"
+        db.session.commit()
+        return build
+
+    def test_served_from_cache(self):
+        build = self.create_remote_build()
+        with patch(
+            "spkrepo.remote_cache.storage.download", wraps=storage.download
+        ) as download:
+            for _ in range(2):
+                response = self.client.get(url_for("nas.data", path=build.path))
+                self.assert200(response)
+                self.assertEqual(response.data, self.fake.objects[build.path])
+                response.close()
+        download.assert_called_once()
+        self.assertIn(build.md5 + ".spk", os.listdir(self.cache_path))
+        self.assertEqual(response.headers["ETag"], f'"{build.md5}"')
+        self.assertIn(
+            os.path.basename(build.path), response.headers["Content-Disposition"]
+        )
+
+    def test_single_flight(self):
+        build = self.create_remote_build()
+        download = storage.download
+
+        def slow_download(object_key, local_path):
+            time.sleep(0.2)
+            return download(object_key, local_path)
+
+        # the threads must not load expired attributes through the session
+        object_key, md5, size = build.path, build.md5, build.size
+        paths = []
+
+        def fetch():
+            with self.app.app_context():
+                paths.append(remote_cache.fetch(object_key, md5, size))
+
+        with patch(
+            "spkrepo.remote_cache.storage.download", side_effect=slow_download
+        ) as slow:
+            threads = [threading.Thread(target=fetch) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        slow.assert_called_once()
+        self.assertEqual(paths, [os.path.join(self.cache_path, md5 + ".spk")] * 4)
+
+    def test_corrupt_download(self):
+        build = self.create_remote_build()
+        self.fake.objects[build.path] += b"garbage"
+        response = self.client.get(url_for("nas.data", path=build.path))
+        self.assertStatus(response, 503)
+        self.assertFalse(
+            [name for name in os.listdir(self.cache_path) if name.endswith(".spk")]
+        )
+
+    def test_evict_least_recently_used(self):
+        old, recent = self.create_remote_build(), self.create_remote_build()
+        old_path = remote_cache.fetch(old.path, old.md5, old.size)
+        os.utime(old_path, (0, 0))
+        self.app.config["REMOTE_CACHE_MAX_SIZE"] = recent.size
+        recent_path = remote_cache.fetch(recent.path, recent.md5, recent.size)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(recent_path))
+
+    def test_evict_stale_part_removed_concurrently(self):
+        build = self.create_remote_build()
+        remote_cache.fetch(build.path, build.md5, build.size)
+        part_path = os.path.join(self.cache_path, "stale" + remote_cache.PART_SUFFIX)
+        with open(part_path, "wb"):
+            pass
+        os.utime(part_path, (0, 0))
+        with patch(
+            "spkrepo.remote_cache.os.remove", side_effect=FileNotFoundError
+        ) as remove:
+            remote_cache.evict()
+        remove.assert_called_once_with(part_path)
+
+    def test_redirect_without_md5(self):
+        build = self.create_remote_build()
+        build.md5 = None
+        db.session.commit()
+        with patch("spkrepo.remote_cache.fetch") as fetch:
+            response = self.client.get(url_for("nas.data", path=build.path))
+        self.assertStatus(response, 302)
+        self.assertEqual(
+            unquote(response.location), f"https://storage.test/{build.path}?expires=900"
+        )
+        fetch.assert_not_called()
+
+    def test_local_file_preferred(self):
+        build = BuildFactory()
+        db.session.commit()
+        response = self.client.get(url_for("nas.data", path=build.path))
+        self.assert200(response)
+        response.close()
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_redirect_to_cdn(self):
+        self.app.config.update(
+            REMOTE_CACHE_PATH=None, PACKAGES_CDN_HOST="packages.example.com"
+        )
+        build = self.create_remote_build()
+        response = self.client.get(url_for("nas.data", path=build.path))
+        self.assertStatus(response, 302)
+        self.assertEqual(
+            response.location, "https://packages.example.com/" + quote(build.path)
+        )
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=3600")
+
+    def test_redirect_to_presigned_url(self):
+        self.app.config.update(REMOTE_CACHE_PATH=None, REMOTE_PRESIGNED_URL_EXPIRES=900)
+        build = self.create_remote_build()
+        response = self.client.get(url_for("nas.data", path=build.path))
+        self.assertStatus(response, 302)
+        self.assertEqual(
+            unquote(response.location), f"https://storage.test/{build.path}?expires=900"
+        )
+        # never cached for longer than the URL is valid
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=450")
+
+    def test_find_build(self):
+        build = self.create_remote_build()
+        self.assertEqual(find_build(build.path, "remote").md5, build.md5)
+        self.assertIsNone(find_build(build.path, "local"))
+        # re-homed by another process
+        build.storage = "local"
+        db.session.commit()
+        self.assertIsNone(find_build(build.path, "remote"))
+        self.assertEqual(find_build(build.path).storage, "local")
@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 import io
 import os
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from flask import current_app
 
 from spkrepo.ext import db
-from spkrepo.models import Build
-from spkrepo.tests.common import BaseTestCase, BuildFactory
-from spkrepo.views.tasks import rehome_from_storage, upload_to_storage
+from spkrepo.models import Build, BuildSidecar
+from spkrepo.tests.common import (
+    OBJECT_STORAGE_CONFIG,
+    BaseTestCase,
+    BuildFactory,
+    FakeObjectStorage,
+)
+from spkrepo.views import tasks
+from spkrepo.views.tasks import (
+    _transfer_progress,
+    rehome_from_storage,
+    upload_builds,
+    upload_to_storage,
+)
 
 
 class UploadToStorageTestCase(BaseTestCase):
@@ -32,6 +43,16 @@ class UploadToStorageTestCase(BaseTestCase):
         db.session.expire_all()
         self.assertEqual(db.session.get(Build, build.id).storage, "local")
 
+    def test_progress_reported_through_task_state(self):
+        task = Mock()
+        task.request.id = "task-id"
+        _transfer_progress(task)(1000, 3000, 500.0)
+        task.update_state.assert_called_once_with(
+            state="PROGRESS", meta={"done": 1000, "total": 3000, "rate": 500.0}
+        )
+        task.request.id = None
+        self.assertIsNone(_transfer_progress(task))
+
     def test_skipped_when_not_signed(self):
         build = BuildFactory(signed=False)
         db.session.commit()
@@ -65,23 +86,160 @@ class UploadToStorageTestCase(BaseTestCase):
         self.assertEqual(result["status"], "skipped")
 
 
+class UploadBuildsTestCase(BaseTestCase):
+    """Tests for upload_builds Celery task."""
+
+    def test_uploads_and_purges_once(self):
+        builds = BuildFactory.create_batch(3, signed=True)
+        unsigned = BuildFactory(signed=False)
+        db.session.commit()
+        build_ids = [b.id for b in builds] + [unsigned.id]
+        paths = {b.id: b.path for b in builds}
+        data_path = current_app.config["DATA_PATH"]
+        with (
+            patch("spkrepo.views.tasks.storage.upload", return_value=True) as upload,
+            patch("spkrepo.views.tasks.storage.purge_cdn") as purge_cdn,
+        ):
+            result = upload_builds(build_ids)
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(len(result["uploaded"]), 3)
+        self.assertEqual(result["failed"], [[str(unsigned), "Build is not signed"]])
+        self.assertEqual(upload.call_count, 3)
+        # the catalog, then every uploaded build at once
+        self.assertEqual(purge_cdn.call_count, 2)
+        purge_cdn.assert_any_call(keys=["catalog"])
+        self.assertEqual(
+            sorted(purge_cdn.call_args.args), sorted("/" + p for p in paths.values())
+        )
+        db.session.expire_all()
+        for build_id, path in paths.items():
+            build = db.session.get(Build, build_id)
+            self.assertEqual(build.storage, "remote")
+            self.assertIsNotNone(build.member_index)
+            self.assertFalse(os.path.exists(os.path.join(data_path, path)))
+            self.assertEqual(build.sidecar.calculated["md5"], build.md5)
+
+    def test_upload_failure_keeps_build_local(self):
+        ok, failing = BuildFactory.create_batch(2, signed=True)
+        db.session.commit()
+        data_path = current_app.config["DATA_PATH"]
+        failing_path = os.path.join(data_path, failing.path)
+        with (
+            patch(
+                "spkrepo.views.tasks.storage.upload",
+                side_effect=lambda path, key: path != failing_path,
+            ),
+            patch("spkrepo.views.tasks.storage.purge_cdn") as purge_cdn,
+        ):
+            result = upload_builds([ok.id, failing.id])
+
+        self.assertEqual(result["uploaded"], [str(ok)])
+        self.assertEqual(
+            result["failed"], [[str(failing), "Upload to Object Storage failed"]]
+        )
+        purge_cdn.assert_called_with("/" + ok.path)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Build, failing.id).storage, "local")
+        self.assertTrue(os.path.exists(failing_path))
+        self.assertIsNone(db.session.get(Build, failing.id).sidecar)
+
+    def test_commits_in_chunks(self):
+        builds = BuildFactory.create_batch(5, signed=True)
+        db.session.commit()
+        with (
+            patch.object(tasks, "UPLOAD_COMMIT_SIZE", 2),
+            patch("spkrepo.views.tasks.storage.upload", return_value=True),
+            patch("spkrepo.views.tasks.storage.purge_cdn"),
+            patch.object(db.session, "commit", wraps=db.session.commit) as commit,
+        ):
+            result = upload_builds([b.id for b in builds])
+        self.assertEqual(len(result["uploaded"]), 5)
+        self.assertEqual(commit.call_count, 3)
+
+
 class RehomeFromStorageTestCase(BaseTestCase):
     """Tests for rehome_from_storage Celery task."""
 
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(
+            OBJECT_STORAGE_CONFIG, OBJECT_STORAGE_MULTIPART_CHUNKSIZE=4096
+        )
+        self.fake = FakeObjectStorage()
+        patcher = patch("spkrepo.storage._client", return_value=self.fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_remote_build(self):
+        build = BuildFactory()
+        db.session.commit()
+        path = os.path.join(self.app.config["DATA_PATH"], build.path)
+        with io.open(path, "rb") as f:
+            self.content = f.read()
+        self.fake.objects[build.path] = self.content
+        os.remove(path)
+        build.storage = "remote"
+        db.session.commit()
+        return build, path
+
+    def rehome(self, build):
+        with patch.object(
+            rehome_from_storage,
+            "retry",
+            side_effect=rehome_from_storage.MaxRetriesExceededError,
+        ):
+            return rehome_from_storage(build.id, str(build))
+
     def test_success_sets_storage_local(self):
-        build = BuildFactory(storage="remote")
+        build, path = self.create_remote_build()
+        build.sidecar = BuildSidecar(info={}, derived={}, calculated={})
         db.session.commit()
-        with patch("spkrepo.views.tasks.storage.download", return_value=True):
-            result = rehome_from_storage(build.id, str(build))
+        result = self.rehome(build)
         self.assertEqual(result["status"], "ok")
+        with io.open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(path + ".part"))
+        self.assertNotIn(build.path, self.fake.objects)
         db.session.expire_all()
         self.assertEqual(db.session.get(Build, build.id).storage, "local")
+        self.assertIsNone(db.session.get(BuildSidecar, build.id))
+
+    def test_resume(self):
+        build, path = self.create_remote_build()
+        with io.open(path + ".part", "wb") as f:
+            f.write(self.content[:5000])
+        self.assertEqual(self.rehome(build)["status"], "ok")
+        self.assertEqual(self.fake.ranges[0][0], 5000)
+        with io.open(path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_already_in_place(self):
+        build, path = self.create_remote_build()
+        with io.open(path, "wb") as f:
+            f.write(self.content)
+        self.assertEqual(self.rehome(build)["status"], "ok")
+        self.assertEqual(self.fake.ranges, [])
+        self.assertNotIn(build.path, self.fake.objects)
+
+    def test_corrupt_download_keeps_remote(self):
+        build, path = self.create_remote_build()
+        corrupt = bytearray(self.content)
+        corrupt[-1] ^= 0xFF
+        self.fake.objects[build.path] = bytes(corrupt)
+        result = self.rehome(build)
+        self.assertEqual(result["status"], "error")
+        self.assertIn("md5 mismatch", result["error"])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".part"))
+        self.assertIn(build.path, self.fake.objects)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Build, build.id).storage, "remote")
 
     def test_download_failure_keeps_storage_remote(self):
-        build = BuildFactory(storage="remote")
-        db.session.commit()
-        with patch("spkrepo.views.tasks.storage.download", return_value=False):
-            result = rehome_from_storage(build.id, str(build))
+        build, path = self.create_remote_build()
+        del self.fake.objects[build.path]
+        result = self.rehome(build)
         self.assertEqual(result["status"], "error")
         db.session.expire_all()
         self.assertEqual(db.session.get(Build, build.id).storage, "remote")
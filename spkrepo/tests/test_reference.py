@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from flask import g
+from sqlalchemy import event
+
+from spkrepo import reference
+from spkrepo.ext import cache, db
+from spkrepo.models import Architecture, Firmware, Service
+from spkrepo.tests.common import BaseTestCase
+from spkrepo.utils import populate_db
+
+
+class ReferenceTestCase(BaseTestCase):
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        self.addCleanup(
+            event.remove, db.engine, "before_cursor_execute", before_cursor_execute
+        )
+        return statements
+
+    def test_lookups(self):
+        self.assertEqual(reference.architecture("88f628x").code, "88f628x")
+        self.assertEqual(reference.architecture("88f6281", syno=True).code, "88f628x")
+        self.assertEqual(reference.firmware(1594).version, "3.1")
+        self.assertEqual(reference.language("fre").name, "French")
+        self.assertEqual(reference.service("mysql").code, "mysql")
+        self.assertIsNone(reference.architecture("unknown"))
+        self.assertIsNone(reference.firmware(1))
+
+    def test_lookups_do_not_query(self):
+        reference.language("enu")
+        statements = self.count_queries()
+        for _ in range(10):
+            reference.architecture("cedarview")
+            reference.firmware(4458)
+            reference.language("enu")
+            reference.service("apache-web")
+        self.assertEqual(statements, [])
+
+    def test_merged_into_session(self):
+        architecture = reference.architecture("qoriq")
+        self.assertIn(architecture, db.session)
+        self.assertIs(architecture, Architecture.find("qoriq"))
+
+    def test_invalidated_on_commit(self):
+        self.assertIsNone(reference.firmware(64570))
+        db.session.add(Firmware(version="7.2", build=64570, type="dsm"))
+        self.assertIsNone(reference.firmware(64570))
+        db.session.commit()
+        self.assertEqual(reference.firmware(64570).version, "7.2")
+
+        db.session.delete(Service.find("mysql"))
+        db.session.commit()
+        self.assertIsNone(reference.service("mysql"))
+
+    def test_invalidated_by_populate_db(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        reference.invalidate()
+        self.assertIsNone(reference.architecture("qoriq"))
+        populate_db()
+        db.session.commit()
+        self.assertEqual(reference.architecture("qoriq").code, "qoriq")
+        self.assertEqual(reference.service("mysql").code, "mysql")
+
+    def test_invalidated_by_other_process(self):
+        reference.language("enu")
+        db.session.execute(Service.__table__.insert().values([{"code": "ssh"}]))
+        db.session.commit()
+        self.assertIsNone(reference.service("ssh"))
+
+        # another process replaced the token, seen from the next app context
+        cache.set(reference.TOKEN_CACHE_KEY, "other", timeout=0)
+        self.assertIsNone(reference.service("ssh"))
+        g.pop("reference_data_token")
+        self.assertEqual(reference.service("ssh").code, "ssh")
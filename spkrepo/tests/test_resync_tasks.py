@@ -6,15 +6,17 @@ from unittest.mock import MagicMock, patch
 from flask import current_app
 
 from spkrepo.ext import cache, db
-from spkrepo.models import Build
+from spkrepo.models import Build, BuildSidecar
 from spkrepo.tests.common import (
+    OBJECT_STORAGE_CONFIG,
     Architecture,
     BaseTestCase,
     BuildFactory,
+    FakeObjectStorage,
     create_info,
     create_spk,
 )
-from spkrepo.views.tasks import resync_build_file, resync_build_metadata
+from spkrepo.views.tasks import _read_sidecar, resync_build_file, resync_build_metadata
 
 
 def _build_stub(build_id, path=None):
@@ -177,6 +179,60 @@ class ResyncBuildMetadataTaskTestCase(BaseTestCase):
         # No path opened more than once
         self.assertEqual(len(spk_opens), len(set(spk_opens)))
 
+    def test_sibling_sidecars_read_from_table(self):
+        build = BuildFactory(architectures=[Architecture.find("88f628x")])
+        siblings = [
+            BuildFactory(version=build.version, architectures=[Architecture.find(a)])
+            for a in ["cedarview", "qoriq"]
+        ]
+        db.session.commit()
+        data_path = current_app.config["DATA_PATH"]
+        for sibling in siblings:
+            spk_path = os.path.join(data_path, sibling.path)
+            sibling.sidecar = BuildSidecar.from_dict(
+                _read_sidecar(spk_path, sibling.path)
+            )
+        db.session.commit()
+
+        opened_paths = []
+        original_open = io.open
+
+        def counting_open(path, *args, **kwargs):
+            opened_paths.append(str(path))
+            return original_open(path, *args, **kwargs)
+
+        with patch("spkrepo.views.tasks.io.open", side_effect=counting_open):
+            result = resync_build_metadata(build.id, str(build))
+
+        self.assertEqual(result["status"], "ok")
+        spk_opens = [p for p in opened_paths if p.endswith((".spk", ".json"))]
+        self.assertEqual(spk_opens, [os.path.join(data_path, build.path)])
+
+    def test_remote_build_read_with_range_requests(self):
+        build = BuildFactory(signed=True)
+        db.session.commit()
+        original_display = build.version.displaynames["enu"].displayname
+        spk_path = os.path.join(current_app.config["DATA_PATH"], build.path)
+        with io.open(spk_path, "rb") as f:
+            fake_storage = FakeObjectStorage({build.path: f.read()})
+        os.remove(spk_path)
+        build.storage = "remote"
+        build.version.displaynames["enu"].displayname = "Corrupted"
+        db.session.commit()
+
+        current_app.config.update(OBJECT_STORAGE_CONFIG)
+        with patch("spkrepo.storage._client", return_value=fake_storage):
+            result = resync_build_metadata(build.id, str(build))
+
+        self.assertEqual(result["status"], "ok")
+        self.assertTrue(fake_storage.ranges)
+        db.session.refresh(build.version)
+        self.assertEqual(
+            build.version.displaynames["enu"].displayname, original_display
+        )
+        self.assertEqual(build.storage, "remote")
+        self.assertFalse(os.path.exists(spk_path))
+
 
 class ResyncBuildFileTaskTestCase(BaseTestCase):
     """Unit tests for the resync_build_file Celery task."""
@@ -202,6 +258,25 @@ class ResyncBuildFileTaskTestCase(BaseTestCase):
         self.assertIsNotNone(refreshed.size)
         self.assertGreater(refreshed.size, 0)
 
+    def test_from_sidecar(self):
+        build = BuildFactory(storage="remote")
+        db.session.commit()
+        build.sidecar = BuildSidecar(
+            info={},
+            derived={},
+            calculated={"md5": "0" * 32, "size": 1024, "member_index": None},
+        )
+        db.session.commit()
+        os.remove(os.path.join(current_app.config["DATA_PATH"], build.path))
+
+        result = resync_build_file(build.id, str(build))
+
+        self.assertEqual(result["status"], "ok")
+        db.session.expire_all()
+        refreshed = db.session.get(Build, build.id)
+        self.assertEqual(refreshed.md5, "0" * 32)
+        self.assertEqual(refreshed.size, 1024)
+
     def test_skipped_when_build_not_found(self):
         result = resync_build_file(999999, "nonexistent")
         self.assertEqual(result["status"], "skipped")
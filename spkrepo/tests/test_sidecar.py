@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+import io
+import json
+import os
+
+from flask import current_app
+
 from spkrepo.ext import db
-from spkrepo.models import Build
+from spkrepo.models import Build, BuildSidecar
 from spkrepo.tests.common import BaseTestCase, BuildFactory
 from spkrepo.utils import apply_sidecar_to_db
 
@@ -93,3 +99,40 @@ class ApplySidecarToDBTestCase(BaseTestCase):
         apply_sidecar_to_db(db.session, build, self._make_sidecar())
         assert build.changelog == "Initial release"
         assert build.signed is True
+
+
+class LoadSidecarTestCase(BaseTestCase):
+    sidecar = {
+        "info": {"version": "1.2.3-4"},
+        "derived": {"license": "MIT"},
+        "calculated": {"md5": "d41d8cd98f00b204e9800998ecf8427e", "size": 1024},
+    }
+
+    def test_from_table(self):
+        build = BuildFactory(storage="remote")
+        build.sidecar = BuildSidecar.from_dict(self.sidecar)
+        db.session.commit()
+        db.session.expire_all()
+        assert db.session.get(Build, build.id).load_sidecar() == self.sidecar
+
+    def test_from_legacy_file(self):
+        build = BuildFactory(storage="remote")
+        db.session.commit()
+        sidecar_path = os.path.join(current_app.config["DATA_PATH"], build.path)
+        with io.open(sidecar_path + ".json", "w", encoding="utf-8") as f:
+            json.dump(self.sidecar, f)
+        assert build.load_sidecar() == self.sidecar
+
+    def test_none(self):
+        build = BuildFactory()
+        db.session.commit()
+        assert build.load_sidecar() is None
+
+    def test_deleted_with_build(self):
+        build = BuildFactory(storage="remote")
+        build.sidecar = BuildSidecar.from_dict(self.sidecar)
+        db.session.commit()
+        build_id = build.id
+        db.session.delete(build)
+        db.session.commit()
+        assert db.session.get(BuildSidecar, build_id) is None
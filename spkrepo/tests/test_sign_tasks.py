@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tarfile
+from unittest.mock import patch
+
+from flask import current_app
+
+from spkrepo import storage
+from spkrepo.exceptions import SPKSignError
+from spkrepo.ext import db
+from spkrepo.models import Build
+from spkrepo.tests.common import BaseTestCase, BuildFactory
+from spkrepo.views.nas import CATALOG_SURROGATE_KEY
+from spkrepo.views.tasks import sign_build, sign_builds
+
+
+class SignBuildTestCase(BaseTestCase):
+    """Tests for sign_build Celery task."""
+
+    def setUp(self):
+        super().setUp()
+        current_app.config["GNUPG_PATH"] = "gnupghome"
+
+    def test_success_marks_build_signed(self):
+        build = BuildFactory(signed=False)
+        db.session.commit()
+        with patch(
+            "spkrepo.utils.SPK._generate_signature",
+            return_value="timestamped signature",
+        ):
+            result = sign_build(build.id, str(build))
+        self.assertEqual(result["status"], "ok")
+        db.session.expire_all()
+        build = db.session.get(Build, build.id)
+        self.assertTrue(build.signed)
+        self.assertFalse(build.active)
+        path = os.path.join(current_app.config["DATA_PATH"], build.path)
+        with tarfile.open(path, "r:") as tar:
+            self.assertIn("syno_signature.asc", tar.getnames())
+        self.assertEqual(build.size, os.path.getsize(path))
+        self.assertEqual(build.member_index["size"], build.size)
+        self.assertIn("syno_signature.asc", build.member_index["members"])
+
+    def test_signed_file_purged(self):
+        build = BuildFactory(signed=False)
+        db.session.commit()
+        with (
+            patch(
+                "spkrepo.utils.SPK._generate_signature",
+                return_value="timestamped signature",
+            ),
+            patch("spkrepo.storage.purge_data_files") as purge_data_files,
+        ):
+            sign_build(build.id, str(build))
+        purge_data_files.assert_called_once_with(build.path)
+
+    def test_sign_failure_keeps_build_unsigned(self):
+        build = BuildFactory(signed=False)
+        db.session.commit()
+        with (
+            patch(
+                "spkrepo.utils.SPK._generate_signature",
+                side_effect=SPKSignError("Timestamp server did not respond in time"),
+            ),
+            patch.object(
+                sign_build, "retry", side_effect=sign_build.MaxRetriesExceededError
+            ),
+        ):
+            result = sign_build(build.id, str(build))
+        self.assertEqual(result["status"], "error")
+        self.assertIn("Timestamp server", result["error"])
+        db.session.expire_all()
+        self.assertFalse(db.session.get(Build, build.id).signed)
+
+    def test_not_configured(self):
+        current_app.config["GNUPG_PATH"] = None
+        build = BuildFactory(signed=False)
+        db.session.commit()
+        result = sign_build(build.id, str(build))
+        self.assertEqual(result["status"], "error")
+        self.assertIn("GNUPG_PATH", result["error"])
+
+    def test_remote_build_not_signed(self):
+        build = BuildFactory(signed=False, storage="remote")
+        db.session.commit()
+        result = sign_build(build.id, str(build))
+        self.assertEqual(result["status"], "error")
+        with (
+            io.open(
+                os.path.join(current_app.config["DATA_PATH"], build.path), "rb"
+            ) as f,
+            tarfile.open(fileobj=f, mode="r:") as tar,
+        ):
+            self.assertNotIn("syno_signature.asc", tar.getnames())
+
+
+class SignBuildsTestCase(BaseTestCase):
+    """Tests for sign_builds Celery task."""
+
+    def setUp(self):
+        super().setUp()
+        current_app.config["GNUPG_PATH"] = "gnupghome"
+
+    def _sign_builds(self, build_ids, **kwargs):
+        with (
+            patch("spkrepo.utils.gnupg.GPG"),
+            patch("spkrepo.utils.Signer.sign", **kwargs) as sign,
+        ):
+            return sign_builds(build_ids), sign
+
+    def test_signs_all_builds_with_one_signer(self):
+        builds = [BuildFactory(signed=False) for _ in range(5)]
+        db.session.commit()
+        result, sign = self._sign_builds(
+            [b.id for b in builds], return_value="timestamped signature"
+        )
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual(len(result["signed"]), 5)
+        self.assertEqual(sign.call_count, 5)
+        db.session.expire_all()
+        for build in builds:
+            build = db.session.get(Build, build.id)
+            self.assertTrue(build.signed)
+            path = os.path.join(current_app.config["DATA_PATH"], build.path)
+            self.assertEqual(build.size, os.path.getsize(path))
+
+    def test_already_signed_file_is_recovered(self):
+        build = BuildFactory(signed=False)
+        db.session.commit()
+        path = os.path.join(current_app.config["DATA_PATH"], build.path)
+        with patch(
+            "spkrepo.utils.SPK._generate_signature",
+            return_value="timestamped signature",
+        ):
+            sign_build(build.id, str(build))
+        build.signed = False
+        db.session.commit()
+        size = os.path.getsize(path)
+
+        result, sign = self._sign_builds([build.id], return_value="other signature")
+        self.assertEqual(result["recovered"], [str(build)])
+        sign.assert_not_called()
+        self.assertEqual(os.path.getsize(path), size)
+        db.session.expire_all()
+        self.assertTrue(db.session.get(Build, build.id).signed)
+
+    def test_failures_reported_per_build(self):
+        builds = [BuildFactory(signed=False) for _ in range(2)]
+        remote = BuildFactory(signed=False, storage="remote")
+        db.session.commit()
+        result, _ = self._sign_builds(
+            [b.id for b in builds] + [remote.id],
+            side_effect=SPKSignError("Cannot verify timestamp"),
+        )
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(len(result["failed"]), 2)
+        self.assertEqual(result["skipped"], [str(remote)])
+        self.assertIn("Cannot verify timestamp", result["error"])
+        db.session.expire_all()
+        for build in builds:
+            self.assertFalse(db.session.get(Build, build.id).signed)
+
+    def test_purges_flushed_once(self):
+        current_app.config.update(
+            CDN_PURGE_TOKEN="token", PACKAGES_CDN_HOST="packages.test"
+        )
+        builds = [BuildFactory(signed=False) for _ in range(3)]
+        db.session.commit()
+        build_ids = [b.id for b in builds]
+        keys = [storage.data_surrogate_key(b.path) for b in builds]
+        with (
+            patch("spkrepo.app.flush_cdn_purges.delay") as delay,
+            current_app.app_context(),
+        ):
+            result, _ = self._sign_builds(
+                build_ids, return_value="timestamped signature"
+            )
+            self.assertEqual(len(result["signed"]), 3)
+            delay.assert_not_called()
+        delay.assert_called_once()
+        url_paths, purged_keys = delay.call_args.args
+        self.assertEqual(url_paths, [])
+        self.assertEqual(sorted(purged_keys), sorted(keys + [CATALOG_SURROGATE_KEY]))
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, patch
+
+from flask import g
+
+from spkrepo import storage
+from spkrepo.tests.common import OBJECT_STORAGE_CONFIG, BaseTestCase
+from spkrepo.views.tasks import flush_cdn_purges
+
+
+class ClientTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(OBJECT_STORAGE_CONFIG)
+        self.addCleanup(storage._reset_clients)
+
+    def test_reused(self):
+        client = storage._client()
+        self.assertIs(storage._client(), client)
+        self.assertEqual(client.meta.config.max_pool_connections, 64)
+        self.assertTrue(client.meta.config.tcp_keepalive)
+
+    def test_config_change(self):
+        client = storage._client()
+        self.app.config["OBJECT_STORAGE_PACKAGES_ENDPOINT"] = "https://other.test"
+        other = storage._client()
+        self.assertIsNot(other, client)
+        self.assertEqual(other.meta.endpoint_url, "https://other.test")
+
+    def test_reset_after_fork(self):
+        client = storage._client()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            os.close(read)
+            os.write(write, b"1" if storage._client() is not client else b"0")
+            os._exit(0)
+        os.close(write)
+        with os.fdopen(read, "rb") as f:
+            self.assertEqual(f.read(), b"1")
+        os.waitpid(pid, 0)
+        self.assertIs(storage._client(), client)
+
+
+class TransferTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(OBJECT_STORAGE_CONFIG)
+        self.client = Mock()
+        patcher = patch("spkrepo.storage._client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(self.app.config["DATA_PATH"], "file.spk")
+        with open(self.path, "wb") as f:
+            f.write(b"x" * 3000)
+
+    def test_upload(self):
+        self.app.config["OBJECT_STORAGE_MAX_CONCURRENCY"] = 4
+
+        def upload_file(path, bucket, key, Callback, Config):
+            for _ in range(3):
+                Callback(1000)
+
+        self.client.upload_file.side_effect = upload_file
+        progress = Mock()
+        self.assertTrue(storage.upload(self.path, "file.spk", progress))
+        config = self.client.upload_file.call_args.kwargs["Config"]
+        self.assertEqual(config.max_concurrency, 4)
+        self.assertEqual(config.multipart_threshold, 16 * 1024 * 1024)
+        self.assertEqual(config.multipart_chunksize, 8 * 1024 * 1024)
+        # reports are throttled, the last one is always sent
+        progress.assert_called_once()
+        self.assertEqual(progress.call_args.args[:2], (3000, 3000))
+
+    def test_download(self):
+        self.client.head_object.return_value = {"ContentLength": 3000}
+        self.client.download_file.side_effect = (
+            lambda bucket, key, path, Callback, Config: Callback(3000)
+        )
+        progress = Mock()
+        path = os.path.join(self.app.config["DATA_PATH"], "rehomed", "file.spk")
+        self.assertTrue(storage.download("file.spk", path, progress))
+        self.assertEqual(progress.call_args.args[:2], (3000, 3000))
+
+    def test_progress_interval(self):
+        progress = Mock()
+        callback = storage.TransferProgress(3000, progress, interval=0)
+        for _ in range(3):
+            callback(1000)
+        self.assertEqual(
+            [c.args[0] for c in progress.call_args_list], [1000, 2000, 3000]
+        )
+
+
+class _CDNHandler(BaseHTTPRequestHandler):
+    """CDN API stand-in recording purges, failing those of ``/fail`` paths."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.requests.append(
+            (self.path, self.headers["Fastly-Key"], self.headers["Surrogate-Key"])
+        )
+        status = 500 if self.path.endswith("/fail") else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PurgeTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _CDNHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.app.config.update(
+            CDN_PURGE_TOKEN="token",
+            PACKAGES_CDN_HOST="packages.test",
+            CDN_API_URL=f"http://127.0.0.1:{self.server.server_port}",
+            CDN_SERVICE_ID="service",
+            CDN_PURGE_BATCH_SIZE=2,
+        )
+        g.pop("cdn_purges", None)
+
+    def test_queued_until_flushed(self):
+        storage.purge_cdn("/a.spk", "/b.spk")
+        storage.purge_cdn("/a.spk", keys=["catalog"])
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(storage.pending_purges(), (["/a.spk", "/b.spk"], ["catalog"]))
+        self.assertEqual(storage.pending_purges(), ([], []))
+
+    def test_not_configured(self):
+        self.app.config["CDN_PURGE_TOKEN"] = None
+        storage.purge_cdn("/a.spk", keys=["catalog"])
+        self.assertEqual(storage.pending_purges(), ([], []))
+
+    def test_purge_data_files(self):
+        storage.purge_data_files("a/1/icon_72.png", "a b.spk")
+        self.assertEqual(
+            storage.pending_purges(), ([], ["data/a/1/icon_72.png", "data/a%20b.spk"])
+        )
+
+    def test_queued_at_teardown(self):
+        with (
+            patch("spkrepo.app.flush_cdn_purges.delay") as delay,
+            self.app.app_context(),
+        ):
+            storage.purge_cdn("/a.spk", keys=["catalog"])
+        delay.assert_called_once_with(["/a.spk"], ["catalog"])
+
+    def test_sent_when_not_queued(self):
+        with (
+            patch(
+                "spkrepo.app.flush_cdn_purges.delay",
+                side_effect=OSError("Broker unreachable"),
+            ),
+            self.app.app_context(),
+        ):
+            storage.purge_cdn("/a.spk")
+        self.assertEqual(
+            self.server.requests, [("/purge/packages.test/a.spk", "token", None)]
+        )
+
+    def test_sent_from_flush(self):
+        with (
+            patch("spkrepo.app.current_task") as task,
+            patch("spkrepo.app.flush_cdn_purges.delay") as delay,
+            self.app.app_context(),
+        ):
+            task.name = flush_cdn_purges.name
+            storage.purge_cdn("/a.spk")
+        delay.assert_not_called()
+        self.assertEqual(
+            self.server.requests, [("/purge/packages.test/a.spk", "token", None)]
+        )
+
+    def test_send(self):
+        failed = storage.send_purges(["/a.spk"], ["k1", "k2", "k3"])
+        self.assertEqual(failed, ([], []))
+        self.assertEqual(
+            self.server.requests,
+            [
+                ("/purge/packages.test/a.spk", "token", None),
+                ("/service/service/purge", "token", "k1 k2"),
+                ("/service/service/purge", "token", "k3"),
+            ],
+        )
+
+    def test_retry_failed_only(self):
+        with patch.object(
+            flush_cdn_purges,
+            "retry",
+            side_effect=flush_cdn_purges.MaxRetriesExceededError,
+        ) as retry:
+            result = flush_cdn_purges(["/a.spk", "/fail"], ["catalog"])
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(result["failed"], ["/fail"])
+        self.assertEqual(retry.call_args.kwargs["args"], (["/fail"], []))
+        self.assertEqual(retry.call_args.kwargs["max_retries"], 5)
+        self.assertEqual(len(self.server.requests), 3)
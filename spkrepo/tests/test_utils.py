@@ -1,24 +1,33 @@
 # -*- coding: utf-8 -*-
 import io
 import json
+import os
 import tarfile
+import threading
 
-from mock import Mock
+from mock import Mock, patch
 
-from spkrepo.exceptions import SPKParseError
+from spkrepo.exceptions import SPKParseError, SPKSignError
 from spkrepo.ext import db
 from spkrepo.models import Architecture, Package
 from spkrepo.tests.common import (
+    OBJECT_STORAGE_CONFIG,
     BaseTestCase,
     BuildFactory,
+    FakeObjectStorage,
     PackageFactory,
     create_info,
     create_spk,
 )
 from spkrepo.utils import (
     SPK,
+    Signer,
     assert_version_metadata_matches_db,
     extract_version_metadata,
+    load_remote_spk,
+    load_spk,
+    member_index_matches,
+    package_lock,
 )
 
 
@@ -383,6 +392,275 @@ class SPKUnsignTestCase(BaseTestCase):
         self.assertEqual("Not signed", str(cm.exception))
 
 
+class SignerTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch("spkrepo.utils.gnupg.GPG")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_timestamp_with_backoff(self):
+        signer = Signer("timestamp_url", "gnupghome", retries=3, backoff=0.5)
+        signer._timestamp = Mock(
+            side_effect=[
+                SPKSignError("Timestamp server did not respond in time"),
+                SPKSignError("Timestamp server returned with status code 502"),
+                "timestamped signature",
+            ]
+        )
+        with patch("spkrepo.utils.time.sleep") as sleep:
+            self.assertEqual(signer.sign(io.BytesIO(b"data")), "timestamped signature")
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.5, 1.0])
+        signer.gpg.sign_file.assert_called_once()
+
+    def test_gives_up_after_retries(self):
+        signer = Signer("timestamp_url", "gnupghome", retries=1, backoff=0)
+        signer._timestamp = Mock(side_effect=SPKSignError("Cannot verify timestamp"))
+        with self.assertRaises(SPKSignError):
+            signer.sign(io.BytesIO(b"data"))
+        self.assertEqual(signer._timestamp.call_count, 2)
+
+    def test_sign_spk_with_shared_signer(self):
+        build = BuildFactory.build()
+        signer = Signer("timestamp_url", "gnupghome")
+        signer._timestamp = Mock(return_value="timestamped signature")
+        with create_spk(build) as f:
+            spk = SPK(f)
+            spk.sign(signer=signer)
+            with tarfile.open(fileobj=f, mode="r:") as tar:
+                self.assertIn("syno_signature.asc", tar.getnames())
+        self.assertEqual(spk.signature, "timestamped signature")
+
+
+class LoadSPKTestCase(BaseTestCase):
+    def _write_spk(self, build, **kwargs):
+        path = os.path.join(self.app.config["DATA_PATH"], "cached.spk")
+        with create_spk(build, **kwargs) as spk_stream, io.open(path, "wb") as f:
+            f.write(spk_stream.read())
+        return path
+
+    def test_metadata_reused_when_file_unchanged(self):
+        build = BuildFactory.build(version__upgrade_wizard=True)
+        path = self._write_spk(build)
+        with io.open(path, "rb") as f:
+            first = load_spk(f)
+        with patch("spkrepo.utils.SPK.__init__") as init, io.open(path, "rb") as f:
+            second = load_spk(f)
+        init.assert_not_called()
+        self.assertEqual(first.info, second.info)
+        self.assertEqual(first.wizards, second.wizards)
+        self.assertEqual(first.license, second.license)
+        self.assertIsNone(second.signature)
+        self.assertEqual(
+            {k: v.getvalue() for k, v in first.icons.items()},
+            {k: v.getvalue() for k, v in second.icons.items()},
+        )
+        self.assertEqual(
+            extract_version_metadata(first), extract_version_metadata(second)
+        )
+
+    def test_signing_invalidates_cached_metadata(self):
+        build = BuildFactory.build()
+        path = self._write_spk(build)
+        with io.open(path, "rb+") as f:
+            spk = load_spk(f)
+            spk._generate_signature = Mock(return_value="timestamped signature")
+            spk.sign("timestamp_url", "gnupghome")
+        with io.open(path, "rb") as f:
+            self.assertEqual(load_spk(f).signature, "timestamped signature")
+        with io.open(path, "rb+") as f:
+            load_spk(f).unsign()
+        with io.open(path, "rb") as f:
+            self.assertIsNone(load_spk(f).signature)
+
+    def test_parse_error_not_cached(self):
+        path = os.path.join(self.app.config["DATA_PATH"], "invalid.spk")
+        with io.open(path, "wb") as f:
+            f.write(b"not a tar file")
+        for _ in range(2):
+            with io.open(path, "rb") as f, self.assertRaises(SPKParseError):
+                load_spk(f)
+
+
+class MemberIndexTestCase(BaseTestCase):
+    def _write_spk(self, build, **kwargs):
+        build.path = "indexed.spk"
+        path = os.path.join(self.app.config["DATA_PATH"], build.path)
+        with create_spk(build, **kwargs) as spk_stream, io.open(path, "wb") as f:
+            f.write(spk_stream.read())
+        return path
+
+    def test_calculate_member_index(self):
+        build = BuildFactory.build()
+        path = self._write_spk(build)
+        index = build.calculate_member_index()
+        self.assertEqual(index["size"], os.path.getsize(path))
+        with tarfile.open(path) as archive:
+            for member in archive.getmembers():
+                self.assertEqual(
+                    index["members"][member.name], [member.offset_data, member.size]
+                )
+
+    def test_parse_with_member_index(self):
+        build = BuildFactory.build(
+            version__install_wizard=True, version__license="License"
+        )
+        path = self._write_spk(build, signature="signature")
+        index = build.calculate_member_index()
+        with io.open(path, "rb") as f:
+            expected = SPK(f)
+            with patch("spkrepo.utils.tarfile.open") as tar_open:
+                spk = SPK(f, member_index=index)
+        tar_open.assert_not_called()
+        self.assertEqual(spk.info, expected.info)
+        self.assertEqual(spk.license, expected.license)
+        self.assertEqual(spk.signature, "signature")
+        self.assertEqual(spk.wizards, {"install"})
+        self.assertEqual(
+            {k: v.getvalue() for k, v in spk.icons.items()},
+            {k: v.getvalue() for k, v in expected.icons.items()},
+        )
+
+    def test_stale_member_index_ignored(self):
+        build = BuildFactory.build()
+        path = self._write_spk(build)
+        index = build.calculate_member_index()
+        index["members"]["INFO"] = [0, 10]
+        index["size"] += 512
+        with io.open(path, "rb") as f:
+            spk = SPK(f, member_index=index)
+        self.assertEqual(spk.info["package"], build.version.package.name)
+
+    def test_member_index_stale_after_signing(self):
+        build = BuildFactory.build()
+        path = self._write_spk(build)
+        index = build.calculate_member_index()
+        with tarfile.open(path, "a") as archive:
+            info = tarfile.TarInfo(SPK.SIGNATURE_FILENAME)
+            info.size = len(b"signature")
+            archive.addfile(info, io.BytesIO(b"signature"))
+        # tar pads archives to whole records, the size is often unchanged
+        index["size"] = os.path.getsize(path)
+        with io.open(path, "rb") as f:
+            self.assertFalse(member_index_matches(f, index))
+            self.assertEqual(SPK(f, member_index=index).signature, "signature")
+
+    def test_member_index_matches(self):
+        build = BuildFactory.build()
+        path = self._write_spk(build, signature="signature")
+        index = build.calculate_member_index()
+        with io.open(path, "rb") as f:
+            self.assertTrue(member_index_matches(f, index))
+            self.assertEqual(f.tell(), 0)
+
+
+def with_large_package(data, size=4 * 1024 * 1024):
+    """Return the SPK `data` with a `size` bytes package.tgz."""
+    output = io.BytesIO()
+    with (
+        tarfile.open(fileobj=io.BytesIO(data)) as source,
+        tarfile.open(fileobj=output, mode="w") as spk,
+    ):
+        for member in source.getmembers():
+            fileobj = source.extractfile(member) if member.isfile() else None
+            if member.name == "package.tgz":
+                member.size = size
+                fileobj = io.BytesIO(os.urandom(size))
+            spk.addfile(member, fileobj)
+    return output.getvalue()
+
+
+class LoadRemoteSPKTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(OBJECT_STORAGE_CONFIG)
+        self.storage = FakeObjectStorage()
+        patcher = patch("spkrepo.storage._client", return_value=self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_small_members_only(self):
+        build = BuildFactory.build(version__install_wizard=True)
+        with create_spk(build, signature="signature") as f:
+            data = with_large_package(f.read())
+        self.storage.objects["btsync.spk"] = data
+
+        spk = load_remote_spk("btsync.spk")
+
+        self.assertEqual(spk.info["package"], build.version.package.name)
+        self.assertEqual(spk.signature, "signature")
+        self.assertEqual(spk.wizards, {"install"})
+        self.assertIn("72", spk.icons)
+        self.assertGreater(len(data), 4 * 1024 * 1024)
+        self.assertLess(spk.stream.bytes_fetched, 64 * 1024)
+
+    def test_reads_members_through_index(self):
+        build = BuildFactory.build()
+        build.path = "btsync.spk"
+        with create_spk(build, signature="signature") as f:
+            data = with_large_package(f.read())
+        with io.open(
+            os.path.join(self.app.config["DATA_PATH"], "btsync.spk"), "wb"
+        ) as f:
+            f.write(data)
+        index = build.calculate_member_index()
+        self.storage.objects["btsync.spk"] = data
+
+        with patch("spkrepo.utils.tarfile.open") as tar_open:
+            spk = load_remote_spk("btsync.spk", index)
+
+        tar_open.assert_not_called()
+        self.assertEqual(spk.info["package"], build.version.package.name)
+        self.assertEqual(spk.signature, "signature")
+        self.assertLess(spk.stream.bytes_fetched, 64 * 1024)
+
+    def test_metadata_cached_by_etag(self):
+        with create_spk(BuildFactory.build()) as f:
+            self.storage.objects["btsync.spk"] = f.read()
+        first = load_remote_spk("btsync.spk")
+        requests = len(self.storage.ranges)
+        second = load_remote_spk("btsync.spk")
+        self.assertEqual(len(self.storage.ranges), requests)
+        self.assertEqual(first.info, second.info)
+
+        with create_spk(BuildFactory.build()) as f:
+            self.storage.objects["btsync.spk"] = f.read()
+        self.assertNotEqual(load_remote_spk("btsync.spk").info, first.info)
+
+
+class PackageLockTestCase(BaseTestCase):
+    def _try_lock(self, name, acquired):
+        with self.app.app_context(), package_lock(name):
+            acquired.set()
+
+    def test_same_package_waits(self):
+        acquired = threading.Event()
+        with package_lock("btsync"):
+            thread = threading.Thread(target=self._try_lock, args=("btsync", acquired))
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+
+    def test_other_package_does_not_wait(self):
+        acquired = threading.Event()
+        with package_lock("btsync"):
+            thread = threading.Thread(target=self._try_lock, args=("git", acquired))
+            thread.start()
+            self.assertTrue(acquired.wait(5))
+        thread.join(5)
+
+    def test_postgresql_advisory_lock(self):
+        with patch("spkrepo.utils.db") as db_mock:
+            db_mock.engine.dialect.name = "postgresql"
+            with package_lock("git", "btsync", "git"):
+                pass
+        statements = db_mock.session.execute.call_args_list
+        self.assertEqual(len(statements), 2)
+        self.assertIn("pg_advisory_xact_lock", str(statements[0].args[0]))
+        self.assertNotEqual(statements[0].args[1], statements[1].args[1])
+
+
 class ExtractVersionMetadataTestCase(BaseTestCase):
     """Tests for extract_version_metadata — pure dict extraction, no DB writes."""
 
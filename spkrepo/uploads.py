@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Staging area for resumable chunked uploads.
+
+Each upload session is a file under ``<DATA_PATH>/.uploads`` that chunks are
+appended to, along with a small JSON file recording its owner. Chunks are only
+appended, so any worker process can take the next one without reading the
+staged file; the digests are computed once, when the session is committed.
+"""
+
+import fcntl
+import io
+import json
+import os
+import time
+import uuid
+
+from flask import current_app
+
+from .hashing import hash_file
+
+#: Name of the staging directory under DATA_PATH
+UPLOADS_DIRNAME = ".uploads"
+
+
+class UploadSessionError(Exception):
+    """Chunk rejected because it does not start at the current offset."""
+
+    def __init__(self, offset):
+        super().__init__(f"Expected offset {offset}")
+        self.offset = offset
+
+
+def _staging_path():
+    return os.path.join(current_app.config["DATA_PATH"], UPLOADS_DIRNAME)
+
+
+def data_path(session_id):
+    """Return the path of the staged data of an upload session."""
+    return os.path.join(_staging_path(), session_id)
+
+
+def _meta_path(session_id):
+    return data_path(session_id) + ".json"
+
+
+def temporary_path():
+    """Return the path of a new file in the staging directory, for an SPK
+    stored before it is registered. It is removed along with expired upload
+    sessions if it is left behind."""
+    os.makedirs(_staging_path(), exist_ok=True)
+    return data_path(uuid.uuid4().hex)
+
+
+def create(user_id):
+    """Create an empty upload session owned by `user_id` and return its id."""
+    os.makedirs(_staging_path(), exist_ok=True)
+    session_id = uuid.uuid4().hex
+    io.open(data_path(session_id), "xb").close()
+    with io.open(_meta_path(session_id), "w", encoding="utf-8") as f:
+        json.dump({"user_id": user_id, "created": time.time()}, f)
+    return session_id
+
+
+def owner(session_id):
+    """Return the id of the user owning an upload session, None if it does not
+    exist."""
+    try:
+        with io.open(_meta_path(session_id), "r", encoding="utf-8") as f:
+            return json.load(f)["user_id"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def offset(session_id):
+    """Return the number of bytes received so far."""
+    return os.path.getsize(data_path(session_id))
+
+
+def append(session_id, start, data):
+    """Append a chunk to an upload session.
+
+    :param session_id: id of the upload session
+    :param start: offset of the chunk, must be the current size of the session
+    :param data: chunk content
+    :returns: the new offset
+    :raises UploadSessionError: if `start` is not the current offset
+    """
+    with io.open(data_path(session_id), "rb+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        size = f.seek(0, io.SEEK_END)
+        if start != size:
+            raise UploadSessionError(size)
+        f.write(data)
+    return size + len(data)
+
+
+def digests(session_id):
+    """Return the md5 and sha256 hex digests and size of the staged data,
+    hashed in a single pass."""
+    hashes, size = hash_file(data_path(session_id), ("md5", "sha256"))
+    return hashes["md5"], hashes["sha256"], size
+
+
+def discard(session_id):
+    """Remove an upload session and its staged data."""
+    for path in (data_path(session_id), _meta_path(session_id)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def purge_expired(max_age):
+    """Remove upload sessions older than `max_age` seconds.
+
+    :returns: number of sessions removed
+    """
+    staging_path = _staging_path()
+    if not os.path.isdir(staging_path):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(staging_path):
+        if name.endswith(".json"):
+            continue
+        try:
+            mtime = os.path.getmtime(os.path.join(staging_path, name))
+        except OSError:
+            continue
+        if now - mtime > max_age:
+            discard(name)
+            removed += 1
+    return removed
@@ -7,15 +7,21 @@ import json
 import os
 import re
 import tarfile
+import threading
 import time
 from configparser import ConfigParser
+from contextlib import ExitStack, contextmanager
 
 import gnupg
 import requests
 from flask import current_app
+from requests.adapters import HTTPAdapter
+from sqlalchemy import text
 
+from . import reference, storage
 from .exceptions import SPKParseError, SPKSignError
-from .ext import db
+from .ext import cache, db
+from .hashing import hash_stream
 from .models import (
     Architecture,
     BuildDescription,
@@ -35,10 +41,108 @@ firmware_re = re.compile(r"^(?P<version>\d+\.\d)-(?P<build>\d{3,6})$")
 version_re = re.compile(r"^(?P<upstream_version>.*)-(?P<version>\d+)$")
 
 
+class _MemberReader(io.RawIOBase):
+    """Raw stream over the data of a single archive member."""
+
+    def __init__(self, stream, offset, size):
+        self.stream = stream
+        self.position = offset
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        length = min(len(b), self.remaining)
+        if length <= 0:
+            return 0
+        self.stream.seek(self.position)
+        data = self.stream.read(length)
+        b[: len(data)] = data
+        self.position += len(data)
+        self.remaining -= len(data)
+        return len(data)
+
+
+class _IndexedArchive(object):
+    """Read-only view of a tar archive whose members are located through a
+    stored member index instead of walking the tar headers. Implements the
+    subset of :class:`tarfile.TarFile` used by :class:`SPK`."""
+
+    def __init__(self, stream, members):
+        self.stream = stream
+        self.members = members
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def getnames(self):
+        return list(self.members)
+
+    def extractfile(self, name):
+        offset, size = self.members[name]
+        return io.BufferedReader(_MemberReader(self.stream, offset, size))
+
+
+def member_index_matches(stream, member_index):
+    """Return True if `member_index` still describes the tar archive in
+    `stream`.
+
+    Appending or removing a member often leaves the size of an archive
+    unchanged, as tar pads it to whole records, so the tar header in front of
+    every indexed member is checked as well as the end-of-archive block after
+    the last one. Only these blocks are read.
+
+    :param stream: seekable binary stream of the archive
+    :param member_index: stored member index, see
+                         :func:`~spkrepo.models.read_member_index`
+    """
+    if member_index is None:
+        return False
+    size = stream.seek(0, io.SEEK_END)
+    try:
+        if member_index.get("size") != size:
+            return False
+        end = 0
+        for name, (offset, length) in member_index["members"].items():
+            if offset < tarfile.BLOCKSIZE:
+                return False
+            stream.seek(offset - tarfile.BLOCKSIZE)
+            try:
+                header = tarfile.TarInfo.frombuf(
+                    stream.read(tarfile.BLOCKSIZE), tarfile.ENCODING, "surrogateescape"
+                )
+            except tarfile.HeaderError:
+                return False
+            # names too long for the header are truncated in it
+            if (
+                header.size != length
+                or not header.name
+                or header.name != name[: len(header.name)]
+            ):
+                return False
+            blocks = -(-length // tarfile.BLOCKSIZE)
+            end = max(end, offset + blocks * tarfile.BLOCKSIZE)
+        stream.seek(end)
+        return stream.read(tarfile.BLOCKSIZE) == tarfile.NUL * tarfile.BLOCKSIZE
+    finally:
+        stream.seek(0)
+
+
 class SPK(object):
     """SPK utilities
 
     :param fileobj stream: SPK file stream
+    :param bool verify_checksum: verify the checksum of package.tgz when the
+                                 INFO has one, which reads the whole archive
+    :param dict member_index: member index of the archive, as computed by
+                              :meth:`~spkrepo.models.Build.calculate_member_index`.
+                              Members are then read directly at their offset.
+                              Ignored if it does not match `stream`, see
+                              :func:`member_index_matches`
     """
 
     #: Required keys in the INFO file
@@ -80,7 +184,7 @@ class SPK(object):
     firmware_version_re = re.compile(r"^\d+\.\d$")
     firmware_type_re = re.compile(r"^([a-z]){3,}$")
 
-    def __init__(self, stream):
+    def __init__(self, stream, verify_checksum=True, member_index=None):
         self.info = {}
         self.icons = {}
         self.wizards = set()
@@ -92,9 +196,8 @@ class SPK(object):
         self.conf_privilege = None
         self.conf_resource = None
 
-        self.stream.seek(0)
         try:
-            with tarfile.open(fileobj=self.stream, mode="r:") as spk:
+            with self._open_archive(member_index) as spk:
                 names = spk.getnames()
 
                 # check for required files
@@ -125,50 +228,7 @@ class SPK(object):
                         raise SPKParseError("Wrong syno_signature.asc encoding")
 
                 # read INFO lines
-                for line in spk.extractfile("INFO").readlines():
-                    try:
-                        line = line.decode("utf-8").strip()
-                    except UnicodeDecodeError:
-                        raise SPKParseError("Wrong INFO encoding")
-
-                    if not line:
-                        continue
-
-                    match = self.info_line_re.match(line)
-                    if not match:
-                        raise SPKParseError("Invalid INFO")
-                    key, value = match.group("key"), match.group("value")
-
-                    match = self.icon_info_re.match(key)
-                    if match:
-                        size = match.group("size") or "72"
-                        try:
-                            self.icons[size] = io.BytesIO(
-                                base64.b64decode(value.encode("utf-8"))
-                            )
-                        except binascii.Error:
-                            raise SPKParseError(f"Invalid INFO icon: {key}")
-                        except TypeError:
-                            raise SPKParseError(f"Invalid INFO icon: {key}")
-                    elif key in self.BOOLEAN_INFO:
-                        if value == "yes":
-                            self.info[key] = True
-                        elif value == "no":
-                            self.info[key] = False
-                        else:
-                            raise SPKParseError(f"Invalid INFO boolean: {key}")
-                    elif key == "package":
-                        match = self.package_re.match(value)
-                        if not match:
-                            raise SPKParseError("Invalid INFO package")
-                        self.info[key] = value
-                    else:
-                        self.info[key] = value
-
-                # validate info
-                if not set(self.info.keys()) >= self.REQUIRED_INFO:
-                    missing = ", ".join(self.REQUIRED_INFO - set(self.info.keys()))
-                    raise SPKParseError(f"Missing INFO: {missing}")
+                self._read_info(spk.extractfile("INFO").readlines())
 
                 # read conf files
                 if (
@@ -232,14 +292,9 @@ class SPK(object):
                         raise SPKParseError("Empty conf folder")
 
                 # verify checksum
-                if "checksum" in self.info:
-                    checksum = hashlib.md5()
-                    archive = spk.extractfile("package.tgz")
-                    for chunk in iter(
-                        lambda: archive.read(io.DEFAULT_BUFFER_SIZE), b""
-                    ):
-                        checksum.update(chunk)
-                    if checksum.hexdigest() != self.info["checksum"]:
+                if verify_checksum and "checksum" in self.info:
+                    digests, _ = hash_stream(spk.extractfile("package.tgz"))
+                    if digests["md5"] != self.info["checksum"]:
                         raise SPKParseError("Checksum mismatch")
 
                 # read icon files
@@ -264,12 +319,166 @@ class SPK(object):
             raise SPKParseError("Invalid SPK")
         self.stream.seek(0)
 
-    def sign(self, timestamp_url, gnupghome):
+    def _open_archive(self, member_index):
+        """Open the archive through `member_index` if it matches the stream,
+        by walking its tar headers otherwise."""
+        if member_index_matches(self.stream, member_index):
+            return _IndexedArchive(self.stream, member_index["members"])
+        return tarfile.open(fileobj=self.stream, mode="r:")
+
+    def _read_info(self, lines):
+        """Parse and validate the lines of an INFO file into :attr:`info` and
+        :attr:`icons`.
+
+        :param lines: iterable of raw INFO lines
+        """
+        for line in lines:
+            try:
+                line = line.decode("utf-8").strip()
+            except UnicodeDecodeError:
+                raise SPKParseError("Wrong INFO encoding")
+
+            if not line:
+                continue
+
+            match = self.info_line_re.match(line)
+            if not match:
+                raise SPKParseError("Invalid INFO")
+            key, value = match.group("key"), match.group("value")
+
+            match = self.icon_info_re.match(key)
+            if match:
+                size = match.group("size") or "72"
+                try:
+                    self.icons[size] = io.BytesIO(
+                        base64.b64decode(value.encode("utf-8"))
+                    )
+                except binascii.Error:
+                    raise SPKParseError(f"Invalid INFO icon: {key}")
+                except TypeError:
+                    raise SPKParseError(f"Invalid INFO icon: {key}")
+            elif key in self.BOOLEAN_INFO:
+                if value == "yes":
+                    self.info[key] = True
+                elif value == "no":
+                    self.info[key] = False
+                else:
+                    raise SPKParseError(f"Invalid INFO boolean: {key}")
+            elif key == "package":
+                match = self.package_re.match(value)
+                if not match:
+                    raise SPKParseError("Invalid INFO package")
+                self.info[key] = value
+            else:
+                self.info[key] = value
+
+        # validate info
+        if not set(self.info.keys()) >= self.REQUIRED_INFO:
+            missing = ", ".join(self.REQUIRED_INFO - set(self.info.keys()))
+            raise SPKParseError(f"Missing INFO: {missing}")
+
+    @classmethod
+    def from_head(cls, data):
+        """Create a partial :class:`SPK` from the beginning of an archive, or
+        from the content of its INFO file alone.
+
+        Only :attr:`info` and :attr:`icons` are reliable. :attr:`license`,
+        :attr:`wizards` and :attr:`signature` reflect whatever members were
+        present in `data`. Nothing is verified beyond INFO.
+
+        :param bytes data: leading bytes of an SPK, or INFO content
+        :raises SPKParseError: if INFO is missing or invalid
+        """
+        spk = cls.__new__(cls)
+        spk.info = {}
+        spk.icons = {}
+        spk.wizards = set()
+        spk.license = None
+        spk.signature = None
+        spk.stream = None
+        spk.conf_dependencies = None
+        spk.conf_conflicts = None
+        spk.conf_privilege = None
+        spk.conf_resource = None
+
+        # INFO content alone, the archive magic is at a fixed offset
+        if data[257:262] != b"ustar":
+            spk._read_info(io.BytesIO(data).readlines())
+            return spk
+
+        info = None
+        try:
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r|") as archive:
+                for member in archive:
+                    if member.name == "INFO":
+                        info = archive.extractfile(member).read()
+                    elif member.name == "LICENSE":
+                        spk.license = (
+                            archive.extractfile(member)
+                            .read()
+                            .decode("utf-8", errors="replace")
+                            .strip()
+                        )
+                    elif member.name == cls.SIGNATURE_FILENAME:
+                        spk.signature = archive.extractfile(member).read()
+                    else:
+                        match = cls.wizard_filename_re.match(member.name)
+                        if match:
+                            spk.wizards.add(match.group("process"))
+        except (tarfile.ReadError, EOFError):
+            pass  # the archive is truncated after the members sent
+        if info is None:
+            raise SPKParseError("Missing INFO file")
+        spk._read_info(io.BytesIO(info).readlines())
+        return spk
+
+    def to_metadata(self):
+        """Return the parsed metadata as a plain dict suitable for caching.
+
+        The stream is not included, see :meth:`from_metadata`.
+        """
+        return {
+            "info": self.info,
+            "icons": {size: icon.getvalue() for size, icon in self.icons.items()},
+            "wizards": sorted(self.wizards),
+            "license": self.license,
+            "signature": self.signature,
+            "conf_dependencies": self.conf_dependencies,
+            "conf_conflicts": self.conf_conflicts,
+            "conf_privilege": self.conf_privilege,
+            "conf_resource": self.conf_resource,
+        }
+
+    @classmethod
+    def from_metadata(cls, stream, metadata):
+        """Create an :class:`SPK` from metadata previously returned by
+        :meth:`to_metadata`, without parsing the stream again.
+
+        :param stream: SPK file stream the metadata was read from
+        :param metadata: dict returned by :meth:`to_metadata`
+        """
+        spk = cls.__new__(cls)
+        spk.stream = stream
+        spk.info = dict(metadata["info"])
+        spk.icons = {size: io.BytesIO(data) for size, data in metadata["icons"].items()}
+        spk.wizards = set(metadata["wizards"])
+        spk.license = metadata["license"]
+        spk.signature = metadata["signature"]
+        spk.conf_dependencies = metadata["conf_dependencies"]
+        spk.conf_conflicts = metadata["conf_conflicts"]
+        spk.conf_privilege = metadata["conf_privilege"]
+        spk.conf_resource = metadata["conf_resource"]
+        spk.stream.seek(0)
+        return spk
+
+    def sign(self, timestamp_url=None, gnupghome=None, signer=None):
         """
         Sign the package
 
         :param timestamp_url: url for the remote timestamping
         :param gnupghome: path to the gnupg home
+        :param signer: a :class:`Signer` to reuse, in which case `timestamp_url`
+                       and `gnupghome` are ignored
         """
         if self.signature is not None:
             raise ValueError("Already signed")
@@ -302,7 +511,12 @@ class SPK(object):
                         data_stream.write(spk.extractfile(name).read())
 
             data_stream.seek(0)
-            signature = self._generate_signature(data_stream, timestamp_url, gnupghome)
+            if signer is not None:
+                signature = signer.sign(data_stream)
+            else:
+                signature = self._generate_signature(
+                    data_stream, timestamp_url, gnupghome
+                )
             self.signature = signature
 
             signature_stream = io.BytesIO(signature.encode("ascii"))
@@ -336,19 +550,67 @@ class SPK(object):
         self.stream.seek(0)
 
     def calculate_md5(self):
-        md5_hash = hashlib.md5()
         self.stream.seek(0)
-        for chunk in iter(lambda: self.stream.read(4096), b""):
-            md5_hash.update(chunk)
-        return md5_hash.hexdigest()
+        return hash_stream(self.stream)[0]["md5"]
 
     def _generate_signature(self, stream, timestamp_url, gnupghome):  # pragma: no cover
-        gpg = gnupg.GPG(gnupghome=gnupghome)
-        signature = gpg.sign_file(stream, detach=True)
+        with Signer(timestamp_url, gnupghome, retries=0) as signer:
+            return signer.sign(stream)
+
+
+class Signer(object):
+    """Signing context reusable across many SPKs.
+
+    Holds a single :class:`gnupg.GPG` instance and a :class:`requests.Session`
+    with pooled connections to the timestamp server. It is safe to share
+    between threads. Timestamp failures are retried with exponential backoff.
+
+    :param timestamp_url: url for the remote timestamping
+    :param gnupghome: path to the gnupg home
+    :param retries: number of retries after a timestamp failure
+    :param backoff: delay before the first retry, doubled on each retry
+    :param pool_size: maximum number of connections to the timestamp server
+    """
+
+    def __init__(self, timestamp_url, gnupghome, retries=3, backoff=1.0, pool_size=4):
+        self.timestamp_url = timestamp_url
+        self.retries = retries
+        self.backoff = backoff
+        self.gpg = gnupg.GPG(gnupghome=gnupghome)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
 
+    def sign(self, stream):
+        """Create a timestamped detached signature of `stream`.
+
+        :param stream: data to sign
+        :returns: the ASCII-armored timestamped signature
+        :raises SPKSignError: if timestamping still fails after all retries
+        """
+        signature = self.gpg.sign_file(stream, detach=True)
+        for attempt in range(self.retries + 1):
+            try:
+                return self._timestamp(signature.data)
+            except SPKSignError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2**attempt)
+
+    def _timestamp(self, signature):  # pragma: no cover
         try:
-            response = requests.post(
-                timestamp_url, files={"file": signature.data}, timeout=2
+            response = self.session.post(
+                self.timestamp_url, files={"file": signature}, timeout=2
             )
         except requests.RequestException:
             raise SPKSignError("Timestamp server did not respond in time")
@@ -358,18 +620,120 @@ class SPK(object):
                 f"Timestamp server returned with status code {response.status_code}"
             )
 
-        if not gpg.verify(response.content):
+        if not self.gpg.verify(response.content):
             raise SPKSignError("Cannot verify timestamp")
 
         response.encoding = "ascii"
         return response.text
 
 
+def _spk_metadata_cache_key(stream):
+    stat = os.fstat(stream.fileno())
+    return (
+        f"spk_metadata:{stat.st_dev}:{stat.st_ino}:"
+        f"{stat.st_mtime_ns}:{stat.st_size}"
+    )
+
+
+def load_spk(stream, member_index=None):
+    """Parse an SPK file opened from disk, reusing previously parsed metadata
+    when the file has not changed since.
+
+    Parsed metadata is cached keyed by the file's inode, modification time and
+    size, so signing, unsigning or replacing the file invalidates it naturally.
+    Parse errors are never cached.
+
+    :param stream: SPK file opened in binary mode (must have a file descriptor)
+    :param member_index: stored member index of the file, see :class:`SPK`
+    :returns: a :class:`SPK` instance bound to `stream`
+    :raises SPKParseError: if the file is not a valid SPK
+    """
+    key = _spk_metadata_cache_key(stream)
+    metadata = cache.get(key)
+    if metadata is not None:
+        return SPK.from_metadata(stream, metadata)
+    spk = SPK(stream, member_index=member_index)
+    cache.set(
+        key,
+        spk.to_metadata(),
+        timeout=current_app.config["SPK_METADATA_CACHE_TIMEOUT"],
+    )
+    return spk
+
+
+def load_remote_spk(object_key, member_index=None):
+    """Parse the metadata of an SPK stored in Object Storage without
+    downloading it.
+
+    The archive is read with HTTP Range requests: tar headers and small
+    members only, ``package.tgz`` is skipped and its checksum is not verified.
+    With a member index, the tar headers are not read either.
+    Parsed metadata is cached keyed by the object's ETag.
+
+    :param object_key: key of the SPK in the packages bucket
+    :param member_index: stored member index of the object, see :class:`SPK`
+    :returns: a :class:`SPK` instance bound to a
+              :class:`~spkrepo.storage.RangeReader`
+    :raises SPKParseError: if the object is not a valid SPK
+    """
+    stream = storage.RangeReader(object_key)
+    key = f"spk_metadata:remote:{object_key}:{stream.etag}:{stream.size}"
+    metadata = cache.get(key)
+    if metadata is not None:
+        return SPK.from_metadata(stream, metadata)
+    spk = SPK(stream, verify_checksum=False, member_index=member_index)
+    cache.set(
+        key,
+        spk.to_metadata(),
+        timeout=current_app.config["SPK_METADATA_CACHE_TIMEOUT"],
+    )
+    return spk
+
+
 # ---------------------------------------------------------------------------
 # Shared SPK processing helpers
 # ---------------------------------------------------------------------------
 
 
+_package_locks = {}
+_package_locks_guard = threading.Lock()
+
+
+def _advisory_lock_key(name):
+    digest = hashlib.blake2b(f"package:{name}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+@contextmanager
+def package_lock(*names):
+    """Serialize the creation of packages, versions and builds of the given
+    packages across concurrent requests.
+
+    On PostgreSQL a transaction-level advisory lock is taken for each package,
+    it is released when the current transaction ends, so the transaction must
+    be committed or rolled back inside the block. Other databases fall back to
+    a lock local to the process.
+
+    :param names: names of the packages
+    """
+    names = sorted(set(names))
+    if db.engine.dialect.name == "postgresql":
+        for name in names:
+            db.session.execute(
+                text("SELECT pg_advisory_xact_lock(:key)"),
+                {"key": _advisory_lock_key(name)},
+            )
+        yield
+        return
+
+    with ExitStack() as stack:
+        for name in names:
+            with _package_locks_guard:
+                lock = _package_locks.setdefault(name, threading.Lock())
+            stack.enter_context(lock)
+        yield
+
+
 def resolve_firmware(session, value, allow_none=False):
     """Resolve a firmware string like '6.2-23739' to a
     :class:`~spkrepo.models.Firmware`.
@@ -389,11 +753,10 @@ def resolve_firmware(session, value, allow_none=False):
     if not match:
         raise ValueError(f"Invalid firmware value: {value}")
 
-    firmware = Firmware.find(int(match.group("build")))
+    firmware = reference.firmware(int(match.group("build")), session=session)
     if firmware is None:
         raise ValueError(f"Unknown firmware: {value}")
-
-    return session.merge(firmware, load=False)
+    return firmware
 
 
 def resolve_architectures(session, arch_string):
@@ -408,10 +771,10 @@ def resolve_architectures(session, arch_string):
         raise ValueError("Missing 'arch' field in INFO")
     architectures = []
     for info_arch in arch_string.split():
-        architecture = Architecture.find(info_arch, syno=True)
+        architecture = reference.architecture(info_arch, syno=True, session=session)
         if architecture is None:
             raise ValueError(f"Unknown architecture: {info_arch}")
-        architectures.append(session.merge(architecture, load=False))
+        architectures.append(architecture)
     return architectures
 
 
@@ -427,7 +790,7 @@ def resolve_services(service_string):
         return []
     services = []
     for service_code in service_string.split():
-        service = Service.find(service_code)
+        service = reference.service(service_code)
         if service is None:
             raise ValueError(f"Unknown dependent service: {service_code}")
         services.append(service)
@@ -482,7 +845,7 @@ def extract_version_metadata(spk):
     }
 
 
-def assert_version_metadata_matches_db(version, spk):
+def assert_version_metadata_matches_db(version, spk, ignore=()):
     """Raise :exc:`ValueError` if the SPK's version-level metadata conflicts with
     what is already stored on an existing :class:`~spkrepo.models.Version` record.
 
@@ -491,6 +854,8 @@ def assert_version_metadata_matches_db(version, spk):
 
     :param version: the existing :class:`~spkrepo.models.Version` DB record
     :param spk: a parsed :class:`SPK` instance for the incoming build
+    :param ignore: names of fields not to compare, e.g. those unknown from a
+                   partial SPK
     :raises ValueError: listing all mismatched fields if any inconsistency is found
     """
     incoming = extract_version_metadata(spk)
@@ -509,6 +874,8 @@ def assert_version_metadata_matches_db(version, spk):
         "license",
     )
     for field in simple_fields:
+        if field in ignore:
+            continue
         spk_val = incoming[field]
         db_val = getattr(version, field)
         # startable=None in the DB means "default true", same as SPK omitting the key
@@ -555,7 +922,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
         subsequent error causes the caller to roll back the session, any newly
         written icon files will be left on disk. Callers that require strict
         atomicity should handle cleanup themselves (e.g. via
-        :func:`~spkrepo.api._cleanup_on_failure`).
+        :func:`~spkrepo.views.api._discard_upload`).
 
     .. note::
         This function calls ``session.flush()`` at the end to push all pending
@@ -609,7 +976,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
         version.displaynames.clear()
         default_display = info.get("displayname")
         if default_display:
-            language = Language.find("enu")
+            language = reference.language("enu", session=session)
             if language is None:
                 raise ValueError("Language 'enu' is not defined")
             version.displaynames[language.code] = DisplayName(
@@ -618,7 +985,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
         for key, value in info.items():
             if key.startswith("displayname_"):
                 language_code = key.split("_", 1)[1]
-                language = Language.find(language_code)
+                language = reference.language(language_code, session=session)
                 if language is None:
                     raise ValueError(
                         f"Unknown INFO displayname language: {language_code}"
@@ -630,7 +997,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
         build.descriptions.clear()
         default_description = info.get("description")
         if default_description:
-            language = Language.find("enu")
+            language = reference.language("enu", session=session)
             if language is None:
                 raise ValueError("Language 'enu' is not defined")
             build.descriptions[language.code] = BuildDescription(
@@ -639,7 +1006,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
         for key, value in info.items():
             if key.startswith("description_"):
                 language_code = key.split("_", 1)[1]
-                language = Language.find(language_code)
+                language = reference.language(language_code, session=session)
                 if language is None:
                     raise ValueError(
                         f"Unknown INFO description language: {language_code}"
@@ -654,7 +1021,9 @@ def apply_info_from_spk(session, build, spk, md5_hash):
         existing_icons = dict(version.icons)
         new_sizes = set(spk.icons.keys()) if spk.icons else set()
         written_icon_paths = []
+        rewritten_icon_paths = []
         for stale_size in set(existing_icons) - new_sizes:
+            rewritten_icon_paths.append(existing_icons[stale_size].path)
             del version.icons[stale_size]
 
         if spk.icons:
@@ -678,6 +1047,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
                     written_icon_paths.append(
                         os.path.join(current_app.config["DATA_PATH"], icon_path)
                     )
+                    rewritten_icon_paths.append(icon_path)
             except Exception:
                 # Clean up any icon files written in this call before re-raising,
                 # so a failed resync does not leave orphaned files on disk.
@@ -687,6 +1057,7 @@ def apply_info_from_spk(session, build, spk, md5_hash):
                     except OSError:
                         pass
                 raise
+        storage.purge_data_files(*rewritten_icon_paths)
 
         # -- Build-level fields --------------------------------------------------
 
@@ -744,6 +1115,7 @@ def apply_sidecar_to_db(session, build, sidecar):
     build.checksum = info.get("checksum")
     build.md5 = calculated["md5"]
     build.size = calculated["size"]
+    build.member_index = calculated.get("member_index")
     build.signed = True
     build.storage = "remote"
 
@@ -789,3 +1161,5 @@ def populate_db():
     db.session.execute(
         Service.__table__.insert().values([{"code": "apache-web"}, {"code": "mysql"}])
     )
+    # the bulk inserts skip the ORM events invalidating the reference data
+    reference.invalidate_on_commit(db.session)
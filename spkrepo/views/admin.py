@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import io
-import json
 import os
 import shutil
 import uuid
@@ -45,13 +44,15 @@ from ..models import (
     User,
     Version,
 )
-from ..utils import SPK
+from ..utils import SPK, load_remote_spk, load_spk, member_index_matches
 from .nas import clear_catalog_cache
 from .tasks import (
     rehome_from_storage,
     resync_build_file,
     resync_build_metadata,
-    upload_to_storage,
+    sign_builds,
+    upload_builds,
+    user_tasks_key,
 )
 
 # ---------------------------------------------------------------------------
@@ -120,9 +121,29 @@ def _store_task_tasks(new_tasks):
 
 
 def _get_task_ids():
-    """Return the current user's task list from Redis."""
+    """Return the current user's task list from Redis.
+
+    Includes tasks queued on the user's behalf outside of this session, such as
+    signing after an API upload.
+    """
     key = _task_redis_key()
-    return cache.get(key) or []
+    tasks = cache.get(key) or []
+    seen = {t["id"] if isinstance(t, dict) else t for t in tasks}
+    for entry in cache.get(user_tasks_key(current_user.id)) or []:
+        if entry["id"] not in seen:
+            tasks.append(entry)
+    return tasks
+
+
+#: Task states shown as in progress, ``PROGRESS`` is reported by batch tasks
+TASK_PENDING_STATES = ("PENDING", "STARTED", "RETRY", "PROGRESS")
+
+
+def _task_progress(result):
+    """Return the progress metadata of a running task, if it reports any."""
+    if result.state == "PROGRESS" and isinstance(result.info, dict):
+        return result.info
+    return None
 
 
 def _clear_task_ids():
@@ -131,22 +152,45 @@ def _clear_task_ids():
     key = session.pop("background_task_key", None)
     if key:
         cache.delete(key)
+    cache.delete(user_tasks_key(current_user.id))
+
+
+def _queue_upload(build_ids):
+    """Queue a single task uploading the given builds to Object Storage."""
+    result = upload_builds.delay(build_ids)
+    _store_task_tasks(
+        [
+            {
+                "id": result.id,
+                "type": "upload",
+                "label": f"Upload {len(build_ids)} build(s)",
+            }
+        ]
+    )
 
 
 def _detect_and_fix_signed(build):
-    """If the local SPK has a signature but build.signed is False, fix it.
-    Returns True if the column was updated."""
+    """If the SPK has a signature but build.signed is False, fix it. The stored
+    member index is used when it still matches the file, checked through its
+    size and tar headers, otherwise the SPK is read. Builds in Object Storage
+    are read with range requests. Returns True if the column was updated."""
     if build.signed:
         return False
     if not build.path:
         return False
     spk_path = os.path.join(current_app.config["DATA_PATH"], build.path)
-    if not os.path.exists(spk_path):
-        return False
     try:
-        with io.open(spk_path, "rb") as f:
-            spk = SPK(f)
-        if spk.signature is not None:
+        if os.path.exists(spk_path):
+            with io.open(spk_path, "rb") as f:
+                signed = _has_signature(f, build.member_index, lambda: load_spk(f))
+        elif build.storage == "remote" and storage_service.storage_configured():
+            with storage_service.RangeReader(build.path) as f:
+                signed = _has_signature(
+                    f, build.member_index, lambda: load_remote_spk(build.path)
+                )
+        else:
+            return False
+        if signed:
             build.signed = True
             return True
     except Exception:
@@ -154,24 +198,33 @@ def _detect_and_fix_signed(build):
     return False
 
 
+def _has_signature(stream, member_index, load):
+    """Return whether the SPK in `stream` is signed, from `member_index` if it
+    matches the stream, from the SPK returned by `load` otherwise."""
+    if member_index_matches(stream, member_index):
+        return SPK.SIGNATURE_FILENAME in member_index["members"]
+    return load().signature is not None
+
+
 # ---------------------------------------------------------------------------
 # SPK helpers
 # ---------------------------------------------------------------------------
 
 
 def _resync_build_file(build):
-    """Recalculate md5 and size from the build file or sidecar."""
+    """Recalculate md5, size and member index from the build file or
+    sidecar."""
     if not build.path:
         raise ValueError("Build has no file path")
-    sidecar_path = os.path.join(current_app.config["DATA_PATH"], build.path + ".json")
-    if os.path.exists(sidecar_path):
-        with io.open(sidecar_path, "r", encoding="utf-8") as f:
-            sidecar = json.load(f)
+    sidecar = build.load_sidecar()
+    if sidecar is not None:
         build.md5 = sidecar["calculated"]["md5"]
         build.size = sidecar["calculated"]["size"]
+        build.member_index = sidecar["calculated"].get("member_index")
     else:
         build.md5 = build.calculate_md5()
         build.size = build.calculate_size()
+        build.member_index = build.calculate_member_index()
 
 
 # ---------------------------------------------------------------------------
@@ -256,60 +309,38 @@ class SignResyncMixin:
 
     @action("07_sign", "Sign", "Are you sure you want to sign selected builds?")
     def action_07_sign(self, ids):
-        try:
-            not_local, already_signed, recovered, success, failed = ([], [], [], [], [])
-            for label, build in self._iter_builds(ids):
-                if build.storage != "local":
-                    not_local.append(label)
-                    continue
-                with io.open(
-                    os.path.join(current_app.config["DATA_PATH"], build.path), "rb+"
-                ) as f:
-                    spk = SPK(f)
-                    if spk.signature is not None:
-                        if not build.signed:
-                            build.signed = True
-                            db.session.commit()
-                            recovered.append(label)
-                        else:
-                            already_signed.append(label)
-                        continue
-                    if current_app.config["GNUPG_PATH"] is None:
-                        failed.append((label, "GNUPG_PATH is not configured"))
-                        continue
-                    try:
-                        spk.sign(
-                            current_app.config["GNUPG_TIMESTAMP_URL"],
-                            current_app.config["GNUPG_PATH"],
-                        )
-                        _resync_build_file(build)
-                        build.signed = True
-                        db.session.commit()
-                        success.append(label)
-                    except Exception as e:
-                        current_app.logger.exception("Failed to sign build %s", label)
-                        db.session.rollback()
-                        failed.append((label, str(e) or "unknown error"))
-            if not_local:
-                flash(
-                    "Build(s) in Object Storage must be re-homed before signing: "
-                    + ", ".join(not_local),
-                    "warning",
-                )
-            if recovered:
-                flash(
-                    "Signature status corrected for: " + ", ".join(recovered),
-                    "info",
-                )
-            _flash_action_results(
-                success,
-                failed,
-                skipped=already_signed,
-                item_label="build",
+        not_local, build_ids = [], []
+        for label, build in self._iter_builds(ids):
+            if build.storage != "local":
+                not_local.append(label)
+                continue
+            build_ids.append(build.id)
+        if not_local:
+            flash(
+                "Build(s) in Object Storage must be re-homed before signing: "
+                + ", ".join(not_local),
+                "warning",
             )
-        except Exception:  # pragma: no cover
-            current_app.logger.exception("Failed to sign builds")
-            flash("Failed to sign builds. Please check the logs.", "error")
+        if build_ids:
+            result = sign_builds.delay(build_ids)
+            _store_task_tasks(
+                [
+                    {
+                        "id": result.id,
+                        "type": "sign",
+                        "label": f"Sign {len(build_ids)} build(s)",
+                    }
+                ]
+            )
+            flash(
+                Markup(
+                    f"Signing of {len(build_ids)} build(s) queued. "
+                    f'<a href="/admin/tasks/">View status</a>',
+                ),
+                "info",
+            )
+        elif not not_local:
+            flash("No builds found to sign.", "warning")
 
     @action("08_unsign", "Unsign", "Are you sure you want to unsign selected builds?")
     def action_08_unsign(self, ids):
@@ -331,12 +362,13 @@ class SignResyncMixin:
                 with io.open(
                     os.path.join(current_app.config["DATA_PATH"], build.path), "rb+"
                 ) as f:
-                    spk = SPK(f)
+                    spk = load_spk(f)
                     if spk.signature is None:
                         not_signed.append(label)
                         continue
                     try:
                         spk.unsign()
+                        storage_service.purge_data_files(build.path)
                         _resync_build_file(build)
                         build.signed = False
                         db.session.commit()
@@ -379,20 +411,19 @@ class SignResyncMixin:
         "Upload selected builds to Object Storage?",
     )
     def action_03_upload(self, ids):
-        tasks = []
+        build_ids = []
         for label, build in self._iter_builds(ids):
             if build.storage != "local":
                 continue
             if not build.signed and not _detect_and_fix_signed(build):
                 continue
-            result = upload_to_storage.delay(build.id, str(build))
-            tasks.append({"id": result.id, "type": "upload", "label": label})
-        if tasks:
-            _store_task_tasks(tasks)
-            count = len(tasks)
+            build_ids.append(build.id)
+        if build_ids:
+            _queue_upload(build_ids)
+            count = len(build_ids)
             flash(
                 Markup(
-                    f"{count} upload task(s) queued. "
+                    f"Upload of {count} build(s) queued. "
                     f'<a href="/admin/tasks/">View status</a>',
                 ),
                 "info",
@@ -1310,14 +1341,9 @@ class VersionView(DetailsNavigationMixin, SignResyncMixin, ModelView):
 
             upload_tasks = []
             if storage_ok:
-                for build in activated:
-                    if build.storage == "local":
-                        result = upload_to_storage.delay(build.id, str(build))
-                        upload_tasks.append(
-                            {"id": result.id, "type": "upload", "label": str(build)}
-                        )
+                upload_tasks = [b.id for b in activated if b.storage == "local"]
             if upload_tasks:
-                _store_task_tasks(upload_tasks)
+                _queue_upload(upload_tasks)
             if not_signed:
                 flash(
                     "Build(s) have no signature and cannot be activated: "
@@ -1561,14 +1587,9 @@ class BuildView(DetailsNavigationMixin, SignResyncMixin, ModelView):
 
             upload_tasks = []
             if storage_ok:
-                for build in activated:
-                    if build.storage == "local":
-                        result = upload_to_storage.delay(build.id, str(build))
-                        upload_tasks.append(
-                            {"id": result.id, "type": "upload", "label": str(build)}
-                        )
+                upload_tasks = [b.id for b in activated if b.storage == "local"]
             if upload_tasks:
-                _store_task_tasks(upload_tasks)
+                _queue_upload(upload_tasks)
             if not_signed:
                 flash(
                     "Build(s) have no signature and cannot be activated: "
@@ -1929,7 +1950,7 @@ class TaskStatusView(BaseView):
             result = AsyncResult(task_id, app=celery)
             state = result.state
             info = result.info if result.ready() else None
-            if state in ("PENDING", "STARTED", "RETRY"):
+            if state in TASK_PENDING_STATES:
                 pending_count += 1
             tasks.append(
                 {
@@ -1938,6 +1959,7 @@ class TaskStatusView(BaseView):
                     "label": task_label,
                     "state": state,
                     "result": info,
+                    "progress": _task_progress(result),
                 }
             )
         return self.render(
@@ -1975,7 +1997,7 @@ class TaskStatusView(BaseView):
                 if isinstance(info, dict)
                 else (str(info) if info else None)
             )
-            if state in ("PENDING", "STARTED", "RETRY"):
+            if state in TASK_PENDING_STATES:
                 pending_count += 1
             tasks.append(
                 {
@@ -1984,6 +2006,7 @@ class TaskStatusView(BaseView):
                     "state": state,
                     "label": label,
                     "error": error,
+                    "progress": _task_progress(result),
                 }
             )
         return jsonify({"tasks": tasks, "pending_count": pending_count})
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import io
 import logging
 import os
+import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 from flask import Blueprint, current_app, request
@@ -11,28 +14,35 @@ from flask_principal import Identity, identity_changed
 from flask_restful import Api, Resource, abort
 from flask_security import current_user
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
 
+from .. import reference, storage, uploads
 from ..exceptions import SPKParseError, SPKSignError
 from ..ext import db
+from ..hashing import HashingReader, hash_file
 from ..models import (
     Build,
     BuildDescription,
     BuildManifest,
+    BuildSidecar,
     DisplayName,
     Icon,
-    Language,
     Package,
     Version,
+    read_member_index,
     user_datastore,
 )
 from ..utils import (
     SPK,
     assert_version_metadata_matches_db,
+    extract_version_metadata,
+    package_lock,
     resolve_architectures,
     resolve_firmware,
     resolve_services,
     version_re,
 )
+from .tasks import make_sidecar, sign_build, track_user_task
 
 logger = logging.getLogger(__name__)
 
@@ -56,22 +66,731 @@ def api_auth_required(f):
     return wrapper
 
 
-def _cleanup_on_failure(
-    data_path, package_name, version_number, build_path, create_package, create_version
+class _Upload(object):
+    """An SPK being registered, from validation to commit."""
+
+    def __init__(self, spk):
+        self.spk = spk
+        self.package = None
+        self.version = None
+        self.build = None
+        self.architectures = None
+        self.firmware = None
+        self.firmware_max = None
+        self.services = None
+        self.create_package = False
+        self.create_version = False
+        #: SPK file stored for the build until it is registered
+        self.stored_path = None
+        #: icon files written for a new version
+        self.icon_paths = []
+
+    def response(self):
+        return {
+            "package": self.package.name,
+            "version": self.version.version_string,
+            "firmware": self.firmware.firmware_string,
+            "architectures": [a.code for a in self.architectures],
+        }
+
+
+def _read_upload(stream):
+    """Read an uploaded SPK into memory, hashing it on the way.
+
+    :returns: a tuple of the buffered SPK, its md5 and sha256 hex digests
+    """
+    buffer = io.BytesIO()
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+        md5.update(chunk)
+        sha256.update(chunk)
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer, md5.hexdigest(), sha256.hexdigest()
+
+
+def _check_package_permission(package):
+    if (
+        not current_user.has_role("package_admin")
+        and current_user not in package.maintainers
+    ):
+        abort(403, message="Insufficient permissions on this package")
+
+
+def _find_duplicate(digest):
+    """Return the :class:`~spkrepo.models.Build` registered from an upload with
+    the same sha256, aborting with 403 if the current user may not see it."""
+    build = (
+        db.session.execute(db.select(Build).filter(Build.upload_digest == digest))
+        .unique()
+        .scalars()
+        .first()
+    )
+    if build is not None:
+        _check_package_permission(build.version.package)
+    return build
+
+
+def _duplicate_response(build):
+    return {
+        "package": build.version.package.name,
+        "version": build.version.version_string,
+        "firmware": build.firmware_min.firmware_string,
+        "architectures": [a.code for a in build.architectures],
+        "duplicate": True,
+    }
+
+
+def _parse_spk(stream):
+    """Parse an uploaded SPK, rejecting invalid and pre-signed packages."""
+    try:
+        spk = SPK(stream)
+    except SPKParseError as e:
+        abort(422, message=str(e))
+
+    # reject signed packages
+    if spk.signature is not None:
+        abort(422, message="Package contains a signature")
+    return spk
+
+
+def _resolve_reference_data(upload):
+    spk = upload.spk
+
+    # Architectures
+    try:
+        upload.architectures = resolve_architectures(db.session, spk.info.get("arch"))
+    except ValueError as e:
+        abort(422, message=str(e))
+
+    # Firmware min
+    input_firmware = spk.info.get("firmware") or spk.info.get("os_min_ver")
+    try:
+        upload.firmware = resolve_firmware(db.session, input_firmware)
+    except ValueError as e:
+        abort(422, message=str(e))
+
+    # Firmware max
+    input_firmware_max = spk.info.get("os_max_ver")
+    if input_firmware_max:
+        try:
+            upload.firmware_max = resolve_firmware(db.session, input_firmware_max)
+        except ValueError as e:
+            abort(422, message=str(e))
+        if upload.firmware_max.build < upload.firmware.build:
+            abort(
+                422,
+                message=(
+                    "Maximum firmware must be greater than or equal to "
+                    "minimum firmware"
+                ),
+            )
+
+    # Services — resolve once here; reused in version creation below
+    try:
+        upload.services = resolve_services(spk.info.get("install_dep_services"))
+    except ValueError as e:
+        abort(422, message=str(e))
+
+
+def _find_or_create_package(upload):
+    spk = upload.spk
+    package = Package.find(spk.info["package"])
+    if package is None:
+        if not current_user.has_role("package_admin"):
+            abort(403, message="Insufficient permissions to create new packages")
+        upload.create_package = True
+        package = Package(name=spk.info["package"], author=current_user)
+    else:
+        _check_package_permission(package)
+    upload.package = package
+
+
+def _find_or_create_version(upload, check_metadata=True, ignore=()):
+    spk, package = upload.spk, upload.package
+    match = version_re.match(spk.info["version"])
+    if not match:
+        abort(422, message="Invalid version")
+
+    version = Version.find(package, int(match.group("version")))
+
+    if version is not None:
+        # Existing version — enforce full metadata consistency before proceeding.
+        # This catches cases where a build pipeline bug produces SPKs with
+        # differing version-level metadata (e.g. different SPK_VER) for builds
+        # that are part of the same logical release.
+        if check_metadata:
+            try:
+                assert_version_metadata_matches_db(version, spk, ignore=ignore)
+            except ValueError as e:
+                abort(422, message=str(e))
+        upload.version = version
+        return
+
+    upload.create_version = True
+    version_startable = True
+    if spk.info.get("startable") is False or spk.info.get("ctl_stop") is False:
+        version_startable = False
+    version = Version(
+        package=package,
+        upstream_version=match.group("upstream_version"),
+        version=int(match.group("version")),
+        report_url=spk.info.get("report_url"),
+        distributor=spk.info.get("distributor"),
+        distributor_url=spk.info.get("distributor_url"),
+        maintainer=spk.info.get("maintainer"),
+        maintainer_url=spk.info.get("maintainer_url"),
+        install_wizard="install" in spk.wizards,
+        upgrade_wizard="upgrade" in spk.wizards,
+        startable=version_startable,
+        license=spk.license,
+    )
+
+    with db.session.no_autoflush:
+        for key, value in spk.info.items():
+            if key == "install_dep_services":
+                version.service_dependencies = upload.services
+            elif key == "displayname":
+                version.displaynames["enu"] = DisplayName(
+                    language=reference.language("enu"), displayname=value
+                )
+            elif key.startswith("displayname_"):
+                language = reference.language(key.split("_", 1)[1])
+                if not language:
+                    abort(422, message="Unknown INFO displayname language")
+                version.displaynames[language.code] = DisplayName(
+                    language=language, displayname=value
+                )
+
+    # Icon
+    for size, icon in spk.icons.items():
+        version.icons[size] = Icon(
+            path=os.path.join(package.name, str(version.version), f"icon_{size}.png"),
+            size=size,
+        )
+    upload.version = version
+
+
+def _check_conflicts(upload, lock=True):
+    """Abort with 409 if a build of the version already covers one of the
+    architectures over an overlapping firmware range.
+
+    :param lock: lock the version row until the end of the transaction so that
+                 concurrent uploads to the same version are checked one after
+                 the other
+    """
+    version = upload.version
+    if version.id is None:
+        # new version, nothing to conflict with
+        return
+    if lock:
+        db.session.execute(
+            db.select(Version.id).filter(Version.id == version.id).with_for_update()
+        )
+    conflicts = Build.conflicting_architectures(
+        version.id, upload.architectures, upload.firmware, upload.firmware_max
+    )
+    if conflicts:
+        abort(409, message=f"Conflicting architectures: {', '.join(conflicts)}")
+
+
+def _create_build(upload, digest=None):
+    spk, package, version = upload.spk, upload.package, upload.version
+    build_filename = Build.generate_filename(
+        package, version, upload.firmware, upload.architectures
+    )
+    build = Build(
+        version=version,
+        architectures=upload.architectures,
+        firmware_min=upload.firmware,
+        firmware_max=upload.firmware_max,
+        publisher=current_user,
+        path=os.path.join(package.name, str(version.version), build_filename),
+        checksum=spk.info.get("checksum"),
+        changelog=spk.info.get("changelog"),
+        upload_digest=digest,
+    )
+
+    with db.session.no_autoflush:
+        for key, value in spk.info.items():
+            if key == "description":
+                build.descriptions["enu"] = BuildDescription(
+                    description=value, language=reference.language("enu")
+                )
+            elif key.startswith("description_"):
+                language = reference.language(key.split("_", 1)[1])
+                if not language:
+                    abort(422, message="Unknown INFO description language")
+                build.descriptions[language.code] = BuildDescription(
+                    language=language, description=value
+                )
+
+    build.buildmanifest = BuildManifest(
+        dependencies=spk.info.get("install_dep_packages"),
+        conf_dependencies=spk.conf_dependencies,
+        conflicts=spk.info.get("install_conflict_packages"),
+        conf_conflicts=spk.conf_conflicts,
+        conf_privilege=spk.conf_privilege,
+        conf_resource=spk.conf_resource,
+    )
+    upload.build = build
+
+
+def _prepare_upload(
+    spk, check_version_metadata=True, digest=None, lock=True, upload=None
 ):
-    """Remove partially saved files after a failed SPK save."""
-    if create_package:
-        shutil.rmtree(os.path.join(data_path, package_name), ignore_errors=True)
-    elif create_version:
-        shutil.rmtree(
-            os.path.join(data_path, package_name, str(version_number)),
-            ignore_errors=True,
+    """Validate a parsed SPK against the database and build the new
+    :class:`~spkrepo.models.Build`, creating its package and version if needed.
+
+    Aborts with the appropriate status code on the first failed check. Nothing
+    is written to disk or committed.
+
+    :param spk: the parsed :class:`~spkrepo.utils.SPK`
+    :param check_version_metadata: compare version-level metadata with an
+                                   existing version
+    :param digest: sha256 of the uploaded SPK
+    :param lock: lock the version row, see :func:`_check_conflicts`
+    :param upload: :class:`_Upload` to prepare again instead of a new one
+    :returns: the prepared :class:`_Upload`
+    """
+    if upload is None:
+        upload = _Upload(spk)
+    upload.create_package = upload.create_version = False
+    _resolve_reference_data(upload)
+    _find_or_create_package(upload)
+    _find_or_create_version(upload, check_metadata=check_version_metadata)
+    _check_conflicts(upload, lock=lock)
+    _create_build(upload, digest=digest)
+    return upload
+
+
+def _direct_upload_enabled():
+    return (
+        current_app.config["UPLOAD_DIRECT_TO_STORAGE"] and storage.storage_configured()
+    )
+
+
+def _sign_for_storage(spk):
+    """Sign an SPK about to be uploaded straight to Object Storage, where it
+    could not be signed later.
+
+    :returns: whether the SPK is signed
+    """
+    config = current_app.config
+    if config["GNUPG_PATH"] is None:
+        return False
+    try:
+        spk.sign(config["GNUPG_TIMESTAMP_URL"], config["GNUPG_PATH"])
+    except SPKSignError as e:
+        logger.warning("Failed to sign %s before upload: %s", spk.info["package"], e)
+        return False
+    return True
+
+
+def _upload_stream(upload, stream):
+    """Sign the SPK in `stream`, upload it to Object Storage while hashing it
+    and record its sidecar.
+
+    :returns: whether the SPK was uploaded
+    """
+    spk, build = upload.spk, upload.build
+    spk.stream = stream
+    if not _sign_for_storage(spk):
+        stream.seek(0)
+        return False
+    member_index = read_member_index(fileobj=stream)
+    reader = HashingReader(stream, ("md5", "sha256"))
+    if not storage.upload_stream(reader, build.path, member_index["size"]):
+        stream.seek(0)
+        return False
+    digests = reader.hexdigests()
+    build.sidecar = BuildSidecar.from_dict(
+        make_sidecar(spk, build.path, digests, reader.size, member_index)
+    )
+    build.md5 = digests["md5"]
+    build.size = reader.size
+    build.member_index = member_index
+    build.signed = True
+    build.storage = "remote"
+    return True
+
+
+def _upload_direct(upload, staged_path=None):
+    """Upload the SPK straight to Object Storage, without a local copy.
+
+    The SPK is signed first. If it cannot be signed or the upload fails, it is
+    left for :func:`_store_upload` to store locally.
+
+    :returns: whether the SPK was uploaded
+    """
+    if staged_path is None:
+        return _upload_stream(upload, upload.spk.stream)
+    # the staged SPK was parsed from a file closed since
+    with io.open(staged_path, "rb+") as f:
+        return _upload_stream(upload, f)
+
+
+#: Attributes of a stored build carried over by :func:`_register_upload`
+STORED_BUILD_ATTRIBUTES = ("md5", "size", "member_index", "signed", "storage")
+
+
+def _store_upload(upload, staged_path=None, md5=None):
+    """Store the SPK of a prepared upload before the package lock is taken, so
+    that concurrent uploads of a package do not wait on each other's transfers.
+
+    With :data:`UPLOAD_DIRECT_TO_STORAGE`, the SPK goes to Object Storage, see
+    :func:`_upload_direct`. Otherwise it is kept in the staging directory of
+    :mod:`spkrepo.uploads` until :func:`_register_upload` moves it into place.
+    The session must be rolled back first, so that no row is held while the
+    SPK is transferred.
+
+    :param upload: the prepared :class:`_Upload`
+    :param staged_path: staged file holding the SPK, stored as is
+    :param md5: md5 of the SPK if already known
+    """
+    build = upload.build
+    try:
+        if _direct_upload_enabled():
+            if _upload_direct(upload, staged_path):
+                return
+            if upload.spk.signature is not None:
+                md5 = None  # signed before the upload failed
+        if staged_path is None:
+            upload.stored_path = uploads.temporary_path()
+            upload.spk.stream.seek(0)
+            with io.open(upload.stored_path, "wb") as f:
+                shutil.copyfileobj(upload.spk.stream, f)
+        else:
+            upload.stored_path = staged_path
+        build.md5 = md5 or hash_file(upload.stored_path)[0]["md5"]
+        build.size = os.path.getsize(upload.stored_path)
+        build.member_index = read_member_index(upload.stored_path)
+    except Exception as e:  # pragma: no cover
+        logger.exception("Failed to store SPK for package %s", upload.package.name)
+        _discard_upload(upload)
+        abort(500, message="Failed to save files", details=str(e))
+
+
+def _register_upload(upload, check_version_metadata=True):
+    """Prepare a stored upload again, under the package lock, and move its SPK
+    and, for a new version, its icons into :data:`DATA_PATH`.
+
+    :param upload: the :class:`_Upload` stored with :func:`_store_upload`
+    :param check_version_metadata: compare version-level metadata with an
+                                   existing version
+    """
+    stored = upload.build
+    _prepare_upload(
+        upload.spk,
+        check_version_metadata=check_version_metadata,
+        digest=stored.upload_digest,
+        upload=upload,
+    )
+    build = upload.build
+    for name in STORED_BUILD_ATTRIBUTES:
+        value = getattr(stored, name)
+        if value is not None:
+            setattr(build, name, value)
+    build.sidecar = stored.sidecar
+    data_path = current_app.config["DATA_PATH"]
+    try:
+        os.makedirs(
+            os.path.join(data_path, upload.package.name, str(upload.version.version)),
+            exist_ok=True,
         )
-    else:
+        if upload.create_version:
+            for size, icon in upload.version.icons.items():
+                upload.icon_paths.append(os.path.join(data_path, icon.path))
+                icon.save(upload.spk.icons[size])
+        if upload.stored_path is not None:
+            build_path = os.path.join(data_path, build.path)
+            os.replace(upload.stored_path, build_path)
+            upload.stored_path = build_path
+    except Exception as e:  # pragma: no cover
+        logger.exception("Failed to save SPK files for package %s", build.path)
+        abort(500, message="Failed to save files", details=str(e))
+
+
+def _discard_upload(upload):
+    """Remove what was stored for an upload that is not registered.
+
+    Directories are only removed once empty, as concurrent uploads of the
+    package may be using them.
+    """
+    build = upload.build
+    if build.storage == "remote":
+        _discard_remote(upload)
+    for path in [upload.stored_path, *upload.icon_paths]:
+        if path is None:
+            continue
         try:
-            os.remove(os.path.join(data_path, build_path))
+            os.remove(path)
         except OSError:
             pass
+    version_path = os.path.dirname(
+        os.path.join(current_app.config["DATA_PATH"], build.path)
+    )
+    for path in (version_path, os.path.dirname(version_path)):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+
+
+def _discard_remote(upload):
+    """Remove the object of a build uploaded to Object Storage, unless a
+    concurrent upload of the same build registered it in the meantime."""
+    path = upload.build.path
+    registered = db.session.execute(
+        db.select(Build.id).filter(Build.path == path)
+    ).first()
+    if registered is None:
+        storage.delete(path)
+
+
+def _commit_uploads(uploads):
+    """Commit registered builds, aborting with 409 on a constraint violation."""
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        package = uploads[0].package
+        if "version_package_id_version_key" in str(e):
+            msg = (
+                f"Version {uploads[0].version.version_string} already exists"
+                f" for {package.name}"
+            )
+        elif "package_name_key" in str(e):
+            msg = f"Package {package.name} was created by another request"
+        else:
+            msg = "Database constraint violation"
+        abort(409, message=msg)
+
+
+def _register_stored_upload(upload):
+    """Register a stored upload under the package lock, discarding it if it is
+    rejected."""
+    try:
+        with package_lock(upload.spk.info["package"]):
+            _register_upload(upload)
+            db.session.add(upload.build)
+            _commit_uploads([upload])
+    except HTTPException:
+        db.session.rollback()
+        _discard_upload(upload)
+        raise
+
+
+def _queue_signing(upload, response):
+    """Sign in the background, the build stays inactive until it is signed.
+
+    The build is committed already, so a failure to queue the task is only
+    logged and the build is left unsigned, to be signed from the admin.
+    """
+    if current_app.config["GNUPG_PATH"] is not None and not upload.build.signed:
+        build = upload.build
+        try:
+            result = sign_build.delay(build.id, str(build))
+        except Exception:
+            logger.exception("Failed to queue signing of %s", build)
+            return response
+        track_user_task(current_user.id, result.id, "sign", str(build))
+        response["signing_task"] = result.id
+    return response
+
+
+def _stage_bulk_files(files, results, paths):
+    """Stream the files of a bulk upload to the staging directory of
+    :mod:`spkrepo.uploads`, one at a time, so they are hashed, parsed and
+    stored from disk. Files larger than ``MAX_CONTENT_LENGTH`` are rejected in
+    `results`.
+
+    :param paths: list the staged paths are appended to, None for the rejected
+                  files, so that the caller can remove them on failure
+    """
+    max_size = current_app.config["MAX_CONTENT_LENGTH"]
+    for f, result in zip(files, results):
+        path = uploads.temporary_path()
+        paths.append(path)
+        f.save(path)
+        f.close()
+        if max_size is not None and os.path.getsize(path) > max_size:
+            result.update(status=413, message="File exceeds the maximum SPK size")
+            os.remove(path)
+            paths[-1] = None
+
+
+def _hash_bulk_file(path):
+    """Hash one staged SPK of a bulk upload, returning its md5 and sha256."""
+    if path is None:
+        return None, None
+    hashes, _ = hash_file(path, ("md5", "sha256"))
+    return hashes["md5"], hashes["sha256"]
+
+
+def _parse_bulk_file(path):
+    """Parse one staged SPK of a bulk upload, returning ``(spk, error)``."""
+    if path is None:
+        return None, None
+    try:
+        with io.open(path, "rb") as f:
+            return SPK(f), None
+    except SPKParseError as e:
+        return None, str(e)
+
+
+def _prepare_bulk_uploads(results, digests, parsed, stored=None):
+    """Prepare the builds of a bulk upload in order, each one seeing the
+    previous ones, and record the files rejected in `results`.
+
+    :param stored: uploads stored after a first preparation, registered with
+                   :func:`_register_upload` instead, under the package lock
+    :returns: a tuple of the prepared uploads and of the rejected results
+    """
+    uploads = []
+    checked_versions = set()
+    stored = iter(stored) if stored is not None else None
+    rejected = [result for result in results if result.get("status", 200) != 200]
+    for result, digest, (spk, _) in zip(results, digests, parsed):
+        if rejected:
+            result.setdefault("message", "Not processed")
+            continue
+        if result.get("duplicate"):
+            continue
+        key = (spk.info["package"], spk.info["version"])
+        check_version_metadata = key not in checked_versions
+        try:
+            if stored is None:
+                upload = _prepare_upload(
+                    spk,
+                    check_version_metadata=check_version_metadata,
+                    digest=digest,
+                    lock=False,
+                )
+            else:
+                upload = next(stored)
+                _register_upload(upload, check_version_metadata)
+        except HTTPException as e:
+            message = getattr(e, "data", {}).get("message", e.description)
+            result.update(status=e.code, message=message)
+            rejected.append(result)
+            continue
+        checked_versions.add(key)
+        # flush so the next files find the package and version created here
+        db.session.add(upload.build)
+        db.session.flush()
+        uploads.append(upload)
+    return uploads, rejected
+
+
+def _register_bulk_files(results, paths):
+    """Register the staged SPKs of a bulk upload, see :meth:`BulkPackages.post`.
+
+    :param results: the result of each file, some already rejected
+    :param paths: the staged path of each file, None for the rejected ones
+    :returns: the response and its status
+    """
+    with ThreadPoolExecutor(
+        max_workers=current_app.config["API_BULK_PARSE_WORKERS"]
+    ) as pool:
+        md5s, digests = zip(*pool.map(_hash_bulk_file, paths))
+        # already uploaded files are not parsed again
+        duplicates = {
+            build.upload_digest: build
+            for build in db.session.execute(
+                db.select(Build).filter(Build.upload_digest.in_(set(digests) - {None}))
+            )
+            .unique()
+            .scalars()
+        }
+        parsed = list(
+            pool.map(
+                _parse_bulk_file,
+                [
+                    None if digest in duplicates else path
+                    for path, digest in zip(paths, digests)
+                ],
+            )
+        )
+
+    # version-level metadata must agree across the set
+    references = {}
+    for result, digest, (spk, error) in zip(results, digests, parsed):
+        if "status" in result:
+            continue
+        if digest in duplicates:
+            try:
+                duplicate = duplicates[digest]
+                _check_package_permission(duplicate.version.package)
+            except HTTPException as e:
+                result.update(status=e.code, message=e.data["message"])
+                continue
+            result.update(_duplicate_response(duplicate), status=200)
+            continue
+        if error is not None:
+            result.update(status=422, message=error)
+            continue
+        if spk.signature is not None:
+            result.update(status=422, message="Package contains a signature")
+            continue
+        key = (spk.info["package"], spk.info["version"])
+        metadata = extract_version_metadata(spk)
+        reference = references.setdefault(key, (result["filename"], metadata))
+        if reference[1] != metadata:
+            result.update(
+                status=422,
+                message=f"Version-level metadata differs from {reference[0]}",
+            )
+
+    uploads, rejected = _prepare_bulk_uploads(results, digests, parsed)
+    db.session.rollback()
+    if rejected:
+        return (
+            {"message": "No package was registered", "results": results},
+            rejected[0]["status"],
+        )
+    if not uploads:
+        return {"results": results}, 200
+
+    # stored first, concurrent uploads of the same packages only wait for
+    # each other to register their builds
+    created = [i for i, result in enumerate(results) if not result.get("duplicate")]
+    stored = []
+    try:
+        for i, upload in zip(created, uploads):
+            _store_upload(upload, staged_path=paths[i], md5=md5s[i])
+            stored.append(upload)
+    except HTTPException:
+        for upload in stored:
+            _discard_upload(upload)
+        raise
+
+    names = [upload.spk.info["package"] for upload in uploads]
+    try:
+        with package_lock(*names):
+            _, rejected = _prepare_bulk_uploads(
+                results, digests, parsed, stored=uploads
+            )
+            if rejected:
+                abort(
+                    rejected[0]["status"],
+                    message="No package was registered",
+                    results=results,
+                )
+            _commit_uploads(uploads)
+    except HTTPException:
+        db.session.rollback()
+        for upload in uploads:
+            _discard_upload(upload)
+        raise
+
+    for i, upload in zip(created, uploads):
+        results[i].update(_queue_signing(upload, upload.response()), status=201)
+    return {"results": results}, 201
+
+
+#: Version-level fields that cannot be known before the whole SPK is received
+PREFLIGHT_IGNORED_FIELDS = ("install_wizard", "upgrade_wizard", "license")
 
 
 class Packages(Resource):
@@ -98,6 +817,19 @@ class Packages(Resource):
            The created :class:`~spkrepo.models.Build` is not
            :attr:`~spkrepo.models.Build.active` by default
 
+        When signing is configured, the build is stored unsigned and a background
+        task signs it. The task id is returned as ``signing_task`` and the task
+        shows in the uploader's task status page. Builds cannot be activated
+        until they are signed.
+
+        With ``UPLOAD_DIRECT_TO_STORAGE``, the build is instead signed during the
+        request and streamed straight to Object Storage, with no local copy and
+        no ``signing_task``.
+
+        Uploading the exact same file again is idempotent: the SPK is not
+        processed again and the already registered build is returned with
+        ``"duplicate": true`` and a 200 status.
+
         **Example response:**
 
         .. sourcecode:: http
@@ -109,274 +841,314 @@ class Packages(Resource):
                 "architectures": ["88f628x"],
                 "firmware": "3.1-1594",
                 "package": "btsync",
-                "version": "1.4.103-10"
+                "version": "1.4.103-10",
+                "signing_task": "0b5c4b7e-..."
             }
 
+        :statuscode 200: The same SPK was already registered
         :statuscode 201: SPK registered
         :statuscode 400: Request contained no body
         :statuscode 403: Insufficient permission
         :statuscode 409: A :class:`~spkrepo.models.Build` already exists
         :statuscode 422: Invalid or malformed SPK
-        :statuscode 500: Signing or filesystem issue
+        :statuscode 500: Filesystem issue
         """
-        if not request.data:
+        data, md5, digest = _read_upload(request.stream)
+        if not data.getbuffer().nbytes:
             abort(400, message="No data to process")
 
+        duplicate = _find_duplicate(digest)
+        if duplicate is not None:
+            return _duplicate_response(duplicate), 200
+
         # open the spk
+        spk = _parse_spk(data)
+
+        # stored first, concurrent uploads of the same package only wait for
+        # each other to register their build
+        upload = _prepare_upload(spk, digest=digest, lock=False)
+        db.session.rollback()
+        _store_upload(upload, md5=md5)
+        _register_stored_upload(upload)
+
+        return _queue_signing(upload, upload.response()), 201
+
+
+class BulkPackages(Resource):
+    """Bulk packages resource"""
+
+    def post(self):
+        """Post several :abbr:`SPK (Synology Package)` files in a single
+        ``multipart/form-data`` request, typically all the builds of a version.
+
+        The SPKs are parsed in parallel and version-level metadata is checked
+        for consistency across the whole set, and against the database once per
+        version. Each SPK then goes through the same checks as
+        :meth:`Packages.post`. Builds are registered in a single transaction:
+        if any file is rejected, none is registered.
+
+        Each file is streamed to disk and parsed from there. The whole request
+        is limited by ``API_BULK_MAX_CONTENT_LENGTH`` and each file, like a
+        single upload, by ``MAX_CONTENT_LENGTH``.
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 201 CREATED
+
+            {
+                "results": [
+                    {
+                        "filename": "btsync_88f628x.spk",
+                        "status": 201,
+                        "architectures": ["88f628x"],
+                        "firmware": "3.1-1594",
+                        "package": "btsync",
+                        "version": "1.4.103-10"
+                    }
+                ]
+            }
+
+        When a file is rejected, the response status is the one of the first
+        rejected file, which carries its own ``status`` and ``message``. Files
+        after it are reported as not processed. Files that were already
+        uploaded are not processed again and are reported with a 200 status
+        and ``"duplicate": true``.
+
+        :statuscode 200: All SPKs were already registered
+        :statuscode 201: All SPKs registered
+        :statuscode 400: Request contained no files
+        :statuscode 403: Insufficient permission
+        :statuscode 409: A :class:`~spkrepo.models.Build` already exists
+        :statuscode 413: A file or the whole request is too large
+        :statuscode 422: Invalid, malformed or inconsistent SPK
+        :statuscode 500: Filesystem issue
+        """
+        # each SPK is limited by MAX_CONTENT_LENGTH, see _stage_bulk_files
+        request.max_content_length = current_app.config["API_BULK_MAX_CONTENT_LENGTH"]
+        files = [f for key in request.files for f in request.files.getlist(key)]
+        if not files:
+            abort(400, message="No data to process")
+
+        results = [{"filename": f.filename} for f in files]
+        paths = []
         try:
-            spk = SPK(io.BytesIO(request.data))
+            _stage_bulk_files(files, results, paths)
+            return _register_bulk_files(results, paths)
+        finally:
+            # registered SPKs were moved into place already
+            for path in paths:
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+
+
+class PackagesPreflight(Resource):
+    """Packages preflight resource"""
+
+    def post(self):
+        """Check whether an :abbr:`SPK (Synology Package)` would be accepted by
+        :http:post:`/packages`, without sending the whole package.
+
+        The body is either the leading bytes of the SPK, as long as they contain
+        the whole ``INFO`` member, or the content of the ``INFO`` file sent as
+        ``text/plain``. Architectures, firmware, services, permissions, version
+        metadata consistency and conflicting builds are checked. Wizards and
+        license are only compared by the actual upload. Nothing is written.
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+
+            {
+                "architectures": ["88f628x"],
+                "firmware": "3.1-1594",
+                "package": "btsync",
+                "version": "1.4.103-10",
+                "create_package": false,
+                "create_version": true
+            }
+
+        :statuscode 200: The SPK would be accepted
+        :statuscode 400: Request contained no body
+        :statuscode 403: Insufficient permission
+        :statuscode 409: A :class:`~spkrepo.models.Build` already exists
+        :statuscode 422: Invalid or malformed INFO
+        """
+        if not request.data:
+            abort(400, message="No data to process")
+
+        try:
+            spk = SPK.from_head(request.data)
         except SPKParseError as e:
             abort(422, message=str(e))
-
-        # reject signed packages
         if spk.signature is not None:
             abort(422, message="Package contains a signature")
 
-        # Architectures
+        upload = _Upload(spk)
         try:
-            architectures = resolve_architectures(db.session, spk.info.get("arch"))
-        except ValueError as e:
-            abort(422, message=str(e))
+            _resolve_reference_data(upload)
+            _find_or_create_package(upload)
+            _find_or_create_version(upload, ignore=PREFLIGHT_IGNORED_FIELDS)
+            _check_conflicts(upload, lock=False)
+        finally:
+            # discard the package and version built for the checks
+            db.session.rollback()
 
-        # Firmware min
-        input_firmware = spk.info.get("firmware") or spk.info.get("os_min_ver")
-        try:
-            firmware = resolve_firmware(db.session, input_firmware)
-        except ValueError as e:
-            abort(422, message=str(e))
+        response = upload.response()
+        response["create_package"] = upload.create_package
+        response["create_version"] = upload.create_version
+        return response
 
-        # Firmware max
-        firmware_max = None
-        input_firmware_max = spk.info.get("os_max_ver")
-        if input_firmware_max:
-            try:
-                firmware_max = resolve_firmware(db.session, input_firmware_max)
-            except ValueError as e:
-                abort(422, message=str(e))
-            if firmware_max.build < firmware.build:
-                abort(
-                    422,
-                    message=(
-                        "Maximum firmware must be greater than or equal to "
-                        "minimum firmware"
-                    ),
-                )
 
-        # Services — resolve once here; reused in version creation below
-        try:
-            services = resolve_services(spk.info.get("install_dep_services"))
-        except ValueError as e:
-            abort(422, message=str(e))
+#: Regex for an upload session id
+upload_session_re = re.compile(r"^[0-9a-f]{32}$")
 
-        # Package
-        create_package = False
-        package = Package.find(spk.info["package"])
-        if package is None:
-            if not current_user.has_role("package_admin"):
-                abort(403, message="Insufficient permissions to create new packages")
-            create_package = True
-            package = Package(name=spk.info["package"], author=current_user)
-        elif (
-            not current_user.has_role("package_admin")
-            and current_user not in package.maintainers
-        ):
-            abort(403, message="Insufficient permissions on this package")
-
-        # Version
-        create_version = False
-        match = version_re.match(spk.info["version"])
-        if not match:
-            abort(422, message="Invalid version")
-
-        version = {v.version: v for v in package.versions}.get(
-            int(match.group("version"))
-        )
 
-        if version is not None:
-            # Existing version — enforce full metadata consistency before proceeding.
-            # This catches cases where a build pipeline bug produces SPKs with
-            # differing version-level metadata (e.g. different SPK_VER) for builds
-            # that are part of the same logical release.
-            try:
-                assert_version_metadata_matches_db(version, spk)
-            except ValueError as e:
-                abort(422, message=str(e))
-        else:
-            create_version = True
-            version_startable = True
-            if spk.info.get("startable") is False or spk.info.get("ctl_stop") is False:
-                version_startable = False
-            version = Version(
-                package=package,
-                upstream_version=match.group("upstream_version"),
-                version=int(match.group("version")),
-                report_url=spk.info.get("report_url"),
-                distributor=spk.info.get("distributor"),
-                distributor_url=spk.info.get("distributor_url"),
-                maintainer=spk.info.get("maintainer"),
-                maintainer_url=spk.info.get("maintainer_url"),
-                install_wizard="install" in spk.wizards,
-                upgrade_wizard="upgrade" in spk.wizards,
-                startable=version_startable,
-                license=spk.license,
-            )
+def _check_upload_session(session_id, staged=True):
+    """Abort with 404 unless the upload session exists and belongs to the
+    current user.
 
-            with db.session.no_autoflush:
-                for key, value in spk.info.items():
-                    if key == "install_dep_services":
-                        version.service_dependencies = services
-                    elif key == "displayname":
-                        version.displaynames["enu"] = DisplayName(
-                            language=Language.find("enu"), displayname=value
-                        )
-                    elif key.startswith("displayname_"):
-                        language = Language.find(key.split("_", 1)[1])
-                        if not language:
-                            abort(422, message="Unknown INFO displayname language")
-                        version.displaynames[language.code] = DisplayName(
-                            language=language, displayname=value
-                        )
-
-            # Icon
-            for size, icon in spk.icons.items():
-                version.icons[size] = Icon(
-                    path=os.path.join(
-                        package.name, str(version.version), f"icon_{size}.png"
-                    ),
-                    size=size,
-                )
+    :param staged: also abort with 410 if the staged data of the session is
+        gone, e.g. moved into place by a commit that then failed. Such a
+        session is removed.
+    """
+    if (
+        not upload_session_re.match(session_id)
+        or uploads.owner(session_id) != current_user.id
+    ):
+        abort(404, message="Unknown upload session")
+    if staged and not os.path.isfile(uploads.data_path(session_id)):
+        uploads.discard(session_id)
+        abort(410, message="Upload session data is gone, start a new session")
 
-        # Build — conflict check is a no-op for new versions but kept unconditional
-        conflicts = set()
-        for existing_build in version.builds:
-            overlapping_architectures = set(existing_build.architectures) & set(
-                architectures
-            )
-            if not overlapping_architectures:
-                continue
-            existing_min_build = existing_build.firmware_min.build
-            existing_max_build = (
-                existing_build.firmware_max.build
-                if existing_build.firmware_max
-                else existing_min_build
-            )
-            candidate_min_build = firmware.build
-            candidate_max_build = (
-                firmware_max.build if firmware_max is not None else candidate_min_build
-            )
-            if (
-                candidate_min_build > existing_max_build
-                or candidate_max_build < existing_min_build
-            ):
-                continue
-            conflicts |= overlapping_architectures
-        if conflicts:
-            conflict_codes = ", ".join(sorted(a.code for a in conflicts))
-            abort(409, message=f"Conflicting architectures: {conflict_codes}")
 
-        build_filename = Build.generate_filename(
-            package, version, firmware, architectures
-        )
-        build = Build(
-            version=version,
-            architectures=architectures,
-            firmware_min=firmware,
-            firmware_max=firmware_max,
-            publisher=current_user,
-            path=os.path.join(package.name, str(version.version), build_filename),
-            checksum=spk.info.get("checksum"),
-            changelog=spk.info.get("changelog"),
-        )
+class Uploads(Resource):
+    """Resumable upload sessions resource"""
 
-        with db.session.no_autoflush:
-            for key, value in spk.info.items():
-                if key == "description":
-                    build.descriptions["enu"] = BuildDescription(
-                        description=value, language=Language.find("enu")
-                    )
-                elif key.startswith("description_"):
-                    language = Language.find(key.split("_", 1)[1])
-                    if not language:
-                        abort(422, message="Unknown INFO description language")
-                    build.descriptions[language.code] = BuildDescription(
-                        language=language, description=value
-                    )
-
-        build.buildmanifest = BuildManifest(
-            dependencies=spk.info.get("install_dep_packages"),
-            conf_dependencies=spk.conf_dependencies,
-            conflicts=spk.info.get("install_conflict_packages"),
-            conf_conflicts=spk.conf_conflicts,
-            conf_privilege=spk.conf_privilege,
-            conf_resource=spk.conf_resource,
-        )
+    def post(self):
+        """Create a resumable upload session.
 
-        # sign
-        if current_app.config["GNUPG_PATH"] is not None:
-            try:
-                spk.sign(
-                    current_app.config["GNUPG_TIMESTAMP_URL"],
-                    current_app.config["GNUPG_PATH"],
-                )
-            except SPKSignError as e:
-                abort(500, message="Failed to sign package", details=str(e))
-        if spk.signature is not None:
-            build.signed = True
+        Large SPKs can be sent in several chunks with :http:put:`/uploads/(id)`
+        and registered with :http:post:`/uploads/(id)/commit` once complete.
+        After a dropped connection, :http:get:`/uploads/(id)` returns the
+        offset to resume from. Sessions are removed after
+        ``UPLOAD_SESSION_TIMEOUT`` seconds without activity.
 
-        # save files
-        try:
-            data_path = current_app.config["DATA_PATH"]
-            if create_package:
-                os.makedirs(os.path.join(data_path, package.name), exist_ok=True)
-            if create_version:
-                os.makedirs(
-                    os.path.join(data_path, package.name, str(version.version)),
-                    exist_ok=True,
-                )
-                for size, icon in build.version.icons.items():
-                    icon.save(spk.icons[size])
-            build.save(spk.stream)
-            build.md5 = build.calculate_md5()
-            build.size = build.calculate_size()
-        except Exception as e:  # pragma: no cover
-            logger.exception("Failed to save SPK files for package %s", package.name)
-            _cleanup_on_failure(
-                data_path,
-                package.name,
-                version.version,
-                build.path,
-                create_package,
-                create_version,
-            )
-            abort(500, message="Failed to save files", details=str(e))
+        **Example response:**
 
-        # insert the package into database
-        db.session.add(build)
-        try:
-            db.session.commit()
-        except IntegrityError as e:
-            db.session.rollback()
-            if "version_package_id_version_key" in str(e):
-                msg = (
-                    f"Version {version.version_string} already exists"
-                    f" for {package.name}"
-                )
-            elif "package_name_key" in str(e):
-                msg = f"Package {package.name} was created by another request"
-            else:
-                msg = "Database constraint violation"
-            abort(409, message=msg)
+        .. sourcecode:: http
+
+            HTTP/1.1 201 CREATED
 
-        return (
             {
-                "package": package.name,
-                "version": version.version_string,
-                "firmware": firmware.firmware_string,
-                "architectures": [a.code for a in architectures],
-            },
-            201,
-        )
+                "id": "3f0c4e1dc2a44f3f9c0f2b3c1f7e5a9d",
+                "offset": 0
+            }
+
+        :statuscode 201: Upload session created
+        """
+        uploads.purge_expired(current_app.config["UPLOAD_SESSION_TIMEOUT"])
+        session_id = uploads.create(current_user.id)
+        return {"id": session_id, "offset": 0}, 201
+
+
+class Upload(Resource):
+    """Resumable upload session resource"""
+
+    def get(self, session_id):
+        """Return the number of bytes received so far as ``offset``.
+
+        :statuscode 200: Upload session found
+        :statuscode 404: Unknown upload session
+        :statuscode 410: The staged data of the upload session is gone
+        """
+        _check_upload_session(session_id)
+        return {"id": session_id, "offset": uploads.offset(session_id)}
+
+    def put(self, session_id):
+        """Append a chunk, sent as the request body, to the upload session.
+
+        :query offset: position of the chunk, must be the current ``offset``
+        :statuscode 200: Chunk stored, the new ``offset`` is returned
+        :statuscode 400: Missing offset
+        :statuscode 404: Unknown upload session
+        :statuscode 409: The offset does not match, the expected ``offset`` is
+                         returned
+        :statuscode 410: The staged data of the upload session is gone
+        :statuscode 413: The upload would exceed the maximum SPK size
+        """
+        _check_upload_session(session_id)
+        start = request.args.get("offset", type=int)
+        if start is None:
+            abort(400, message="Missing offset")
+        if start + len(request.data) > current_app.config["MAX_CONTENT_LENGTH"]:
+            abort(413, message="Upload exceeds the maximum SPK size")
+        try:
+            offset = uploads.append(session_id, start, request.data)
+        except uploads.UploadSessionError as e:
+            abort(409, message=str(e), offset=e.offset)
+        return {"id": session_id, "offset": offset}
+
+    def delete(self, session_id):
+        """Abandon the upload session.
+
+        :statuscode 204: Upload session removed
+        :statuscode 404: Unknown upload session
+        """
+        _check_upload_session(session_id, staged=False)
+        uploads.discard(session_id)
+        return "", 204
+
+
+class UploadCommit(Resource):
+    """Resumable upload session commit resource"""
+
+    def post(self, session_id):
+        """Register the SPK assembled in the upload session.
+
+        The SPK goes through the same checks as :http:post:`/packages` and the
+        response is the same, including for an SPK that was already uploaded.
+        The session is removed once the SPK is registered.
+
+        :statuscode 200: The same SPK was already registered
+        :statuscode 201: SPK registered
+        :statuscode 400: Upload session contained no data
+        :statuscode 403: Insufficient permission
+        :statuscode 404: Unknown upload session
+        :statuscode 409: A :class:`~spkrepo.models.Build` already exists
+        :statuscode 410: The staged data of the upload session is gone
+        :statuscode 422: Invalid or malformed SPK
+        :statuscode 500: Filesystem issue
+        """
+        _check_upload_session(session_id)
+        md5, digest, size = uploads.digests(session_id)
+        if not size:
+            abort(400, message="No data to process")
+
+        duplicate = _find_duplicate(digest)
+        if duplicate is not None:
+            uploads.discard(session_id)
+            return _duplicate_response(duplicate), 200
+
+        staged_path = uploads.data_path(session_id)
+        with io.open(staged_path, "rb") as stream:
+            spk = _parse_spk(stream)
+        upload = _prepare_upload(spk, digest=digest, lock=False)
+        db.session.rollback()
+        _store_upload(upload, staged_path=staged_path, md5=md5)
+        _register_stored_upload(upload)
+        uploads.discard(session_id)
+
+        return _queue_signing(upload, upload.response()), 201
 
 
 restful_api = Api(api, decorators=[api_auth_required])
 restful_api.add_resource(Packages, "/packages")
+restful_api.add_resource(BulkPackages, "/packages/bulk")
+restful_api.add_resource(PackagesPreflight, "/packages/preflight")
+restful_api.add_resource(Uploads, "/uploads")
+restful_api.add_resource(Upload, "/uploads/<session_id>")
+restful_api.add_resource(UploadCommit, "/uploads/<session_id>/commit")
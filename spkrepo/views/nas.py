@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+from urllib.parse import quote
+
 import gnupg
 from flask import (
     Blueprint,
@@ -12,7 +16,9 @@ from flask import (
     url_for,
 )
 from sqlalchemy.orm import aliased
+from werkzeug.utils import send_from_directory as werkzeug_send_from_directory
 
+from .. import reference, remote_cache, storage
 from ..ext import cache, db
 from ..models import (
     Architecture,
@@ -20,7 +26,6 @@ from ..models import (
     BuildDescription,
     DisplayName,
     Firmware,
-    Language,
     Package,
     PackageDownloadCounts,
     Version,
@@ -28,17 +33,21 @@ from ..models import (
 
 nas = Blueprint("nas", __name__)
 
+#: Surrogate key of every catalog response, purged from the CDN at once
+CATALOG_SURROGATE_KEY = "catalog"
+
+#: Regex for the path of a version icon
+icon_path_re = re.compile(r"^[^/]+/\d+/icon_\d+\.png$")
+
 
-@cache.memoize(timeout=600)
 def is_valid_arch(arch):
     """Return True if arch is a known Architecture code."""
-    return Architecture.find(arch) is not None
+    return reference.architecture(arch) is not None
 
 
-@cache.memoize(timeout=600)
 def is_valid_language(language):
     """Return True if language is a known Language code."""
-    return Language.find(language) is not None
+    return reference.language(language) is not None
 
 
 @cache.memoize(timeout=600)
@@ -289,9 +298,54 @@ def clear_catalog_cache():
 
     Called by admin actions and background tasks whenever build metadata
     or activation state changes, so Synology devices see fresh data
-    without waiting for the memoize timeout to expire.
+    without waiting for the memoize timeout to expire. The catalog cached by
+    the CDN is purged through its surrogate key.
     """
     cache.delete_memoized(get_catalog)
+    storage.purge_cdn(keys=[CATALOG_SURROGATE_KEY])
+
+
+def find_build(path, storage=None):
+    """Look up a build by its path, through the index on :attr:`Build.path`.
+
+    :param storage: only return a build in this storage, ``local`` or
+                    ``remote``
+    :returns: a row with the ``md5``, ``size`` and ``storage`` of the build,
+              None if not found
+    """
+    if not path.endswith(".spk"):
+        return None
+    query = db.select(Build.md5, Build.size, Build.storage).filter(Build.path == path)
+    if storage is not None:
+        query = query.filter(Build.storage == storage)
+    return db.session.execute(query).first()
+
+
+def _file_etag(path):
+    """Return an ETag of the file at `path` from its inode, modification time
+    and size, so it changes as soon as the file is rewritten."""
+    stat = os.stat(path)
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def _redirect_remote(path):
+    """Redirect to the CDN, or to a presigned URL of the packages bucket, for
+    the remote build at `path`. The redirect itself can be cached, for less
+    time than the presigned URL is valid."""
+    config = current_app.config
+    max_age = config["REMOTE_REDIRECT_MAX_AGE"]
+    if config["PACKAGES_CDN_HOST"]:
+        location = f"https://{config['PACKAGES_CDN_HOST']}/{quote(path)}"
+    else:
+        expires = config["REMOTE_PRESIGNED_URL_EXPIRES"]
+        location = storage.presigned_url(path, expires)
+        if location is None:
+            abort(503)
+        max_age = min(max_age, expires // 2)
+    response = redirect(location)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
 
 
 @nas.route("/", methods=["POST", "GET"])
@@ -390,16 +444,111 @@ def catalog():
         major = int(closest_firmware.version.split(".")[0])
 
     result = get_catalog(arch, build, major, language, beta)
-    return Response(json.dumps(result), mimetype="application/json")
+    return Response(
+        json.dumps(result),
+        mimetype="application/json",
+        headers={"Surrogate-Key": CATALOG_SURROGATE_KEY},
+    )
+
+
+def _send_data_file(directory, path, etag=True, accel_redirect=None):
+    """Send the file at `path` under `directory`.
+
+    SPKs and icons are cacheable for ``DATA_MAX_AGE``, then revalidated with
+    their ETag. Conditional and range requests are answered here, unless the transfer is
+    handed to the front proxy with an ``X-Accel-Redirect`` to `accel_redirect`
+    or with ``USE_X_SENDFILE``, which then serves the ranges itself.
+
+    :param etag: ETag of the file, computed from its stat if True
+    :param accel_redirect: internal location of `directory` in the front proxy
+    """
+    max_age = None
+    if path.endswith(".spk") or icon_path_re.match(path) is not None:
+        max_age = current_app.config["DATA_MAX_AGE"]
+    if accel_redirect is None and not current_app.config["USE_X_SENDFILE"]:
+        response = send_from_directory(directory, path, etag=etag, max_age=max_age)
+    else:
+        environ = dict(request.environ)
+        environ.pop("HTTP_RANGE", None)
+        response = werkzeug_send_from_directory(
+            directory,
+            path,
+            environ,
+            etag=etag,
+            max_age=max_age,
+            use_x_sendfile=True,
+            response_class=current_app.response_class,
+        )
+        sendfile = response.headers.pop("X-Sendfile", None)
+        if sendfile is not None:
+            if accel_redirect is not None:
+                response.headers["X-Accel-Redirect"] = (
+                    accel_redirect.rstrip("/") + "/" + quote(path)
+                )
+            else:
+                response.headers["X-Sendfile"] = sendfile
+        response.accept_ranges = "bytes"
+    return response
 
 
 @nas.route("/<path:path>")
 def data(path):
     """Serve a file (SPK, icon, or screenshot) from local storage.
 
+    Local files carry an ETag of their stat, which changes as soon as a file is
+    rewritten in place, and remote builds their md5. Responses are tagged with the
+    :func:`~spkrepo.storage.data_surrogate_key` of `path` so files rewritten in
+    place can be purged from the CDN. The transfer is handed to the front proxy
+    when ``DATA_ACCEL_REDIRECT`` or ``USE_X_SENDFILE`` is configured.
+
+    Builds stored in Object Storage are served from a local copy when
+    ``REMOTE_CACHE_PATH`` is configured, see :mod:`spkrepo.remote_cache`.
+    Otherwise the client is redirected to the CDN when ``PACKAGES_CDN_HOST`` is
+    configured, or to a short-lived presigned URL of the packages bucket.
+
     :param path: relative file path under DATA_PATH, as returned by the
         catalog's ``link``/``thumbnail``/``snapshot`` URLs
     :statuscode 200: file returned
-    :statuscode 404: no file exists at the given path
+    :statuscode 206: part of the file returned
+    :statuscode 302: the file is a build stored in Object Storage
+    :statuscode 304: the file did not change
+    :statuscode 404: no file exists at the given path, or it is hidden, such as
+        the staged data of an upload session
+    :statuscode 503: a remote build could not be fetched from Object Storage
     """
-    return send_from_directory(current_app.config["DATA_PATH"], path)
+    if any(part.startswith(".") for part in path.split("/")):
+        abort(404)
+    config = current_app.config
+    data_path = config["DATA_PATH"]
+    file_path = os.path.join(data_path, path)
+    if os.path.isfile(file_path):
+        try:
+            etag = _file_etag(file_path)
+        except FileNotFoundError:
+            abort(404)
+        response = _send_data_file(
+            data_path, path, etag=etag, accel_redirect=config["DATA_ACCEL_REDIRECT"]
+        )
+        response.headers["Surrogate-Key"] = storage.data_surrogate_key(path)
+        return response
+    if storage.storage_configured():
+        remote = find_build(path, "remote")
+        if remote is not None:
+            # the cached copy is named and verified after the md5
+            if not remote_cache.cache_configured() or remote.md5 is None:
+                return _redirect_remote(path)
+            cached_path = remote_cache.fetch(path, remote.md5, remote.size)
+            if cached_path is None:
+                abort(503)
+            response = _send_data_file(
+                os.path.dirname(cached_path),
+                os.path.basename(cached_path),
+                etag=remote.md5,
+                accel_redirect=config["REMOTE_CACHE_ACCEL_REDIRECT"],
+            )
+            response.headers.set(
+                "Content-Disposition", "inline", filename=os.path.basename(path)
+            )
+            response.headers["Surrogate-Key"] = storage.data_surrogate_key(path)
+            return response
+    abort(404)
@@ -1,32 +1,162 @@
 # -*- coding: utf-8 -*-
-import hashlib
 import io
-import json
 import os
-import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+from types import SimpleNamespace
 
 from flask import current_app
+from sqlalchemy import select
 
 from .. import storage
+from ..exceptions import SPKSignError
 from ..ext import cache, celery, db
-from ..models import Build
+from ..hashing import hash_file
+from ..models import Build, BuildSidecar, read_member_index, read_sidecar_file
 from ..utils import (
-    SPK,
+    Signer,
     apply_info_from_spk,
     apply_sidecar_to_db,
     extract_version_metadata,
+    load_remote_spk,
+    load_spk,
 )
 from .nas import clear_catalog_cache
 
 
+def user_tasks_key(user_id):
+    """Return the cache key listing background tasks queued on behalf of a user
+    outside of an admin session, e.g. signing after an API upload."""
+    return f"background_tasks:user:{user_id}"
+
+
+#: Seconds a user's task list stays locked by :func:`track_user_task`
+USER_TASKS_LOCK_TIMEOUT = 10
+
+
+def track_user_task(user_id, task_id, task_type, label):
+    """Record a queued task so it shows in the user's task status page.
+
+    The list is updated under a per-user lock taken in the cache, so concurrent
+    uploads of the same user do not drop each other's tasks. The task is not
+    recorded if the lock cannot be taken within
+    :data:`USER_TASKS_LOCK_TIMEOUT`.
+    """
+    key = user_tasks_key(user_id)
+    lock_key = f"{key}:lock"
+    deadline = time.monotonic() + USER_TASKS_LOCK_TIMEOUT
+    while not cache.add(lock_key, task_id, timeout=USER_TASKS_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            current_app.logger.warning(
+                "Task %s not tracked for user %s: task list locked", task_id, user_id
+            )
+            return
+        time.sleep(0.05)
+    try:
+        existing = cache.get(key) or []
+        cache.set(
+            key,
+            existing + [{"id": task_id, "type": task_type, "label": label}],
+            timeout=86400,
+        )
+    finally:
+        cache.delete(lock_key)
+
+
+def _transfer_progress(task):
+    """Return a callable reporting the progress of a transfer through the
+    ``PROGRESS`` state of `task`, None if it does not run in a worker."""
+    if not task.request.id:
+        return None
+
+    def report(done, total, rate):
+        task.update_state(
+            state="PROGRESS", meta={"done": done, "total": total, "rate": rate}
+        )
+
+    return report
+
+
+def _raw_info(spk):
+    """Return the INFO of a parsed SPK as raw strings, as stored in sidecars."""
+    return {
+        key: ("yes" if value else "no") if isinstance(value, bool) else value
+        for key, value in spk.info.items()
+    }
+
+
+def _sidecar_metadata(sidecar):
+    """Return the version-level metadata of a build from its sidecar."""
+    derived = sidecar["derived"]
+    info = dict(sidecar["info"], startable=derived["startable"])
+    info.pop("ctl_stop", None)
+    wizards = {name for name in ("install", "upgrade") if derived.get(f"{name}_wizard")}
+    return extract_version_metadata(
+        SimpleNamespace(info=info, wizards=wizards, license=derived.get("license"))
+    )
+
+
+def _sibling_metadata(sibling, sidecar=None):
+    """Return the version-level metadata of another build of the version, from
+    its sidecar, its local file or its object in Object Storage. None if it
+    cannot be read.
+
+    :param sidecar: sidecar of the sibling, if it has one
+    """
+    if sidecar is None and sibling.storage == "remote":
+        sidecar = read_sidecar_file(sibling.path)
+    if sidecar is not None:
+        return _sidecar_metadata(sidecar)
+    spk_path = os.path.join(current_app.config["DATA_PATH"], sibling.path)
+    if os.path.exists(spk_path):
+        with io.open(spk_path, "rb") as f:
+            return extract_version_metadata(load_spk(f, sibling.member_index))
+    if sibling.storage == "remote" and storage.storage_configured():
+        return extract_version_metadata(
+            load_remote_spk(sibling.path, sibling.member_index)
+        )
+    return None
+
+
+def _check_siblings(build, spk):
+    """Raise ValueError if the version-level metadata of `spk` differs from the
+    one of the other builds of the version.
+
+    The sidecars of the siblings are loaded with a single query.
+    """
+    incoming_meta = extract_version_metadata(spk)
+    siblings = [s for s in build.version.builds if s.id != build.id and s.path]
+    if not siblings:
+        return
+    sidecars = {
+        row.build_id: {"info": row.info, "derived": row.derived}
+        for row in db.session.execute(
+            select(
+                BuildSidecar.build_id, BuildSidecar.info, BuildSidecar.derived
+            ).where(BuildSidecar.build_id.in_([s.id for s in siblings]))
+        )
+    }
+    for sibling in siblings:
+        sibling_meta = _sibling_metadata(sibling, sidecars.get(sibling.id))
+        if sibling_meta is not None and sibling_meta != incoming_meta:
+            raise ValueError(
+                "Version-level metadata mismatch between "
+                f"{os.path.basename(build.path)} and "
+                f"{os.path.basename(sibling.path)} — resync aborted."
+            )
+
+
 @celery.task(bind=True, max_retries=3, default_retry_delay=10, queue="ops")
 def resync_build_metadata(self, build_id, build_label):
-    """Re-read build metadata from sidecar or SPK and reapply to DB.
-
-    If the build has a sidecar (Object Storage), reads metadata from the
-    sidecar. Otherwise parses the local .spk file and checks consistency
-    against siblings.
+    """Re-read build metadata from Object Storage, sidecar or SPK and reapply to
+    DB.
+
+    Builds in Object Storage are read with range requests when it is
+    configured, fetching only the small members of the SPK. Members are located
+    through the stored member index of the build when it has one. Otherwise, if the
+    build has a sidecar, reads metadata from the sidecar. Otherwise parses the
+    local .spk file. The SPK is checked for consistency against siblings.
     """
     build = db.session.get(Build, build_id)
     if not build or not build.path:
@@ -34,11 +164,18 @@ def resync_build_metadata(self, build_id, build_label):
 
     try:
         data_path = current_app.config["DATA_PATH"]
-        sidecar_path = os.path.join(data_path, build.path + ".json")
 
-        if os.path.exists(sidecar_path):
-            with io.open(sidecar_path, "r", encoding="utf-8") as f:
-                sidecar = json.load(f)
+        if build.storage == "remote" and storage.storage_configured():
+            spk = load_remote_spk(build.path, build.member_index)
+            _check_siblings(build, spk)
+            apply_info_from_spk(db.session, build, spk, build.md5)
+            db.session.commit()
+            cache.delete("packages_versions")
+            clear_catalog_cache()
+            return {"status": "ok", "build_id": build_id, "label": build_label}
+
+        sidecar = build.load_sidecar()
+        if sidecar is not None:
             apply_sidecar_to_db(db.session, build, sidecar)
             db.session.commit()
             cache.delete("packages_versions")
@@ -48,31 +185,8 @@ def resync_build_metadata(self, build_id, build_label):
         # No sidecar — read from local .spk
         file_path = os.path.join(data_path, build.path)
         with io.open(file_path, "rb") as stream:
-            spk = SPK(stream)
-            incoming_meta = extract_version_metadata(spk)
-
-            for sibling in build.version.builds:
-                if sibling.id == build.id or not sibling.path:
-                    continue
-                sibling_spk_path = os.path.join(data_path, sibling.path)
-                sibling_sidecar_path = sibling_spk_path + ".json"
-                if os.path.exists(sibling_sidecar_path):
-                    with io.open(sibling_sidecar_path, "r", encoding="utf-8") as s2:
-                        sc = json.load(s2)
-                    sibling_meta = extract_version_metadata(
-                        type("_", (), {"info": sc["info"]})()
-                    )
-                elif os.path.exists(sibling_spk_path):
-                    with io.open(sibling_spk_path, "rb") as s2:
-                        sibling_meta = extract_version_metadata(SPK(s2))
-                else:
-                    continue
-                if sibling_meta != incoming_meta:
-                    raise ValueError(
-                        "Version-level metadata mismatch between "
-                        f"{os.path.basename(build.path)} and "
-                        f"{os.path.basename(sibling.path)} — resync aborted."
-                    )
+            spk = load_spk(stream, build.member_index)
+            _check_siblings(build, spk)
 
             md5 = spk.calculate_md5()
             apply_info_from_spk(db.session, build, spk, md5)
@@ -104,25 +218,215 @@ def resync_build_metadata(self, build_id, build_label):
             }
 
 
+@celery.task(bind=True, max_retries=3, default_retry_delay=10, queue="ops")
+def sign_build(self, build_id, build_label):
+    """Sign a local build and mark it as signed.
+
+    Queued by the API after an upload so the request does not wait on the
+    timestamp server. Timestamp failures are retried; the build stays unsigned,
+    and therefore cannot be activated, until this succeeds.
+    """
+    build = db.session.get(Build, build_id)
+    if not build or not build.path:
+        return {
+            "status": "skipped",
+            "type": "sign",
+            "build_id": build_id,
+            "label": build_label,
+        }
+    if build.storage != "local":
+        return {
+            "status": "error",
+            "type": "sign",
+            "build_id": build_id,
+            "label": build_label,
+            "error": "Build is not stored locally",
+        }
+    if current_app.config["GNUPG_PATH"] is None:
+        return {
+            "status": "error",
+            "type": "sign",
+            "build_id": build_id,
+            "label": build_label,
+            "error": "GNUPG_PATH is not configured",
+        }
+
+    try:
+        file_path = os.path.join(current_app.config["DATA_PATH"], build.path)
+        with io.open(file_path, "rb+") as f:
+            spk = load_spk(f)
+            if spk.signature is None:
+                spk.sign(
+                    current_app.config["GNUPG_TIMESTAMP_URL"],
+                    current_app.config["GNUPG_PATH"],
+                )
+                storage.purge_data_files(build.path)
+        build.md5 = build.calculate_md5()
+        build.size = build.calculate_size()
+        build.member_index = build.calculate_member_index()
+        build.signed = True
+        db.session.commit()
+        cache.delete("packages_versions")
+        clear_catalog_cache()
+        return {
+            "status": "ok",
+            "type": "sign",
+            "build_id": build_id,
+            "label": build_label,
+        }
+
+    except SPKSignError as exc:
+        db.session.rollback()
+        try:
+            raise self.retry(exc=exc)
+        except self.MaxRetriesExceededError:
+            return {
+                "status": "error",
+                "type": "sign",
+                "build_id": build_id,
+                "label": build_label,
+                "error": str(exc),
+            }
+
+    except Exception as exc:
+        db.session.rollback()
+        return {
+            "status": "error",
+            "type": "sign",
+            "build_id": build_id,
+            "label": build_label,
+            "error": str(exc),
+        }
+
+
+def _in_worker(app, func, *args):
+    """Call `func` from a worker thread, in an application context of `app`.
+
+    :returns: the result of `func` and the CDN purges it queued, to be queued
+              again by the task with :func:`~spkrepo.storage.queue_purges`
+    """
+    with app.app_context():
+        return func(*args), storage.pending_purges()
+
+
+def _sign_file(file_path, signer):
+    """Sign an SPK file from a worker thread of :func:`sign_builds`. The
+    signed file is hashed in the same thread.
+
+    :returns: the md5 and size of the signed file, None if it already was
+    """
+    with io.open(file_path, "rb+") as f:
+        spk = load_spk(f)
+        if spk.signature is not None:
+            return None
+        if signer is None:
+            raise ValueError("GNUPG_PATH is not configured")
+        spk.sign(signer=signer)
+    digests, size = hash_file(file_path)
+    return digests["md5"], size
+
+
+@celery.task(bind=True, queue="ops")
+def sign_builds(self, build_ids):
+    """Sign many local builds at once.
+
+    Files are signed concurrently by a bounded thread pool sharing a single
+    :class:`~spkrepo.utils.Signer`, so the GPG context and the connections to
+    the timestamp server are reused. Signed files are hashed by the same
+    threads. Database updates stay in the task's own thread and are committed
+    per build. The CDN purges of all the builds are flushed once, at the end.
+    Progress is reported through the ``PROGRESS`` task state.
+
+    Builds already carrying a signature are only flagged as signed.
+    """
+    config = current_app.config
+    signed, recovered, skipped, failed = [], [], [], []
+    pending = {}
+    builds = db.session.execute(select(Build).where(Build.id.in_(build_ids)))
+    for build in builds.unique().scalars():
+        if build.storage != "local" or not build.path:
+            skipped.append(str(build))
+            continue
+        pending[build.id] = os.path.join(config["DATA_PATH"], build.path)
+
+    signer = None
+    if config["GNUPG_PATH"] is not None:
+        signer = Signer(
+            config["GNUPG_TIMESTAMP_URL"],
+            config["GNUPG_PATH"],
+            retries=config["GNUPG_TIMESTAMP_RETRIES"],
+            backoff=config["GNUPG_TIMESTAMP_BACKOFF"],
+            pool_size=config["GNUPG_SIGNING_WORKERS"],
+        )
+    app = current_app._get_current_object()
+    try:
+        with ThreadPoolExecutor(max_workers=config["GNUPG_SIGNING_WORKERS"]) as pool:
+            futures = {
+                pool.submit(_in_worker, app, _sign_file, file_path, signer): build_id
+                for build_id, file_path in pending.items()
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                build = db.session.get(Build, futures[future])
+                label = str(build)
+                try:
+                    signed_file, purges = future.result()
+                    storage.queue_purges(*purges)
+                    if signed_file is not None:
+                        storage.purge_data_files(build.path)
+                        build.md5, build.size = signed_file
+                        build.member_index = build.calculate_member_index()
+                        signed.append(label)
+                    elif build.signed:
+                        skipped.append(label)
+                    else:
+                        recovered.append(label)
+                    build.signed = True
+                    db.session.commit()
+                except Exception as exc:
+                    db.session.rollback()
+                    failed.append([label, str(exc) or "unknown error"])
+                if self.request.id:
+                    self.update_state(
+                        state="PROGRESS", meta={"done": done, "total": len(futures)}
+                    )
+    finally:
+        if signer is not None:
+            signer.close()
+
+    if signed or recovered:
+        cache.delete("packages_versions")
+        clear_catalog_cache()
+    result = {
+        "status": "error" if failed else "ok",
+        "type": "sign",
+        "label": f"Sign {len(build_ids)} build(s)",
+        "signed": signed,
+        "recovered": recovered,
+        "skipped": skipped,
+        "failed": failed,
+    }
+    if failed:
+        result["error"] = "; ".join(f"{label}: {error}" for label, error in failed)
+    return result
+
+
 @celery.task(bind=True, max_retries=3, default_retry_delay=10, queue="ops")
 def resync_build_file(self, build_id, build_label):
-    """Recalculate md5 and size from sidecar or local file."""
+    """Recalculate md5, size and member index from sidecar or local file."""
     build = db.session.get(Build, build_id)
     if not build or not build.path:
         return {"status": "skipped", "build_id": build_id, "label": build_label}
 
     try:
-        data_path = current_app.config["DATA_PATH"]
-        sidecar_path = os.path.join(data_path, build.path + ".json")
-
-        if os.path.exists(sidecar_path):
-            with io.open(sidecar_path, "r", encoding="utf-8") as f:
-                sidecar = json.load(f)
+        sidecar = build.load_sidecar()
+        if sidecar is not None:
             build.md5 = sidecar["calculated"]["md5"]
             build.size = sidecar["calculated"]["size"]
+            build.member_index = sidecar["calculated"].get("member_index")
         else:
             build.md5 = build.calculate_md5()
             build.size = build.calculate_size()
+            build.member_index = build.calculate_member_index()
 
         db.session.commit()
         cache.delete("packages_versions")
@@ -151,9 +455,81 @@ def resync_build_file(self, build_id, build_label):
             }
 
 
+def make_sidecar(spk, object_key, digests, size, member_index):
+    """Build the sidecar of an SPK stored in Object Storage.
+
+    :param spk: the parsed :class:`~spkrepo.utils.SPK`
+    :param object_key: key of the SPK in the packages bucket
+    :param digests: md5 and sha256 hex digests of the SPK
+    :param size: size of the SPK
+    :param member_index: member index of the SPK
+    """
+    info = _raw_info(spk)
+    return {
+        "info": info,
+        "derived": {
+            "install_wizard": "install" in spk.wizards,
+            "upgrade_wizard": "upgrade" in spk.wizards,
+            "startable": (
+                info.get("startable", "yes") != "no"
+                and info.get("ctl_stop", "yes") != "no"
+            ),
+            "license": spk.license,
+        },
+        "calculated": {
+            "md5": digests["md5"],
+            "sha256": digests["sha256"],
+            "size": size,
+            "member_index": member_index,
+            "uploaded_at": datetime.now(timezone.utc).isoformat(),
+            "object_storage_key": object_key,
+            "sidecar_version": 1,
+        },
+    }
+
+
+def _read_sidecar(spk_path, object_key, member_index=None):
+    """Parse and hash a local SPK about to be uploaded to Object Storage and
+    make its sidecar.
+
+    :param spk_path: path of the SPK
+    :param object_key: key of the SPK in the packages bucket
+    :param member_index: stored member index of the SPK
+    :returns: the sidecar
+    """
+    with io.open(spk_path, "rb") as f:
+        spk = load_spk(f, member_index)
+    digests, file_size = hash_file(spk_path, ("md5", "sha256"))
+    return make_sidecar(
+        spk, object_key, digests, file_size, read_member_index(spk_path)
+    )
+
+
+def _check_uploadable(build, spk_path):
+    """Return why a build cannot be uploaded to Object Storage, None if it can.
+
+    A sidecar file left next to a local build by an older upload is removed.
+
+    :returns: a tuple of the result status and error, or None
+    """
+    if not os.path.exists(spk_path):
+        return "error", "File not found on disk"
+    if not build.signed:
+        return "error", "Build is not signed"
+    if build.storage == "remote":
+        return "skipped", "Already uploaded"
+    sidecar_path = spk_path + ".json"
+    if os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+    return None
+
+
 @celery.task(bind=True, max_retries=3, default_retry_delay=10, queue="ops")
 def upload_to_storage(self, build_id, build_label):
-    """Upload a signed, active build from local disk to Object Storage."""
+    """Upload a signed, active build from local disk to Object Storage.
+
+    Transfer progress is reported through the ``PROGRESS`` task state.
+    """
     build = db.session.get(Build, build_id)
     if not build or not build.path:
         return {
@@ -166,104 +542,22 @@ def upload_to_storage(self, build_id, build_label):
     data_path = current_app.config["DATA_PATH"]
     spk_path = os.path.join(data_path, build.path)
     object_key = build.path
-    sidecar_path = spk_path + ".json"
 
-    if not os.path.exists(spk_path):
-        return {
-            "status": "error",
-            "type": "upload",
-            "build_id": build_id,
-            "label": build_label,
-            "error": "File not found on disk",
-        }
-
-    if not build.signed:
+    rejected = _check_uploadable(build, spk_path)
+    if rejected is not None:
+        status, error = rejected
         return {
-            "status": "error",
+            "status": status,
             "type": "upload",
             "build_id": build_id,
             "label": build_label,
-            "error": "Build is not signed",
+            "error": error,
         }
 
-    if os.path.exists(sidecar_path):
-        if build.storage == "remote":
-            return {
-                "status": "skipped",
-                "type": "upload",
-                "build_id": build_id,
-                "label": build_label,
-                "error": "Already uploaded (sidecar exists)",
-            }
-        os.remove(sidecar_path)
-
     try:
-        info = {}
-        install_wizard = False
-        upgrade_wizard = False
-        license_text = None
-
-        with tarfile.open(spk_path, "r:") as archive:
-            names = archive.getnames()
-            if "INFO" in names:
-                info_stream = archive.extractfile("INFO")
-                if info_stream:
-                    raw = info_stream.read().decode("utf-8").strip()
-                    for line in raw.split("\n"):
-                        if "=" not in line:
-                            continue
-                        eq = line.index("=")
-                        key = line[:eq].strip()
-                        val = line[eq + 1 :].strip().strip('"')
-                        info[key] = val
-            if "WIZARD_UIFILES/install_uifile" in names:
-                install_wizard = True
-            if "WIZARD_UIFILES/upgrade_uifile" in names:
-                upgrade_wizard = True
-            if "LICENSE" in names:
-                lic_stream = archive.extractfile("LICENSE")
-                if lic_stream:
-                    license_text = (
-                        lic_stream.read().decode("utf-8", errors="replace").strip()
-                    )
-
-        md5_hash = hashlib.md5()
-        sha256_hash = hashlib.sha256()
-        file_size = 0
-        with io.open(spk_path, "rb") as f:
-            for chunk in iter(lambda: f.read(65536), b""):
-                md5_hash.update(chunk)
-                sha256_hash.update(chunk)
-                file_size += len(chunk)
-
-        sidecar = {
-            "info": info,
-            "derived": {
-                "install_wizard": install_wizard,
-                "upgrade_wizard": upgrade_wizard,
-                "startable": (
-                    info.get("startable", "yes") != "no"
-                    and info.get("ctl_stop", "yes") != "no"
-                ),
-                "license": license_text,
-            },
-            "calculated": {
-                "md5": md5_hash.hexdigest(),
-                "sha256": sha256_hash.hexdigest(),
-                "size": file_size,
-                "uploaded_at": datetime.now(timezone.utc).isoformat(),
-                "object_storage_key": object_key,
-                "sidecar_version": 1,
-            },
-        }
-
-        tmp_sidecar = sidecar_path + ".tmp"
-        with io.open(tmp_sidecar, "w", encoding="utf-8") as f:
-            json.dump(sidecar, f, indent=2, ensure_ascii=False)
-        os.rename(tmp_sidecar, sidecar_path)
+        sidecar = _read_sidecar(spk_path, object_key, build.member_index)
 
-        if not storage.upload(spk_path, object_key):
-            os.remove(sidecar_path)
+        if not storage.upload(spk_path, object_key, _transfer_progress(self)):
             return {
                 "status": "error",
                 "type": "upload",
@@ -274,12 +568,12 @@ def upload_to_storage(self, build_id, build_label):
 
         build.md5 = sidecar["calculated"]["md5"]
         build.size = sidecar["calculated"]["size"]
+        build.member_index = sidecar["calculated"]["member_index"]
+        build.sidecar = BuildSidecar.from_dict(sidecar)
         build.storage = "remote"
         db.session.commit()
     except Exception as exc:
         db.session.rollback()
-        if os.path.exists(sidecar_path):
-            os.remove(sidecar_path)
         return {
             "status": "error",
             "type": "upload",
@@ -302,9 +596,145 @@ def upload_to_storage(self, build_id, build_label):
     }
 
 
+#: Number of builds committed together by :func:`upload_builds`
+UPLOAD_COMMIT_SIZE = 50
+
+
+def _upload_file(spk_path, object_key, member_index):
+    """Make the sidecar of an SPK and upload it to Object Storage from a
+    worker thread of :func:`upload_builds`.
+
+    :returns: the sidecar
+    """
+    sidecar = _read_sidecar(spk_path, object_key, member_index)
+    if not storage.upload(spk_path, object_key):
+        raise RuntimeError("Upload to Object Storage failed")
+    return sidecar
+
+
+@celery.task(bind=True, queue="ops")
+def upload_builds(self, build_ids):
+    """Upload many signed local builds to Object Storage at once.
+
+    Builds are parsed, hashed and uploaded by a bounded thread pool
+    (``OBJECT_STORAGE_UPLOAD_WORKERS``) sharing the Object Storage client of
+    the process. Database updates stay in the task's own thread and are
+    committed every :data:`UPLOAD_COMMIT_SIZE` builds, then the local files of
+    the committed builds are removed. The CDN is purged once, at the end.
+    Progress is reported through the ``PROGRESS`` task state.
+    """
+    config = current_app.config
+    uploaded, skipped, failed = [], [], []
+    pending = {}
+    builds = db.session.execute(select(Build).where(Build.id.in_(build_ids)))
+    for build in builds.unique().scalars():
+        if build.storage != "local" or not build.path:
+            skipped.append(str(build))
+            continue
+        spk_path = os.path.join(config["DATA_PATH"], build.path)
+        rejected = _check_uploadable(build, spk_path)
+        if rejected is not None:
+            status, error = rejected
+            if status == "skipped":
+                skipped.append(str(build))
+            else:
+                failed.append([str(build), error])
+            continue
+        pending[build.id] = (spk_path, build.path, build.member_index)
+
+    purged = []
+    chunk = []
+
+    def commit_chunk():
+        try:
+            db.session.commit()
+        except Exception as exc:
+            db.session.rollback()
+            for label, _, _ in chunk:
+                uploaded.remove(label)
+                failed.append([label, str(exc) or "unknown error"])
+        else:
+            for _, spk_path, object_key in chunk:
+                try:
+                    os.remove(spk_path)
+                except OSError:
+                    pass
+                purged.append("/" + object_key)
+        chunk.clear()
+
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(
+        max_workers=config["OBJECT_STORAGE_UPLOAD_WORKERS"]
+    ) as pool:
+        futures = {
+            pool.submit(_in_worker, app, _upload_file, *args): build_id
+            for build_id, args in pending.items()
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            build = db.session.get(Build, futures[future])
+            label = str(build)
+            spk_path, object_key, _ = pending[build.id]
+            try:
+                sidecar, purges = future.result()
+            except Exception as exc:
+                failed.append([label, str(exc) or "unknown error"])
+            else:
+                storage.queue_purges(*purges)
+                calculated = sidecar["calculated"]
+                build.md5 = calculated["md5"]
+                build.size = calculated["size"]
+                build.member_index = calculated["member_index"]
+                build.sidecar = BuildSidecar.from_dict(sidecar)
+                build.storage = "remote"
+                uploaded.append(label)
+                chunk.append((label, spk_path, object_key))
+                if len(chunk) >= UPLOAD_COMMIT_SIZE:
+                    commit_chunk()
+            if self.request.id:
+                self.update_state(
+                    state="PROGRESS", meta={"done": done, "total": len(futures)}
+                )
+    if chunk:
+        commit_chunk()
+
+    if purged:
+        cache.delete("packages_versions")
+        clear_catalog_cache()
+        storage.purge_cdn(*purged)
+    result = {
+        "status": "error" if failed else "ok",
+        "type": "upload",
+        "label": f"Upload {len(build_ids)} build(s)",
+        "uploaded": uploaded,
+        "skipped": skipped,
+        "failed": failed,
+    }
+    if failed:
+        result["error"] = "; ".join(f"{label}: {error}" for label, error in failed)
+    return result
+
+
+def _check_rehomed(build, md5, size):
+    """Return why a file downloaded for `build` does not match its recorded
+    md5 and size, None if it does."""
+    if build.size is not None and size != build.size:
+        return f"size mismatch: expected {build.size}, got {size}"
+    if build.md5 and md5 != build.md5:
+        return f"md5 mismatch: expected {build.md5}, got {md5}"
+    return None
+
+
 @celery.task(bind=True, max_retries=3, default_retry_delay=10, queue="ops")
 def rehome_from_storage(self, build_id, build_label):
-    """Download a build from Object Storage back to local disk for editing."""
+    """Download a build from Object Storage back to local disk for editing.
+
+    The build is downloaded to a ``.part`` file next to its final path, verified
+    against its md5 and size as it is written, and renamed into place. A retry
+    resumes an interrupted download, and a file that fails verification is
+    discarded so the retry starts over. The remote copy is only deleted once
+    the local one is verified and recorded.
+    Transfer progress is reported through the ``PROGRESS`` task state.
+    """
     build = db.session.get(Build, build_id)
     if not build or not build.path:
         return {
@@ -315,27 +745,37 @@ def rehome_from_storage(self, build_id, build_label):
         }
 
     data_path = current_app.config["DATA_PATH"]
-    local_path = os.path.join(data_path, build.path)
+    object_key = build.path
+    local_path = os.path.join(data_path, object_key)
+    part_path = local_path + ".part"
 
     try:
-        if not storage.download(build.path, local_path):
-            return {
-                "status": "error",
-                "type": "rehome",
-                "build_id": build_id,
-                "label": build_label,
-                "error": "Download from Object Storage failed",
-            }
+        # a previous attempt may have stopped after moving the file into place
+        error = "missing file"
+        if os.path.isfile(local_path):
+            digests, size = hash_file(local_path)
+            error = _check_rehomed(build, digests["md5"], size)
+        if error is not None:
+            downloaded = storage.resume_download(
+                object_key, part_path, _transfer_progress(self)
+            )
+            if downloaded is None:
+                raise RuntimeError("Download from Object Storage failed")
+            error = _check_rehomed(build, *downloaded)
+            if error is not None:
+                os.remove(part_path)
+                raise RuntimeError(error)
+            os.replace(part_path, local_path)
 
         sidecar_path = local_path + ".json"
         if os.path.exists(sidecar_path):
             os.remove(sidecar_path)
 
-        storage.delete(build.path)
-        storage.purge_cdn("/" + build.path)
-
+        build.sidecar = None
         build.storage = "local"
         db.session.commit()
+        storage.delete(object_key)
+        storage.purge_cdn("/" + object_key)
         cache.delete("packages_versions")
         clear_catalog_cache()
         return {
@@ -357,3 +797,33 @@ def rehome_from_storage(self, build_id, build_label):
                 "label": build_label,
                 "error": str(exc),
             }
+
+
+@celery.task(bind=True, default_retry_delay=10, queue="ops")
+def flush_cdn_purges(self, url_paths, keys):
+    """Purge the URL paths and surrogate keys queued by
+    :func:`~spkrepo.storage.purge_cdn` during a request or task.
+
+    Only the purges that failed are retried, with an exponential backoff, up to
+    ``CDN_PURGE_RETRIES`` times.
+    """
+    failed_paths, failed_keys = storage.send_purges(url_paths, keys)
+    failed = failed_paths + failed_keys
+    if failed:
+        try:
+            raise self.retry(
+                args=(failed_paths, failed_keys),
+                countdown=self.default_retry_delay * 2**self.request.retries,
+                max_retries=current_app.config["CDN_PURGE_RETRIES"],
+            )
+        except self.MaxRetriesExceededError:
+            pass
+    result = {
+        "status": "error" if failed else "ok",
+        "type": "purge",
+        "label": f"Purge {len(url_paths) + len(keys)} CDN path(s) and key(s)",
+        "failed": failed,
+    }
+    if failed:
+        result["error"] = "CDN purge failed for " + ", ".join(failed)
+    return result